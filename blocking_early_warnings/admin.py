@@ -18,7 +18,49 @@ class MetricAdmin(admin.ModelAdmin):
     list_display = ("url", "asn", "hour", "measurement_count", "anomaly_count")
 
 
+class MetricRollupAdmin(admin.ModelAdmin):
+    list_display = (
+        "url",
+        "asn",
+        "resolution",
+        "period_start",
+        "measurement_count",
+        "anomaly_count",
+    )
+
+
+class MetricStatisticsAdmin(admin.ModelAdmin):
+    list_display = ("url", "asn", "count", "mean", "variance", "last_hour")
+
+
+class NotificationAdmin(admin.ModelAdmin):
+    list_display = ("channel", "title", "status", "attempts", "created_at", "sent_at")
+
+
+class NotificationChannelLeaseAdmin(admin.ModelAdmin):
+    list_display = ("channel", "leased_until", "scheduled_at")
+
+
+class AlertStateAdmin(admin.ModelAdmin):
+    list_display = ("url", "asn", "issue_type", "opened_at", "last_seen_at", "last_notified_at")
+
+
+class SyncCursorAdmin(admin.ModelAdmin):
+    list_display = ("country_code", "last_hour")
+
+
+class BackfillUnitAdmin(admin.ModelAdmin):
+    list_display = ("country_code", "day", "status", "started_at", "completed_at")
+
+
 admin.site.register(UrlList, UrlListAdmin)
 admin.site.register(Url, UrlAdmin)
 admin.site.register(ASN, AsnAdmin)
 admin.site.register(Metric, MetricAdmin)
+admin.site.register(MetricRollup, MetricRollupAdmin)
+admin.site.register(MetricStatistics, MetricStatisticsAdmin)
+admin.site.register(Notification, NotificationAdmin)
+admin.site.register(NotificationChannelLease, NotificationChannelLeaseAdmin)
+admin.site.register(AlertState, AlertStateAdmin)
+admin.site.register(SyncCursor, SyncCursorAdmin)
+admin.site.register(BackfillUnit, BackfillUnitAdmin)
@@ -0,0 +1,52 @@
+"""
+    Command to fill historical metrics for a range of days
+"""
+# Django imports
+from django.core.management.base import BaseCommand, CommandError
+
+# Local imports
+from blocking_early_warnings.utils.backfill import Backfiller
+import blocking_early_warnings.tasks as tasks
+
+# Python imports
+from datetime import date
+
+
+class Command(BaseCommand):
+    help = "Sync metrics for every day in the given range. Days already backfilled are skipped"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "since",
+            type=date.fromisoformat,
+            help="First day to backfill, as YYYY-MM-DD",
+        )
+        parser.add_argument(
+            "until", type=date.fromisoformat, help="Last day to backfill, as YYYY-MM-DD"
+        )
+        parser.add_argument(
+            "--async",
+            action="store_true",
+            dest="run_async",
+            help="Dispatch days to celery workers instead of processing them in this process",
+        )
+
+    def handle(self, *args, since: date, until: date, run_async: bool, **options):
+        if since > until:
+            raise CommandError(
+                f"'since' ({since}) should not be after 'until' ({until})"
+            )
+
+        if run_async:
+            tasks.backfill_metrics.delay(since.isoformat(), until.isoformat())
+            self.stdout.write(f"Backfill from {since} to {until} dispatched to celery")
+            return
+
+        backfiller = Backfiller()
+        for unit in backfiller.plan(since, until):
+            self.stdout.write(f"Backfilling {unit.day}...")
+            backfiller.run_unit(unit.id)
+
+        self.stdout.write(
+            self.style.SUCCESS(f"Backfill from {since} to {until} completed")
+        )
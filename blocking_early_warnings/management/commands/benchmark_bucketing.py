@@ -0,0 +1,78 @@
+"""
+    Micro-benchmark for hour bucketing of ooni measurements
+"""
+# Django imports
+from django.core.management.base import BaseCommand
+
+# Local imports
+from blocking_early_warnings.settings import DATE_FORMAT
+from blocking_early_warnings.utils.misc import get_hour_from_str, get_hour_from_time_str
+from blocking_early_warnings.utils.ooni_requests import DBMetricsClient
+
+# Python imports
+from datetime import datetime, timedelta
+from pytz import utc
+from typing import Any, Callable, Dict, List
+import random
+import time
+
+
+class Command(BaseCommand):
+    help = "Measure how many measurements per second can be bucketed by hour"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--measurements",
+            type=int,
+            default=200_000,
+            help="How many synthetic measurements to bucket",
+        )
+        parser.add_argument(
+            "--hours", type=int, default=24, help="Hours spanned by the measurements"
+        )
+
+    def handle(self, *args, measurements: int, hours: int, **options):
+        since = datetime(2022, 6, 1, tzinfo=utc)
+        data = self._make_measurements(since, measurements, hours)
+        time_strs = [m["measurement_start_time"] for m in data]
+
+        self._report(
+            "get_hour_from_str",
+            measurements,
+            lambda: [get_hour_from_str(t) for t in time_strs],
+        )
+        self._report(
+            "get_hour_from_time_str",
+            measurements,
+            lambda: [get_hour_from_time_str(t) for t in time_strs],
+        )
+
+        # Full bucketing loop, the way the ingestion runs it
+        client = DBMetricsClient()
+        self._report(
+            "compute_metrics",
+            measurements,
+            lambda: client.compute_metrics(data, since=since, number_of_hours=hours),
+        )
+
+    def _report(self, name: str, n: int, fn: Callable[[], Any]):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+
+        self.stdout.write(
+            f"{name:<24} {n / elapsed:>14,.0f} measurements/s ({elapsed:.3f}s)"
+        )
+
+    @staticmethod
+    def _make_measurements(since: datetime, n: int, hours: int) -> List[Dict[str, Any]]:
+        rnd = random.Random(42)
+        return [
+            {
+                "measurement_start_time": datetime.strftime(
+                    since + timedelta(seconds=rnd.randrange(hours * 3600)), DATE_FORMAT
+                ),
+                "anomaly": rnd.random() < 0.1,
+            }
+            for _ in range(n)
+        ]
@@ -0,0 +1,108 @@
+"""
+    Micro-benchmark for vectorized anomaly detectors
+"""
+# Django imports
+from django.core.management.base import BaseCommand
+
+# Local imports
+from blocking_early_warnings.settings import MONITOR_DETECTORS
+from blocking_early_warnings.utils.anomaly_monitor import BatchAnomalyDetector
+from blocking_early_warnings.utils.detectors import (
+    DETECTORS,
+    SeriesBatch,
+    create_detector,
+)
+
+# Python imports
+from typing import Any, Callable
+import numpy as np
+import time
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure how many (asn, url) pairs per second every anomaly detector can check"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--pairs",
+            type=int,
+            default=100_000,
+            help="How many synthetic (asn, url) pairs to check",
+        )
+        parser.add_argument(
+            "--hours", type=int, default=24, help="Hours of metrics for every pair"
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=3,
+            help="Runs for every detector, the best one is reported",
+        )
+
+    def handle(self, *args, pairs: int, hours: int, repeat: int, **options):
+        arrays = self._make_arrays(pairs, hours)
+        n_metrics = len(arrays["measurement_counts"])
+        self.stdout.write(f"{pairs:,} pairs, {n_metrics:,} metrics")
+
+        self._report(
+            "load batch",
+            pairs,
+            n_metrics,
+            repeat,
+            lambda: SeriesBatch.from_arrays(**arrays),
+        )
+
+        batch = SeriesBatch.from_arrays(**arrays)
+        for name in DETECTORS:
+            detector = create_detector(name)
+            self._report(name, pairs, n_metrics, repeat, lambda: detector.detect(batch))
+
+        # Whole configured pipeline, including loading the batch and collecting offending metrics
+        pipeline = BatchAnomalyDetector(
+            spike_tolerance=0.1,
+            detectors=[create_detector(name) for name in MONITOR_DETECTORS],
+        )
+        self._report(
+            "pipeline",
+            pairs,
+            n_metrics,
+            repeat,
+            lambda: pipeline.detect_arrays(**arrays),
+        )
+
+    def _report(
+        self, name: str, pairs: int, metrics: int, repeat: int, fn: Callable[[], Any]
+    ):
+        elapsed = float("inf")
+        for _ in range(max(repeat, 1)):
+            start = time.perf_counter()
+            fn()
+            elapsed = min(elapsed, time.perf_counter() - start)
+
+        self.stdout.write(
+            f"{name:<20} {pairs / elapsed:>14,.0f} pairs/s {metrics / elapsed:>16,.0f} metrics/s ({elapsed:.3f}s)"
+        )
+
+    @staticmethod
+    def _make_arrays(pairs: int, hours: int):
+        rng = np.random.default_rng(42)
+
+        # Some pairs miss a few hours
+        lengths = rng.integers(max(hours - 3, 1), hours + 1, size=pairs)
+        n_metrics = int(lengths.sum())
+
+        measurement_counts = rng.integers(0, 50, size=n_metrics)
+        anomaly_counts = rng.binomial(measurement_counts, 0.05)
+
+        # Every pair starts at the same hour, missing hours are at the end
+        starts = np.cumsum(lengths) - lengths
+        hours_since_start = np.arange(n_metrics) - np.repeat(starts, lengths)
+
+        return {
+            "lengths": lengths,
+            "measurement_counts": measurement_counts,
+            "anomaly_counts": anomaly_counts,
+            "hours": 455_000 + hours_since_start,
+        }
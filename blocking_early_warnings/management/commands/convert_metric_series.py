@@ -0,0 +1,39 @@
+"""
+    Command to store hourly metrics as packed daily series
+"""
+# Django imports
+from django.core.management.base import BaseCommand, CommandError
+
+# Local imports
+from blocking_early_warnings.settings import DATE_FORMAT
+from blocking_early_warnings.utils.metric_series import MetricSeriesStore
+
+# Python imports
+from datetime import datetime
+from pytz import utc
+
+
+class Command(BaseCommand):
+    help = "Convert hourly metrics to packed daily series, overwriting already converted days"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--since",
+            default=None,
+            help=f"Only convert metrics after this time, formatted as {DATE_FORMAT}",
+        )
+        parser.add_argument(
+            "--until",
+            default=None,
+            help=f"Only convert metrics before this time, formatted as {DATE_FORMAT}",
+        )
+
+    def handle(self, *args, since: str, until: str, **options):
+        try:
+            since = since and datetime.strptime(since, DATE_FORMAT).replace(tzinfo=utc)
+            until = until and datetime.strptime(until, DATE_FORMAT).replace(tzinfo=utc)
+        except ValueError:
+            raise CommandError(f"Invalid date format. Expected format: {DATE_FORMAT}")
+
+        written = MetricSeriesStore().convert_from_metrics(since=since, until=until)
+        self.stdout.write(self.style.SUCCESS(f"Wrote {written} daily metric series"))
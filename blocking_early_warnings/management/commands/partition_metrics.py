@@ -0,0 +1,37 @@
+"""
+    Command to convert the metric table to a time partitioned table
+"""
+# Django imports
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+# Local imports
+from blocking_early_warnings.utils.metric_storage import MetricStorageManager
+
+
+class Command(BaseCommand):
+    help = "Partition the metric table by hour range. Only supported on PostgreSQL"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--granularity",
+            choices=["day", "month"],
+            default=None,
+            help="Time span of every partition. Defaults to METRIC_PARTITION_GRANULARITY",
+        )
+
+    def handle(self, *args, granularity: str, **options):
+        if connection.vendor != "postgresql":
+            raise CommandError("Metric partitioning is only supported on PostgreSQL")
+
+        manager = (
+            MetricStorageManager(granularity=granularity)
+            if granularity
+            else MetricStorageManager()
+        )
+        if manager.is_partitioned():
+            self.stdout.write("Metric table is already partitioned")
+            return
+
+        manager.partition_table()
+        self.stdout.write(self.style.SUCCESS("Metric table partitioned"))
@@ -0,0 +1,19 @@
+"""
+    Command to recompute daily and weekly metric rollups from hourly metrics
+"""
+# Django imports
+from django.core.management.base import BaseCommand
+
+# Local imports
+from blocking_early_warnings.models import MetricRollup
+from blocking_early_warnings.utils.rollups import RollupManager
+
+
+class Command(BaseCommand):
+    help = "Recompute every daily and weekly metric rollup from stored hourly metrics"
+
+    def handle(self, *args, **options):
+        RollupManager().rebuild_all()
+        self.stdout.write(
+            self.style.SUCCESS(f"Rebuilt {MetricRollup.objects.count()} metric rollups")
+        )
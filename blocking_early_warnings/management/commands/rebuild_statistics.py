@@ -0,0 +1,20 @@
+"""
+    Command to recompute running anomaly statistics for every url and asn from stored metrics
+"""
+# Django imports
+from django.core.management.base import BaseCommand
+
+# Local imports
+from blocking_early_warnings.utils.running_statistics import RunningStatisticsManager
+
+
+class Command(BaseCommand):
+    help = "Recompute running anomaly statistics for every url and asn from stored hourly metrics"
+
+    def handle(self, *args, **options):
+        count = RunningStatisticsManager().rebuild()
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Rebuilt running statistics for {count} url and asn pairs"
+            )
+        )
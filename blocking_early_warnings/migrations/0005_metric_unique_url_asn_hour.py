@@ -0,0 +1,42 @@
+# Generated by Django 4.2.30 on 2026-10-17 00:55
+
+from django.db import migrations, models
+
+
+def delete_duplicated_metrics(apps, schema_editor):
+    """Keep only the most recent metric for every (url, asn, hour) so the
+    unique constraint can be created"""
+    Metric = apps.get_model("blocking_early_warnings", "Metric")
+
+    duplicated = (
+        Metric.objects.filter(hour__isnull=False)
+        .values("url_id", "asn_id", "hour")
+        .annotate(n=models.Count("id"), last_id=models.Max("id"))
+        .filter(n__gt=1)
+        .order_by()
+    )
+
+    for row in duplicated.iterator():
+        Metric.objects.filter(
+            url_id=row["url_id"], asn_id=row["asn_id"], hour=row["hour"]
+        ).exclude(id=row["last_id"]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        (
+            "blocking_early_warnings",
+            "0004_anomalyreport_earlywarningsettings_synccursor",
+        ),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicated_metrics, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="metric",
+            constraint=models.UniqueConstraint(
+                fields=("url", "asn", "hour"), name="unique_metric_url_asn_hour"
+            ),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 4.2.30 on 2026-10-17 00:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("blocking_early_warnings", "0005_metric_unique_url_asn_hour"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="BackfillUnit",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("country_code", models.TextField(max_length=10)),
+                ("day", models.DateField()),
+                (
+                    "status",
+                    models.TextField(
+                        choices=[
+                            ("pending", "Pending"),
+                            ("running", "Running"),
+                            ("done", "Done"),
+                            ("failed", "Failed"),
+                        ],
+                        default="pending",
+                    ),
+                ),
+                ("completed_at", models.DateTimeField(default=None, null=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="backfillunit",
+            constraint=models.UniqueConstraint(
+                fields=("country_code", "day"), name="unique_backfill_country_day"
+            ),
+        ),
+    ]
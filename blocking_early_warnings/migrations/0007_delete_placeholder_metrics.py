@@ -0,0 +1,37 @@
+# Generated by Django 4.2.30 on 2026-10-17 01:12
+
+from django.db import migrations
+
+# How many placeholder metrics are deleted in each transaction
+CHUNK_SIZE = 10000
+
+
+def delete_placeholder_metrics(apps, schema_editor):
+    """Delete empty metrics created when adding urls or asns, they have no hour
+    and no counts. Deleted in chunks to avoid a huge transaction"""
+    Metric = apps.get_model("blocking_early_warnings", "Metric")
+
+    while True:
+        ids = list(
+            Metric.objects.filter(hour__isnull=True).values_list("id", flat=True)[
+                :CHUNK_SIZE
+            ]
+        )
+        if not ids:
+            break
+
+        Metric.objects.filter(id__in=ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    # Every chunk is committed on its own
+    atomic = False
+
+    dependencies = [
+        ("blocking_early_warnings", "0006_backfillunit"),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_placeholder_metrics, migrations.RunPython.noop),
+    ]
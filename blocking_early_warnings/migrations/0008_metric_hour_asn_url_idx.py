@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-17 01:01
+
+from django.db import migrations, models
+import blocking_early_warnings.operations
+
+
+class Migration(migrations.Migration):
+
+    # Indexes are created concurrently on PostgreSQL, which can't run in a transaction
+    atomic = False
+
+    dependencies = [
+        ("blocking_early_warnings", "0007_delete_placeholder_metrics"),
+    ]
+
+    operations = [
+        blocking_early_warnings.operations.AddIndexConcurrently(
+            model_name="metric",
+            index=models.Index(
+                fields=["hour", "asn", "url"],
+                include=("anomaly_count", "measurement_count"),
+                name="metric_hour_asn_url_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 4.2.30 on 2026-10-17 01:04
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("blocking_early_warnings", "0008_metric_hour_asn_url_idx"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MetricRollup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "resolution",
+                    models.TextField(choices=[("day", "Day"), ("week", "Week")]),
+                ),
+                ("period_start", models.DateTimeField()),
+                ("anomaly_count", models.IntegerField(default=0)),
+                ("measurement_count", models.IntegerField(default=0)),
+                (
+                    "asn",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="blocking_early_warnings.asn",
+                    ),
+                ),
+                (
+                    "url",
+                    models.ForeignKey(
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="blocking_early_warnings.url",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["resolution", "period_start", "asn"],
+                        name="rollup_period_asn_idx",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 4.2.30 on 2026-10-17 01:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("blocking_early_warnings", "0009_metricrollup"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MetricSeries",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("day", models.DateField()),
+                ("counts", models.BinaryField()),
+                (
+                    "asn",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="blocking_early_warnings.asn",
+                    ),
+                ),
+                (
+                    "url",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="blocking_early_warnings.url",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["day", "asn", "url"], name="series_day_asn_url_idx"
+                    )
+                ],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="metricseries",
+            constraint=models.UniqueConstraint(
+                fields=("url", "asn", "day"), name="unique_series_url_asn_day"
+            ),
+        ),
+    ]
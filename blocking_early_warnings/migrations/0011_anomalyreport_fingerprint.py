@@ -0,0 +1,63 @@
+# Generated by Django 4.2.30 on 2026-10-17 01:20
+
+from django.db import migrations, models
+
+import hashlib
+
+
+def compute_fingerprint(asn_id, url_id, issue_type, metric_ids):
+    """Copy of AnomalyReport.compute_fingerprint when this migration was created"""
+    metrics = ",".join(str(m) for m in sorted(metric_ids))
+    return hashlib.sha256(
+        f"{asn_id}|{url_id}|{issue_type}|{metrics}".encode()
+    ).hexdigest()
+
+
+def fill_fingerprints(apps, schema_editor):
+    """Compute the fingerprint of every existing report. Reports identical to an older
+    one are deleted, so the unique constraint can be created"""
+    AnomalyReport = apps.get_model("blocking_early_warnings", "AnomalyReport")
+    Through = AnomalyReport.metrics.through
+
+    metric_ids = {}
+    for (report_id, metric_id) in Through.objects.values_list(
+        "anomalyreport_id", "metric_id"
+    ).iterator():
+        metric_ids.setdefault(report_id, []).append(metric_id)
+
+    seen = set()
+    duplicated = []
+    for report in list(AnomalyReport.objects.order_by("id")):
+        fingerprint = compute_fingerprint(
+            asn_id=report.asn_id,
+            url_id=report.url_id,
+            issue_type=report.issue_type,
+            metric_ids=metric_ids.get(report.id, []),
+        )
+        if fingerprint in seen:
+            duplicated.append(report.id)
+            continue
+
+        seen.add(fingerprint)
+        report.fingerprint = fingerprint
+        report.save(update_fields=["fingerprint"])
+
+    AnomalyReport.objects.filter(id__in=duplicated).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("blocking_early_warnings", "0010_metricseries"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="anomalyreport",
+            name="fingerprint",
+            field=models.CharField(
+                max_length=64, null=True, verbose_name="Fingerprint"
+            ),
+        ),
+        migrations.RunPython(fill_fingerprints, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.30 on 2026-10-17 01:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    # Kept apart from filling fingerprints, since PostgreSQL can't alter a table in the
+    # same transaction that deleted rows referenced by deferred foreign keys
+    dependencies = [
+        ("blocking_early_warnings", "0011_anomalyreport_fingerprint"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="anomalyreport",
+            name="fingerprint",
+            field=models.CharField(
+                max_length=64, unique=True, verbose_name="Fingerprint"
+            ),
+        ),
+    ]
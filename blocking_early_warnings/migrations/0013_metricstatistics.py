@@ -0,0 +1,52 @@
+# Generated by Django 4.2.30 on 2026-10-17 01:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("blocking_early_warnings", "0012_alter_anomalyreport_fingerprint"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MetricStatistics",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("count", models.IntegerField(default=0)),
+                ("mean", models.FloatField(default=0)),
+                ("variance", models.FloatField(default=0)),
+                ("last_hour", models.DateTimeField(default=None, null=True)),
+                (
+                    "asn",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="blocking_early_warnings.asn",
+                    ),
+                ),
+                (
+                    "url",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="blocking_early_warnings.url",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="metricstatistics",
+            constraint=models.UniqueConstraint(
+                fields=("url", "asn"), name="unique_statistics_url_asn"
+            ),
+        ),
+    ]
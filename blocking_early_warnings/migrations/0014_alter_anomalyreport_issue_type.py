@@ -0,0 +1,29 @@
+# Generated by Django 4.2.30 on 2026-10-17 01:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("blocking_early_warnings", "0013_metricstatistics"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="anomalyreport",
+            name="issue_type",
+            field=models.TextField(
+                choices=[
+                    ("ok", "Ok"),
+                    ("spike", "Spike"),
+                    ("high_anomaly_rate", "High Anomaly Rate"),
+                    ("ewma_deviation", "Ewma Deviation"),
+                    ("robust_outlier", "Robust Outlier"),
+                    ("level_shift", "Level Shift"),
+                    ("seasonal_deviation", "Seasonal Deviation"),
+                ],
+                verbose_name="Anomaly type",
+            ),
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 4.2.30 on 2026-10-17 01:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("blocking_early_warnings", "0014_alter_anomalyreport_issue_type"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Notification",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("channel", models.TextField()),
+                ("title", models.TextField()),
+                ("message", models.TextField()),
+                ("payload", models.JSONField(default=list)),
+                (
+                    "status",
+                    models.TextField(
+                        choices=[
+                            ("pending", "Pending"),
+                            ("sending", "Sending"),
+                            ("sent", "Sent"),
+                            ("failed", "Failed"),
+                            ("dropped", "Dropped"),
+                        ],
+                        default="pending",
+                    ),
+                ),
+                ("attempts", models.IntegerField(default=0)),
+                ("next_attempt_at", models.DateTimeField(default=None, null=True)),
+                ("last_error", models.TextField(default=None, null=True)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("claimed_at", models.DateTimeField(default=None, null=True)),
+                ("sent_at", models.DateTimeField(default=None, null=True)),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["channel", "status", "next_attempt_at"],
+                        name="notification_channel_idx",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 4.2.30 on 2026-10-17 01:33
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("blocking_early_warnings", "0015_notification"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AlertState",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "issue_type",
+                    models.TextField(
+                        choices=[
+                            ("ok", "Ok"),
+                            ("spike", "Spike"),
+                            ("high_anomaly_rate", "High Anomaly Rate"),
+                            ("ewma_deviation", "Ewma Deviation"),
+                            ("robust_outlier", "Robust Outlier"),
+                            ("level_shift", "Level Shift"),
+                            ("seasonal_deviation", "Seasonal Deviation"),
+                        ],
+                        verbose_name="Anomaly type",
+                    ),
+                ),
+                ("opened_at", models.DateTimeField()),
+                ("last_seen_at", models.DateTimeField()),
+                ("last_notified_at", models.DateTimeField(default=None, null=True)),
+                ("notified_peak_ratio", models.FloatField(default=0)),
+                (
+                    "asn",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="blocking_early_warnings.asn",
+                    ),
+                ),
+                (
+                    "url",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="blocking_early_warnings.url",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="alertstate",
+            constraint=models.UniqueConstraint(
+                fields=("url", "asn", "issue_type"),
+                name="unique_alert_state_url_asn_issue_type",
+            ),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-17 01:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("blocking_early_warnings", "0016_alertstate"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="alertstate",
+            name="issue_type",
+            field=models.TextField(verbose_name="Anomaly type"),
+        ),
+        migrations.AlterField(
+            model_name="anomalyreport",
+            name="issue_type",
+            field=models.TextField(verbose_name="Anomaly type"),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 4.2.30 on 2026-10-17 02:04
+
+from django.db import migrations, models
+
+
+def delete_duplicated_rollups(apps, schema_editor):
+    """Keep a single rollup for every period, asn and url. Duplicates were computed from
+    the same metrics by concurrent updates, so any of them can be kept"""
+    MetricRollup = apps.get_model("blocking_early_warnings", "MetricRollup")
+
+    seen = set()
+    duplicated = []
+    for (rollup_id, *key) in (
+        MetricRollup.objects.order_by("id")
+        .values_list("id", "resolution", "period_start", "asn_id", "url_id")
+        .iterator()
+    ):
+        key = tuple(key)
+        if key in seen:
+            duplicated.append(rollup_id)
+        seen.add(key)
+
+    MetricRollup.objects.filter(id__in=duplicated).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("blocking_early_warnings", "0017_issue_type_plain_text"),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicated_rollups, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="metricrollup",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("url__isnull", False)),
+                fields=("resolution", "period_start", "asn", "url"),
+                name="unique_rollup_period_asn_url",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="metricrollup",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("url__isnull", True)),
+                fields=("resolution", "period_start", "asn"),
+                name="unique_rollup_period_asn",
+            ),
+        ),
+    ]
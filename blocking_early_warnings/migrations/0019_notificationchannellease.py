@@ -0,0 +1,32 @@
+# Generated by Django 4.2.30 on 2026-10-17 02:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("blocking_early_warnings", "0018_metricrollup_unique_period"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="NotificationChannelLease",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("channel", models.TextField(unique=True)),
+                ("leased_until", models.DateTimeField(default=None, null=True)),
+                ("lease_token", models.TextField(default=None, null=True)),
+                ("scheduled_at", models.DateTimeField(default=None, null=True)),
+                ("scheduled_token", models.TextField(default=None, null=True)),
+            ],
+        ),
+    ]
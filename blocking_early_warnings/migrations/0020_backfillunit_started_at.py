@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-17 02:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("blocking_early_warnings", "0019_notificationchannellease"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="backfillunit",
+            name="started_at",
+            field=models.DateTimeField(default=None, null=True),
+        ),
+    ]
@@ -1,13 +1,10 @@
 # Django imports
 from typing_extensions import Self
-from django.db import models
-from django.db.models.signals import post_save
-
-# Local imports
-from blocking_early_warnings.settings import NUMBER_OF_HOURS
+from django.db import models, transaction
 
 # Python imports
-from typing import Type, Optional, Iterable
+from typing import Type, Optional, Iterable, List
+import hashlib
 
 
 class UrlList(models.Model):
@@ -105,28 +102,6 @@ class Url(models.Model):
     def __str__(self) -> str:
         return self.__repr__()
 
-    @staticmethod
-    def post_save(
-        sender, instance, created, raw, using, update_fields, *args, **kwargs
-    ):
-        """
-        Create a valid set of metrics for this new instance
-        """
-        # if not a new instance, do nothing
-        if not created:
-            return
-
-        asns = ASN.objects.all()
-
-        # create a new metric for each asn
-        for asn in asns:
-            for _ in range(NUMBER_OF_HOURS):
-                metric = Metric(asn=asn, url=instance)
-                metric.save()
-
-
-post_save.connect(Url.post_save, sender=Url)
-
 
 class ASN(models.Model):
     """
@@ -139,23 +114,6 @@ class ASN(models.Model):
     # ASN code, for example: AS8048
     code = models.TextField(unique=True, max_length=100, null=False)
 
-    @staticmethod
-    def post_save(
-        sender, instance, created, raw, using, update_fields, *args, **kwargs
-    ):
-        """
-        Create a valid set of metrics for every URL with this asn
-        """
-        # if not a new instance, do nothing
-        if not created:
-            return
-
-        urls = Url.objects.all()
-        for url in urls:
-            for _ in range(NUMBER_OF_HOURS):
-                metric = Metric(asn=instance, url=url)
-                metric.save()
-
     def __repr__(self) -> str:
         return f"{self.code} - {self.name}"
 
@@ -163,13 +121,10 @@ class ASN(models.Model):
         return self.__repr__()
 
 
-post_save.connect(ASN.post_save, sender=ASN)
-
-
 class Metric(models.Model):
     """
-    A metric for an URL. Every URL has 24 metrics per ASN, one per hour
-    for such asn
+    A metric for an URL and ASN in a given hour. Metrics are only created
+    when there's data for them, so there might be missing hours
     """
 
     # Hour for this metric
@@ -187,30 +142,212 @@ class Metric(models.Model):
     # URL related to this metric
     url = models.ForeignKey(to=Url, null=False, on_delete=models.CASCADE)
 
+    class Meta:
+        constraints = [
+            # Metrics are upserted by (url, asn, hour) when syncing with ooni
+            models.UniqueConstraint(
+                fields=["url", "asn", "hour"], name="unique_metric_url_asn_hour"
+            ),
+        ]
+        indexes = [
+            # Range scans by hour, like the histogram and the anomaly monitor. Counts are
+            # included so aggregates can be computed with index only scans on PostgreSQL
+            models.Index(
+                fields=["hour", "asn", "url"],
+                include=["anomaly_count", "measurement_count"],
+                name="metric_hour_asn_url_idx",
+            ),
+        ]
+
     def __repr__(self) -> str:
         return f"Metric(hour={self.hour}, anomaly_count={self.anomaly_count}, measurement_count={self.measurement_count}, asn={self.asn}, url={self.url})"
 
 
+class MetricRollup(models.Model):
+    """
+    Aggregated metrics for a whole day or week, used to answer long range queries
+    without reading every hourly metric. Rollups with no url aggregate every url
+    for their asn
+    """
+
+    class Resolution(models.TextChoices):
+        DAY = "day"
+        WEEK = "week"
+
+    resolution = models.TextField(choices=Resolution.choices, null=False)
+
+    # Start of the aggregated period. Weeks start on monday
+    period_start = models.DateTimeField(null=False)
+
+    anomaly_count = models.IntegerField(default=0)
+    measurement_count = models.IntegerField(default=0)
+
+    asn = models.ForeignKey(to=ASN, null=False, on_delete=models.CASCADE)
+
+    # Null when this rollup aggregates every url for its asn
+    url = models.ForeignKey(to=Url, null=True, on_delete=models.CASCADE)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["resolution", "period_start", "asn"],
+                name="rollup_period_asn_idx",
+            ),
+        ]
+        constraints = [
+            # Nulls are distinct in unique constraints, so rollups for every url need their own
+            models.UniqueConstraint(
+                fields=["resolution", "period_start", "asn", "url"],
+                condition=models.Q(url__isnull=False),
+                name="unique_rollup_period_asn_url",
+            ),
+            models.UniqueConstraint(
+                fields=["resolution", "period_start", "asn"],
+                condition=models.Q(url__isnull=True),
+                name="unique_rollup_period_asn",
+            ),
+        ]
+
+    def __repr__(self) -> str:
+        return f"MetricRollup(resolution={self.resolution}, period_start={self.period_start}, anomaly_count={self.anomaly_count}, measurement_count={self.measurement_count}, asn={self.asn}, url={self.url})"
+
+
+class MetricSeries(models.Model):
+    """
+    Hourly metrics for an URL and ASN during a whole day, packed in a single binary
+    column. A compact alternative to storing one Metric per hour, see
+    blocking_early_warnings.utils.metric_series to read and write them
+    """
+
+    # Day for this series, in utc
+    day = models.DateField(null=False)
+
+    # 24 measurement counts followed by 24 anomaly counts, as little endian uint32
+    counts = models.BinaryField(null=False)
+
+    asn = models.ForeignKey(to=ASN, null=False, on_delete=models.CASCADE)
+
+    url = models.ForeignKey(to=Url, null=False, on_delete=models.CASCADE)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["url", "asn", "day"], name="unique_series_url_asn_day"
+            ),
+        ]
+        indexes = [
+            models.Index(fields=["day", "asn", "url"], name="series_day_asn_url_idx"),
+        ]
+
+    def __repr__(self) -> str:
+        return f"MetricSeries(day={self.day}, asn={self.asn}, url={self.url})"
+
+
+class MetricStatistics(models.Model):
+    """
+    Running statistics of the anomaly ratio for an URL and ASN, updated with every
+    newly synced hour, so new hours can be tested for spikes without reading
+    the whole history
+    """
+
+    # How many hours were folded in these statistics
+    count = models.IntegerField(default=0)
+
+    # Exponentially weighted mean and variance of the anomaly ratio
+    mean = models.FloatField(default=0)
+    variance = models.FloatField(default=0)
+
+    # Last hour folded in these statistics. Older hours are never folded again
+    last_hour = models.DateTimeField(null=True, default=None)
+
+    asn = models.ForeignKey(to=ASN, null=False, on_delete=models.CASCADE)
+
+    url = models.ForeignKey(to=Url, null=False, on_delete=models.CASCADE)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["url", "asn"], name="unique_statistics_url_asn"
+            ),
+        ]
+
+    def is_spike(self, ratio: float, tolerance: float) -> bool:
+        """Check if the given anomaly ratio is a spike compared to these statistics,
+        using the same criteria as the anomaly monitor
+
+        Args:
+            ratio (float): Anomaly ratio to check
+            tolerance (float): Spike tolerance
+
+        Returns:
+            bool: If the given ratio is a spike
+        """
+        return ratio > self.mean + self.variance + tolerance
+
+    def __repr__(self) -> str:
+        return f"MetricStatistics(count={self.count}, mean={self.mean}, variance={self.variance}, last_hour={self.last_hour}, asn={self.asn}, url={self.url})"
+
+
 class AnomalyReport(models.Model):
     """Represents an anomaly event. It has all the relevant data to identify 
     an anomaly.
     """
 
     class IssueType(models.TextChoices):
-        """Possible types of anomaly. Remember to update 
-        this enum if you add more issue types to the anomaly monitor module
+        """Issue types reported by the built-in detectors. Detectors registered by other
+        modules can report more types, so issue types are stored as plain text
         """
         OK = "ok"
         SPIKE = "spike"
         HIGH_ANOMALY_RATE = "high_anomaly_rate"
+        EWMA_DEVIATION = "ewma_deviation"
+        ROBUST_OUTLIER = "robust_outlier"
+        LEVEL_SHIFT = "level_shift"
+        SEASONAL_DEVIATION = "seasonal_deviation"
 
 
     asn = models.ForeignKey(verbose_name="ASN", to=ASN, on_delete=models.CASCADE, null=False)
     metrics = models.ManyToManyField(verbose_name="Offending metrics", to=Metric)
     url = models.ForeignKey(verbose_name="Affected URL", to=Url, on_delete=models.CASCADE, null=False)
-    issue_type = models.TextField(verbose_name="Anomaly type", choices=IssueType.choices)
+    issue_type = models.TextField(verbose_name="Anomaly type")
     # TODO Should we add start time and end time?
 
+    # Hash of asn, url, issue type and sorted metric ids. Identical reports share the same fingerprint
+    fingerprint = models.CharField(verbose_name="Fingerprint", max_length=64, unique=True, null=False)
+
+    @staticmethod
+    def compute_fingerprint(asn_id : int, url_id : int, issue_type : str, metric_ids : Iterable[int]) -> str:
+        """Compute the fingerprint for a report with the given data
+
+        Args:
+            asn_id (int): id of the report's asn
+            url_id (int): id of the report's url
+            issue_type (str): issue type value
+            metric_ids (Iterable[int]): ids of the offending metrics, in any order
+
+        Returns:
+            str: hex encoded sha256 hash identifying this report
+        """
+        metrics = ",".join(str(m) for m in sorted(metric_ids))
+        return hashlib.sha256(f"{asn_id}|{url_id}|{issue_type}|{metrics}".encode()).hexdigest()
+
+    @classmethod
+    def fingerprint_for_issue(cls, description) -> str:
+        """Compute the fingerprint for a report created from the given issue description
+
+        Args:
+            description (IssueDescription): Issue to compute a fingerprint for
+
+        Returns:
+            str: Fingerprint for the issue
+        """
+        return cls.compute_fingerprint(
+            asn_id=description.asn.id,
+            url_id=description.url.id,
+            issue_type=description.issue_type.value,
+            metric_ids=(m.id for m in description.metrics)
+        )
+
     @classmethod
     def create_from_issue_description(cls, description) -> Self: 
         """Create a new report from an issue description. If an identical report already exists, do nothing
@@ -222,32 +359,224 @@ class AnomalyReport(models.Model):
             Self: Report instance stored in database. It might be new or an already existent one depending if 
             the given issue was new or not
         """
-        from blocking_early_warnings.utils.anomaly_monitor import IssueDescription # Imported here to avoid circular dependencies
-
-        issue_description : IssueDescription = description
-        qs = cls.objects \
-            .all() \
-            .annotate(n_metrics = models.Count("metrics")) \
-            .filter(
-                asn=issue_description.asn, 
-                url=issue_description.url, 
-                issue_type = issue_description.issue_type.value,
-                n_metrics = len(issue_description.metrics)
+        return cls.bulk_create_from_issue_descriptions([description])[0]
+
+    @classmethod
+    def bulk_create_from_issue_descriptions(cls, descriptions : Iterable) -> List[Self]:
+        """Create reports for every given issue description at once, along with their metrics. 
+        Issues with an already existent report, or repeated issues, are not created again
+
+        Args:
+            descriptions (Iterable[IssueDescription]): Issues to use to build new reports
+
+        Returns:
+            List[Self]: Report instance for every given issue, in the same order. They might be new or already existent ones
+        """
+        descriptions = list(descriptions)
+        fingerprints = [cls.fingerprint_for_issue(d) for d in descriptions]
+
+        with transaction.atomic():
+            existing = set(cls.objects.filter(fingerprint__in=fingerprints).values_list("fingerprint", flat=True))
+
+            # Only one report per fingerprint, even if the same issue was given multiple times
+            new_reports = {}
+            for (fingerprint, description) in zip(fingerprints, descriptions):
+                if fingerprint in existing or fingerprint in new_reports:
+                    continue
+
+                new_reports[fingerprint] = (description, cls(
+                    asn=description.asn,
+                    url=description.url,
+                    issue_type=description.issue_type.value,
+                    fingerprint=fingerprint,
+                ))
+
+            # Reports created concurrently by another run are skipped
+            cls.objects.bulk_create([report for (_, report) in new_reports.values()], ignore_conflicts=True)
+
+            # Primary keys are not returned for every database when ignoring conflicts, so reload them
+            reports = cls.objects.in_bulk(fingerprints, field_name="fingerprint")
+
+            Through = cls.metrics.through
+            Through.objects.bulk_create(
+                [
+                    Through(anomalyreport_id=reports[fingerprint].id, metric_id=metric.id)
+                    for (fingerprint, (description, _)) in new_reports.items()
+                    for metric in description.metrics
+                ],
+                ignore_conflicts=True
             )
 
-        # Chain multiple filters searching for the one that matches the same metrics
-        for m in issue_description.metrics:
-            qs = qs.filter(metrics=m)  
+        return [reports[fingerprint] for fingerprint in fingerprints]
+
+
+class AlertState(models.Model):
+    """Notification state of an issue type for an URL and ASN, linking monitor runs
+    so ongoing issues are not notified again on every run
+    """
+
+    issue_type = models.TextField(verbose_name="Anomaly type")
+
+    # When this issue was first seen, or seen again after it was resolved
+    opened_at = models.DateTimeField(null=False)
+
+    # Last run where this issue was found
+    last_seen_at = models.DateTimeField(null=False)
+
+    # Last time this issue was notified, and its peak anomaly ratio back then. Null if never notified
+    last_notified_at = models.DateTimeField(null=True, default=None)
+    notified_peak_ratio = models.FloatField(default=0)
+
+    asn = models.ForeignKey(to=ASN, null=False, on_delete=models.CASCADE)
+
+    url = models.ForeignKey(to=Url, null=False, on_delete=models.CASCADE)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["url", "asn", "issue_type"], name="unique_alert_state_url_asn_issue_type"
+            ),
+        ]
+
+    def __repr__(self) -> str:
+        return f"AlertState(issue_type={self.issue_type}, opened_at={self.opened_at}, last_seen_at={self.last_seen_at}, last_notified_at={self.last_notified_at}, asn={self.asn}, url={self.url})"
+
+    def __str__(self) -> str:
+        return self.__repr__()
+
+
+class SyncCursor(models.Model):
+    """High-water mark for ooni data synchronization. Stores the last hour whose
+    measurements were fully ingested for a country, so the next sync only has to
+    request data from there on
+    """
+
+    # Country code of synced measurements, for example: VE
+    country_code = models.TextField(unique=True, max_length=10, null=False)
+
+    # Last hour whose metrics are already stored. Null if never synced
+    last_hour = models.DateTimeField(null=True, default=None)
+
+    def __repr__(self) -> str:
+        return f"SyncCursor(country_code={self.country_code}, last_hour={self.last_hour})"
+
+    def __str__(self) -> str:
+        return self.__repr__()
+
+
+class BackfillUnit(models.Model):
+    """A single day of historical ooni data to be synced by a backfill. Completed
+    units are never processed again, so an interrupted backfill can be resumed
+    """
+
+    class Status(models.TextChoices):
+        PENDING = "pending"
+        RUNNING = "running"
+        DONE = "done"
+        FAILED = "failed"
 
-        report, _ = qs.get_or_create(defaults={
-            "asn" : issue_description.asn,
-            "url" : issue_description.url,
-            "issue_type" : issue_description.issue_type.value,
-        })
+    # Country code of synced measurements, for example: VE
+    country_code = models.TextField(max_length=10, null=False)
 
-        report.metrics.set(issue_description.metrics)
+    # Day to sync, from 00:00 to 24:00 UTC
+    day = models.DateField(null=False)
 
-        return report
+    status = models.TextField(choices=Status.choices, default=Status.PENDING)
+
+    # When this unit was last taken by a worker. Null if never run
+    started_at = models.DateTimeField(null=True, default=None)
+
+    # When this unit was completed. Null if not done yet
+    completed_at = models.DateTimeField(null=True, default=None)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["country_code", "day"], name="unique_backfill_country_day"
+            ),
+        ]
+
+    def __repr__(self) -> str:
+        return f"BackfillUnit(country_code={self.country_code}, day={self.day}, status={self.status})"
+
+    def __str__(self) -> str:
+        return self.__repr__()
+
+
+class Notification(models.Model):
+    """An outbound alert waiting to be delivered through a notification channel.
+    The monitor only stores them, and they're delivered later by a separate worker pool
+    """
+
+    class Status(models.TextChoices):
+        PENDING = "pending"
+        SENDING = "sending"
+        SENT = "sent"
+        FAILED = "failed"
+
+        # Not queued because there were too many pending notifications for its channel
+        DROPPED = "dropped"
+
+    # Name of the channel to deliver this notification with, for example: smtp
+    channel = models.TextField(null=False)
+
+    title = models.TextField(null=False)
+    message = models.TextField(null=False)
+
+    # Serialized issues in this notification, for channels that send structured data
+    payload = models.JSONField(default=list)
+
+    status = models.TextField(choices=Status.choices, default=Status.PENDING)
+
+    # Failed deliveries so far, and when to try again
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(null=True, default=None)
+    last_error = models.TextField(null=True, default=None)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    # When a worker took this notification to deliver it
+    claimed_at = models.DateTimeField(null=True, default=None)
+
+    sent_at = models.DateTimeField(null=True, default=None)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["channel", "status", "next_attempt_at"],
+                name="notification_channel_idx",
+            ),
+        ]
+
+    def __repr__(self) -> str:
+        return f"Notification(channel={self.channel}, title={self.title}, status={self.status}, attempts={self.attempts})"
+
+    def __str__(self) -> str:
+        return self.__repr__()
+
+
+class NotificationChannelLease(models.Model):
+    """Delivery state of a notification channel shared by every worker, so a single
+    dispatcher delivers its notifications at a time, and a single delivery run
+    is scheduled for it
+    """
+
+    # Name of the channel, like in notifications
+    channel = models.TextField(null=False, unique=True)
+
+    # The dispatcher holding this token delivers for the channel until it's done, or until this time
+    leased_until = models.DateTimeField(null=True, default=None)
+    lease_token = models.TextField(null=True, default=None)
+
+    # When the next delivery run for this channel will start, and its token. Null if there's none
+    scheduled_at = models.DateTimeField(null=True, default=None)
+    scheduled_token = models.TextField(null=True, default=None)
+
+    def __repr__(self) -> str:
+        return f"NotificationChannelLease(channel={self.channel}, leased_until={self.leased_until}, scheduled_at={self.scheduled_at})"
+
+    def __str__(self) -> str:
+        return self.__repr__()
 
 
 class EarlyWarningSettings(models.Model):
@@ -6,9 +6,147 @@ import os
 # How many hours do we store
 NUMBER_OF_HOURS = 24
 
+# How many hours before the last synced hour are requested again on each sync,
+# so measurements uploaded late by probes are still counted
+SYNC_OVERLAP_HOURS = 2
+
+# How many metrics are written to the database in each bulk upsert
+METRIC_WRITE_CHUNK_SIZE = 1000
+
+# Time span of every metric partition when the metric table is partitioned (PostgreSQL only),
+# can be "day" or "month"
+METRIC_PARTITION_GRANULARITY = "day"
+
+# How many partitions after the current one should always exist
+METRIC_PARTITIONS_AHEAD = 3
+
+# How many expired metrics are deleted at once when they can't be dropped with their partition
+METRIC_RETENTION_BATCH_SIZE = 10000
+
 # ooni endpoit to request data from
 OONI_ENDPOINT = "https://api.ooni.io/api/v1/measurements"
 
+# How many time windows are requested to ooni at the same time
+OONI_FETCH_CONCURRENCY = int(os.environ.get("BLOCKING_EARLY_WARNING_FETCH_CONCURRENCY", 4))
+
+# How many hours are requested by each of those windows
+OONI_FETCH_WINDOW_HOURS = 3
+
+# Max pages fetched ahead by every window while an earlier window is being consumed
+OONI_FETCH_BUFFERED_PAGES = 4
+
+# How many measurements are requested in the first page of each window. Later
+# pages are resized depending on how long they take and how big they are
+OONI_PAGE_SIZE = 5000
+
+# Bounds and targets for page size adaptation
+OONI_MIN_PAGE_SIZE = 500
+OONI_MAX_PAGE_SIZE = 20000
+OONI_TARGET_PAGE_SECONDS = 5.0
+OONI_MAX_PAGE_BYTES = 20 * 1024 * 1024
+
+# Max amount of requests per second to ooni, and how many can be performed in a burst
+OONI_REQUESTS_PER_SECOND = 5.0
+OONI_REQUESTS_BURST = 10
+
+# How many times a failed request is retried, with exponential backoff and jitter
+OONI_MAX_RETRIES = 5
+OONI_BACKOFF_SECONDS = 1.0
+OONI_MAX_BACKOFF_SECONDS = 60.0
+
+# Request measurements for each watched asn separately instead of every measurement
+# in the country, so only data for watched pairs is downloaded
+OONI_SHARDED_QUERIES = True
+
+# When sharding, also filter by input if there are at most this many watched urls.
+# Every url multiplies the number of requests, so it's only useful for short lists
+OONI_INPUT_FILTER_MAX_URLS = 5
+
+# Fold ooni pages into hourly counters as soon as they arrive instead of
+# keeping every raw measurement in memory until the sync finishes
+STREAMING_INGESTION = True
+
+# ooni endpoint to request data already aggregated by hour, asn and input from
+OONI_AGGREGATION_ENDPOINT = "https://api.ooni.io/api/v1/aggregation"
+
+# How to get hourly counts from ooni. One of:
+#   - measurements : download every raw measurement and count them locally
+#   - aggregation  : request counts already aggregated by the ooni aggregation api
+INGESTION_STRATEGY = os.environ.get(
+    "BLOCKING_EARLY_WARNING_INGESTION_STRATEGY", "measurements"
+)
+
+# Directory where raw ooni measurements are archived so metrics can be rebuilt
+# later without requesting them again. Archiving is disabled if not set
+MEASUREMENT_ARCHIVE_DIR = os.environ.get("BLOCKING_EARLY_WARNING_ARCHIVE_DIR")
+
+# Backfill units running for longer than this many seconds are considered abandoned, so
+# they're planned and run again. Should be longer than the backfill task time limit
+BACKFILL_STALE_SECONDS = 2 * 3600
+
+# How many metric rows the anomaly monitor fetches from the database cursor at once
+MONITOR_READ_CHUNK_SIZE = 5000
+
+# Detect anomalies for many (asn, url) pairs at once using numpy matrices instead
+# of one pair at a time, and about how many metrics are loaded in every matrix
+MONITOR_BATCH_DETECTION = True
+MONITOR_BATCH_ROWS = 200000
+
+# Detectors run by the anomaly monitor, by priority: every (asn, url) pair gets the issue type
+# of the first detector that flags it. Only used with batch detection, see utils/detectors.py
+# for available detectors: high_anomaly_rate, spike, ewma, robust_outlier, cusum, seasonal
+MONITOR_DETECTORS = ["high_anomaly_rate", "spike"]
+
+# Parameters for every detector, by detector name. For example: {"ewma": {"alpha": 0.2}}
+MONITOR_DETECTOR_OPTIONS = {}
+
+# Split the monitor run in shards of about this many urls (by id), each one analized by its
+# own celery task, and merge their results in a single callback that reports and notifies
+MONITOR_SHARDED = True
+MONITOR_SHARD_SIZE = 5000
+
+# Max number of shards in a run, so at most this many shard tasks run in parallel.
+# Shards grow beyond MONITOR_SHARD_SIZE if needed
+MONITOR_PARALLELISM = 8
+
+# Detect anomalies on aggregated series per asn and per url list first, and only check the
+# (asn, url) pairs under aggregates that look suspicious. Urls with alert level ALERT are
+# always fully checked. Anomalies hidden in aggregates that look fine might be missed
+MONITOR_HIERARCHICAL = False
+
+# Aggregates whose hourly anomaly ratio has a standard deviation above this are also
+# checked pair by pair, even if no detector flags them
+MONITOR_DRILLDOWN_STD = 0.05
+
+# Keep daily and weekly metric rollups up to date after every sync
+UPDATE_METRIC_ROLLUPS = True
+
+# Also store synced metrics as packed daily series (one row per url, asn and day instead
+# of one per hour), and read hourly histograms and monitor runs from them. Hourly metrics
+# are still stored, as the sync writes them and anomaly reports link to them, but old ones
+# are pruned by the metric storage maintenance, see METRIC_SERIES_HOURLY_DAYS
+METRIC_SERIES_STORAGE = False
+
+# With series storage, hourly metrics older than this many days are pruned once their day is
+# stored as a series, except the ones linked to anomaly reports. Should be longer than any
+# interval synced again later, since days are packed again from their hourly metrics. Running
+# statistics rebuilds only see the hourly metrics left. Never pruned if None
+METRIC_SERIES_HOURLY_DAYS = 7
+
+# Update running anomaly ratio statistics for every (url, asn) after every sync
+UPDATE_RUNNING_STATISTICS = True
+
+# Weight of every new hour in the running statistics. 2 / (N + 1) weights about
+# as much history as an N hours moving average
+RUNNING_STATISTICS_ALPHA = 2 / (24 + 1)
+
+# Hours folded in the running statistics of a pair before new hours are tested for spikes
+RUNNING_STATISTICS_MIN_HOURS = 24
+
+# Max number of blocks in a histogram when the "auto" resolution is requested. The finest
+# resolution (hour, day or week) that fits the requested interval is used
+HISTOGRAM_MAX_BLOCKS = 200
+
 # Date format
 DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
 
@@ -24,3 +162,76 @@ MAIL_TO_NOTIFY = os.environ.get("BLOCKING_EARLY_WARNING_NOTIFY_MAIL")
 SENDER_MAIL = os.environ.get("BLOCKING_EARLY_WARNING_SENDER_MAIL")
 
 SENDER_MAIL_PSWD = os.environ.get("BLOCKING_EARLY_WARNING_SENDER_MAIL_PSWD")
+
+# SMTP server used to send alerts. Every monitor run sends all of its alerts over a single
+# connection. A local debugging server can be used instead for tests, for example:
+#   python -m aiosmtpd -n -l localhost:1025
+# with host "localhost", port 1025, no ssl and no password
+SMTP_HOST = os.environ.get("BLOCKING_EARLY_WARNING_SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.environ.get("BLOCKING_EARLY_WARNING_SMTP_PORT", 465))
+SMTP_USE_SSL = os.environ.get("BLOCKING_EARLY_WARNING_SMTP_USE_SSL", "true").lower() == "true"
+
+# Upgrade plain connections with STARTTLS, only used if SMTP_USE_SSL is false
+SMTP_STARTTLS = os.environ.get("BLOCKING_EARLY_WARNING_SMTP_STARTTLS", "false").lower() == "true"
+
+# Seconds to wait for the SMTP server
+SMTP_TIMEOUT = 30
+
+# How alerts found in a monitor run are grouped in digest mails. One of:
+#   - asn      : a digest for every asn
+#   - url_list : a digest for every url list. Urls in many lists are in each of their digests
+#   - severity : a digest for every severity level of the issue types
+#   - none     : a mail for every issue
+ALERT_DIGEST_GROUPING = os.environ.get("BLOCKING_EARLY_WARNING_ALERT_DIGEST_GROUPING", "asn")
+
+# Keep alert state between monitor runs, so only new or escalated issues are notified
+ALERT_SUPPRESSION = True
+
+# Don't notify an issue type for the same url and asn again until this many hours after
+# it was last notified, unless it escalates
+ALERT_COOLDOWN_HOURS = 24
+
+# An ongoing issue escalates, and is notified again, if its peak anomaly ratio is this
+# much higher than when it was last notified. For example, 0.5 means 50% higher
+ALERT_ESCALATION_RATIO = 0.5
+
+# An issue not found for this many hours is resolved, so it's notified as new if it comes back
+ALERT_RESOLVE_HOURS = 6
+
+# Queue alerts found by the monitor and deliver them in a separate task, so slow or failing
+# channels don't stall the monitor. Alerts are sent by the monitor itself otherwise
+NOTIFICATION_QUEUE = True
+
+# Channels to deliver queued alerts with, by name, and their options:
+#   - concurrency : workers delivering notifications for this channel at the same time
+#   - max_retries : failed deliveries before giving up on a notification
+#   - backoff_seconds, max_backoff_seconds : exponential backoff between retries
+#   - max_pending : max notifications waiting for this channel, new ones are dropped beyond it
+#   - batch_size : max notifications taken by every delivery run
+# Other options depend on the channel, the webhook channel needs an "url"
+NOTIFICATION_CHANNELS = {
+    "smtp": {
+        "concurrency": 1,
+        "max_retries": 5,
+        "backoff_seconds": 30.0,
+        "max_backoff_seconds": 3600.0,
+        "max_pending": 1000,
+        "batch_size": 100,
+    },
+}
+
+# Also post alerts as json to this url if set
+NOTIFICATION_WEBHOOK_URL = os.environ.get("BLOCKING_EARLY_WARNING_WEBHOOK_URL")
+if NOTIFICATION_WEBHOOK_URL:
+    NOTIFICATION_CHANNELS["webhook"] = {
+        "url": NOTIFICATION_WEBHOOK_URL,
+        "concurrency": 4,
+        "max_retries": 8,
+        "backoff_seconds": 10.0,
+        "max_backoff_seconds": 1800.0,
+        "max_pending": 5000,
+        "batch_size": 200,
+    }
+
+# Notifications taken by a delivery worker that didn't finish after this many seconds can be taken again
+NOTIFICATION_CLAIM_TIMEOUT_SECONDS = 600
@@ -1,7 +1,19 @@
-from celery import shared_task
+from celery import chord, group, shared_task
+from datetime import date, datetime
+from django.utils import timezone
+from typing import Optional
 import blocking_early_warnings.utils.ooni_requests as ooni_requests
 import blocking_early_warnings.utils.list_loaders as list_loaders
 import blocking_early_warnings.utils.anomaly_monitor as anomaly_monitor
+import blocking_early_warnings.utils.backfill as backfill
+import blocking_early_warnings.utils.metric_series as metric_series
+import blocking_early_warnings.utils.metric_storage as metric_storage
+import blocking_early_warnings.utils.notifications as notifications
+from blocking_early_warnings.settings import (
+    METRIC_SERIES_STORAGE,
+    MONITOR_SHARDED,
+    NOTIFICATION_QUEUE,
+)
 
 
 @shared_task(time_limit=3600, name="blocking_early_warnings.synch_metrics")
@@ -9,10 +21,18 @@ def synch_db_metrics():
     """
     Asynch process to get raw data from ooni.
     Will update database so metrics object are up to date
-    with current hour and online ooni data
+    with current hour and online ooni data. Spikes found in new hours
+    by the running statistics are reported and notified right away, like
+    the monitor's issues. They share the monitor's alert state, so the
+    monitor doesn't notify them again while they're ongoing
     """
     client = ooni_requests.DBMetricsClient()
-    client.sync_db_metrics()
+    spikes = client.sync_db_metrics()
+
+    monitor = anomaly_monitor.AnomalyMonitor()
+    monitor.handle_issues(spikes, should_act=True, should_report=True)
+    if spikes:
+        _start_notification_delivery()
 
 
 @shared_task(time_limit=3600, name="blocking_early_warnings.synch_urls")
@@ -26,6 +46,115 @@ def synch_urls():
 
 @shared_task(time_limit=3600, name="blocking_early_warnings.monitor_anomalies")
 def monitor_anomalies():
-    """Asynch process to check for anomalies in the database and notify as specified"""
+    """Asynch process to check for anomalies in the database and notify as specified.
+    If sharded, every shard of urls is analized by its own task, and their issues
+    are reported and notified once all of them are done"""
+    monitor = anomaly_monitor.AnomalyMonitor()
+    if not MONITOR_SHARDED:
+        monitor.analize_db_metrics(should_act=True, should_report=True)
+        _start_notification_delivery()
+        return
+
+    shards = monitor.plan_shards()
+    if not shards:
+        return
+
+    # Every shard analizes the same time window, even if they start at different times
+    (start_time, end_time) = monitor.get_time_window()
+    chord(
+        monitor_shard.s(start_time.isoformat(), end_time.isoformat(), first, last)
+        for (first, last) in shards
+    )(merge_monitor_shards.s())
+
+
+@shared_task(time_limit=3600, name="blocking_early_warnings.monitor_shard")
+def monitor_shard(start_time: str, end_time: str, first_url_id: int, last_url_id: int):
+    """Asynch process to check for anomalies for urls with ids from 'first_url_id' to 'last_url_id'.
+    Returns serialized issues, nothing is reported or notified here"""
     monitor = anomaly_monitor.AnomalyMonitor()
-    monitor.analize_db_metrics(should_act=True)
+    issues = monitor.analize_shard(
+        start_time=datetime.fromisoformat(start_time),
+        end_time=datetime.fromisoformat(end_time),
+        url_range=(first_url_id, last_url_id),
+    )
+
+    return [issue.to_dict() for issue in issues]
+
+
+@shared_task(time_limit=3600, name="blocking_early_warnings.merge_monitor_shards")
+def merge_monitor_shards(shard_results: list):
+    """Asynch process to report and notify issues found by every shard of a monitor run"""
+    issues = anomaly_monitor.IssueDescription.from_dicts(
+        issue for shard in shard_results for issue in shard
+    )
+
+    monitor = anomaly_monitor.AnomalyMonitor()
+    monitor.handle_issues(issues, should_act=True, should_report=True)
+    _start_notification_delivery()
+
+
+@shared_task(time_limit=3600, name="blocking_early_warnings.deliver_notifications")
+def deliver_notifications(channel: Optional[str] = None, run: Optional[str] = None):
+    """Asynch process to deliver queued notifications of a channel. Every channel has a single
+    chain of runs: each run schedules the next one when its next pending notification is due,
+    like failed ones waiting to be retried, unless there's already an earlier run scheduled.
+    Without a channel, a run is started right away for every channel"""
+    dispatcher = notifications.NotificationDispatcher()
+    if channel is None:
+        for name in dispatcher.channels:
+            _schedule_notification_delivery(dispatcher, name, timezone.now())
+        return
+
+    # Replaced by an earlier run, or the channel is not configured anymore
+    if not dispatcher.start_run(channel, run) or channel not in dispatcher.channels:
+        return
+
+    dispatcher.deliver_channel(channel, dispatcher.channels[channel])
+
+    next_run = dispatcher.next_run(channel)
+    if next_run is not None:
+        _schedule_notification_delivery(dispatcher, channel, next_run)
+
+
+def _schedule_notification_delivery(
+    dispatcher: notifications.NotificationDispatcher, channel: str, at: datetime
+):
+    """Schedule a delivery run for a channel, unless an earlier one is already scheduled"""
+    run = dispatcher.schedule(channel, at)
+    if run is not None:
+        deliver_notifications.apply_async(args=[channel, run], eta=at)
+
+
+def _start_notification_delivery():
+    """Deliver queued notifications in their own task, so the monitor doesn't wait for them"""
+    if NOTIFICATION_QUEUE:
+        deliver_notifications.delay()
+
+
+@shared_task(time_limit=3600, name="blocking_early_warnings.backfill_metrics")
+def backfill_metrics(since: str, until: str):
+    """Asynch process to plan a backfill from 'since' to 'until' (both as YYYY-MM-DD)
+    and dispatch every pending day to its own task"""
+    backfiller = backfill.Backfiller()
+    units = backfiller.plan(date.fromisoformat(since), date.fromisoformat(until))
+
+    group(backfill_day.s(unit.id) for unit in units).apply_async()
+
+
+@shared_task(time_limit=3600, acks_late=True, name="blocking_early_warnings.backfill_day")
+def backfill_day(unit_id: int):
+    """Asynch process to sync metrics for a single backfill unit"""
+    backfiller = backfill.Backfiller()
+    backfiller.run_unit(unit_id)
+
+
+@shared_task(time_limit=3600, name="blocking_early_warnings.maintain_metric_storage")
+def maintain_metric_storage():
+    """Asynch process to create upcoming metric partitions and remove expired metrics.
+    Hourly metrics already stored as series are pruned too, if series are stored"""
+    manager = metric_storage.MetricStorageManager()
+    manager.create_future_partitions()
+    manager.apply_retention()
+
+    if METRIC_SERIES_STORAGE:
+        metric_series.MetricSeriesStore().prune_metrics()
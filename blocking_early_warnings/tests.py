@@ -1,3 +1,1671 @@
-from django.test import TestCase
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
-# Create your tests here.
+# Local imports
+from blocking_early_warnings.models import (
+    ASN,
+    BackfillUnit,
+    EarlyWarningSettings,
+    Metric,
+    MetricRollup,
+    MetricStatistics,
+    Notification,
+    AlertState,
+    AnomalyReport,
+    Url,
+    UrlList,
+)
+from blocking_early_warnings.utils.anomaly_monitor import (
+    AnomalyMonitor,
+    BatchAnomalyDetector,
+    IssueDescription,
+    IssueType,
+    MetricRow,
+)
+from blocking_early_warnings.utils.alert_state import AlertStateCache
+from blocking_early_warnings.utils.backfill import Backfiller
+from blocking_early_warnings.utils.detectors import (
+    DETECTORS,
+    HOURS_PER_WEEK,
+    ISSUE_TYPES,
+    Detector,
+    SeriesBatch,
+    create_detector,
+    register_detector,
+)
+from blocking_early_warnings.utils.histogram_generator import HistogramGenerator
+from blocking_early_warnings.utils.mailer import SmtpMailer
+from blocking_early_warnings.utils.measurement_archive import MeasurementArchive
+from blocking_early_warnings.utils.metric_series import MetricSeriesStore
+from blocking_early_warnings.utils.metric_storage import MetricStorageManager
+from blocking_early_warnings.utils.notifications import (
+    NotificationChannel,
+    NotificationDispatcher,
+    WebhookChannel,
+)
+from blocking_early_warnings.utils.ooni_requests import DBMetricsClient
+from blocking_early_warnings.utils.ooni_fetcher import (
+    AdaptivePageSize,
+    OoniFetcher,
+    TokenBucket,
+)
+from blocking_early_warnings.utils.rollups import RollupManager
+from blocking_early_warnings.utils.running_statistics import (
+    RunningStatisticsManager,
+)
+
+# Python imports
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from email import message_from_bytes
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pytz import utc
+from requests.exceptions import HTTPError
+from typing import Any, Callable, Dict, List, Tuple
+from unittest import skipUnless
+from urllib.parse import parse_qsl, urlencode, urlsplit
+import json
+import os
+import random
+import socketserver
+import tempfile
+import threading
+import time
+
+
+class BatchAnomalyDetectorTest(SimpleTestCase):
+    """The batch detector should find exactly the same issues as the scalar path"""
+
+    def _random_pairs(self, rng: random.Random, n_pairs: int, n_hours: int):
+        start = datetime(2022, 1, 1, tzinfo=utc)
+        asns = [ASN(id=i, code=f"AS{i}") for i in range(4)]
+
+        pairs = []
+        metric_id = 0
+        for i in range(n_pairs):
+            metrics = []
+            for h in range(n_hours):
+                # Missing hours, and hours without measurements
+                if rng.random() < 0.2:
+                    continue
+
+                measurement_count = rng.choice([0, 1, 2, 5, 10, rng.randint(1, 500)])
+                anomaly_count = rng.randint(0, measurement_count)
+                if rng.random() < 0.7:
+                    anomaly_count = min(anomaly_count, rng.choice([0, 0, 1]))
+
+                metric_id += 1
+                metrics.append(
+                    MetricRow(
+                        id=metric_id,
+                        hour=start + timedelta(hours=h),
+                        anomaly_count=anomaly_count,
+                        measurement_count=measurement_count,
+                    )
+                )
+
+            pairs.append(
+                ((asns[i % len(asns)], Url(id=i, url=f"http://{i}.com")), metrics)
+            )
+
+        return pairs
+
+    def test_same_issues_as_scalar_path(self):
+        rng = random.Random(42)
+        monitor = AnomalyMonitor()
+
+        for tolerance in (0.0, 0.1, 0.5):
+            pairs = self._random_pairs(rng, n_pairs=300, n_hours=48)
+
+            expected = [
+                monitor.compute_anomaly(
+                    metrics=metrics, spike_tolerance=tolerance, asn=asn, url=url
+                )
+                for ((asn, url), metrics) in pairs
+            ]
+            got = BatchAnomalyDetector(spike_tolerance=tolerance).detect(pairs)
+
+            self.assertEqual(len(expected), len(got))
+            for (e, g) in zip(expected, got):
+                self.assertEqual(e.issue_type, g.issue_type)
+                self.assertEqual(e.asn, g.asn)
+                self.assertEqual(e.url, g.url)
+                self.assertEqual(e.metrics, g.metrics)
+
+    def test_no_pairs(self):
+        self.assertEqual(BatchAnomalyDetector(spike_tolerance=0.1).detect([]), [])
+
+    def test_pairs_without_measurements(self):
+        asn, url = ASN(id=1, code="AS1"), Url(id=1, url="http://a.com")
+        hour = datetime(2022, 1, 1, tzinfo=utc)
+        pairs = [
+            ((asn, url), []),
+            (
+                (asn, url),
+                [MetricRow(id=1, hour=hour, anomaly_count=0, measurement_count=0)],
+            ),
+        ]
+
+        issues = BatchAnomalyDetector(spike_tolerance=0.1).detect(pairs)
+        self.assertEqual([i.issue_type.value for i in issues], ["ok", "ok"])
+
+
+class DetectorsTest(SimpleTestCase):
+    """Every detector should flag obvious anomalies, and nothing in a steady series"""
+
+    HOURS = 3 * 7 * 24
+
+    def _detect(self, name: str, ratios_by_pair):
+        detector = BatchAnomalyDetector(
+            spike_tolerance=0.1, detectors=[create_detector(name)]
+        )
+        asn = ASN(id=1, code="AS1")
+        start = datetime(2022, 1, 3, tzinfo=utc)
+
+        pairs = [
+            (
+                (asn, Url(id=i, url=f"http://{i}.com")),
+                [
+                    MetricRow(
+                        id=h,
+                        hour=start + timedelta(hours=h),
+                        anomaly_count=round(r * 100),
+                        measurement_count=100,
+                    )
+                    for (h, r) in enumerate(ratios)
+                ],
+            )
+            for (i, ratios) in enumerate(ratios_by_pair)
+        ]
+        return detector.detect(pairs)
+
+    def test_steady_series(self):
+        steady = [0.02] * self.HOURS
+        for name in DETECTORS:
+            with self.subTest(detector=name):
+                self.assertEqual(
+                    self._detect(name, [steady])[0].issue_type, IssueType.OK
+                )
+
+    def test_outliers(self):
+        outlier = [0.02] * self.HOURS
+        outlier[-5] = 0.6
+        for name in ("spike", "ewma", "robust_outlier", "seasonal"):
+            with self.subTest(detector=name):
+                (issue,) = self._detect(name, [outlier])
+                self.assertEqual(issue.issue_type.value, DETECTORS[name].issue_type)
+                self.assertEqual([m.id for m in issue.metrics], [self.HOURS - 5])
+
+    def test_level_shift(self):
+        shifted = [0.02] * (self.HOURS - 12) + [0.15] * 12
+        (issue,) = self._detect("cusum", [shifted])
+        self.assertEqual(issue.issue_type, IssueType.LEVEL_SHIFT)
+        self.assertTrue(all(m.id >= self.HOURS - 12 for m in issue.metrics))
+
+    def test_registered_descriptions(self):
+        for detector in DETECTORS.values():
+            issue_type = IssueType(detector.issue_type)
+            self.assertEqual(issue_type.description, detector.description)
+            self.assertEqual(issue_type.human_readable, detector.human_readable)
+
+    def test_unknown_detector(self):
+        with self.assertRaises(ValueError):
+            create_detector("unknown")
+
+
+class DrilldownTest(SimpleTestCase):
+    """Only suspicious or volatile aggregates should be drilled down"""
+
+    def test_flag_aggregates(self):
+        monitor = AnomalyMonitor(drilldown_std=0.05)
+        detector = BatchAnomalyDetector(spike_tolerance=0.1)
+        start = datetime(2022, 1, 3, tzinfo=utc)
+
+        series = {
+            1: [2] * 24,  # steady
+            2: [2] * 20 + [60] * 4,  # blocked in the last hours
+            3: [2, 22] * 12,  # volatile, but no detector flags it
+        }
+        rows = [
+            (key, start + timedelta(hours=h), anomalies, 100)
+            for (key, counts) in series.items()
+            for (h, anomalies) in enumerate(counts)
+        ]
+
+        self.assertEqual(monitor._flag_aggregates(detector, rows), [2, 3])
+        self.assertEqual(monitor._flag_aggregates(detector, []), [])
+
+
+class AlertStateCacheTest(SimpleTestCase):
+    """Ongoing issues should only be notified again after the cooldown or if they escalate"""
+
+    def test_suppression(self):
+        cache = AlertStateCache(
+            cooldown_hours=24, escalation_ratio=0.5, resolve_hours=6
+        )
+        cache.warm([], states=[])
+
+        def notify(hours: int, ratio: float) -> bool:
+            now = datetime(2022, 1, 1, tzinfo=utc) + timedelta(hours=hours)
+            return cache.should_notify(1, 1, "high_anomaly_rate", ratio, now)
+
+        self.assertTrue(notify(0, 0.3))  # new
+        self.assertFalse(notify(1, 0.3))  # ongoing
+        self.assertFalse(notify(2, 0.4))  # not enough to escalate
+        self.assertTrue(notify(3, 0.5))  # escalated
+        self.assertFalse(notify(4, 0.5))
+        self.assertTrue(notify(27, 0.5))  # cooldown expired
+        self.assertTrue(notify(34, 0.5))  # resolved, then seen again
+
+        # Other issue types for the same pair have their own state
+        now = datetime(2022, 1, 2, 10, tzinfo=utc)
+        self.assertTrue(cache.should_notify(1, 1, "spike", 0.5, now))
+
+
+class AlertStateStoreTest(TestCase):
+    """Stored alert states should be found however old they are, and saved by concurrent runs"""
+
+    def setUp(self):
+        self.asn = ASN.objects.create(code="AS1")
+        self.url = Url.objects.create(
+            url="http://a.com", alert_level=Url.AlertCategory.ALERT
+        )
+        self.now = datetime.now(tz=utc).replace(minute=0, second=0, microsecond=0)
+        self.metric = Metric.objects.create(
+            asn=self.asn,
+            url=self.url,
+            hour=self.now - timedelta(hours=1),
+            anomaly_count=5,
+            measurement_count=10,
+        )
+
+    def _issue(self) -> IssueDescription:
+        return IssueDescription(
+            asn=self.asn,
+            metrics=[MetricRow(self.metric.id, self.metric.hour, 5, 10)],
+            url=self.url,
+            issue_type=IssueType.SPIKE,
+        )
+
+    def test_issue_back_after_long_gap(self):
+        last_seen = self.now - timedelta(hours=30)
+        AlertState.objects.create(
+            url=self.url,
+            asn=self.asn,
+            issue_type="spike",
+            opened_at=last_seen,
+            last_seen_at=last_seen,
+            last_notified_at=last_seen,
+            notified_peak_ratio=0.5,
+        )
+
+        monitor = AnomalyMonitor(notification_queue=True, alert_suppression=True)
+        monitor.handle_issues([self._issue()], should_act=True, should_report=True)
+
+        self.assertEqual(AnomalyReport.objects.count(), 1)
+        self.assertGreater(Notification.objects.count(), 0)
+        state = AlertState.objects.get()
+        self.assertGreater(state.opened_at, last_seen)
+        self.assertEqual(state.last_seen_at, state.last_notified_at)
+
+    def test_concurrent_runs(self):
+        caches = [AlertStateCache() for _ in range(2)]
+        key = (self.url.id, self.asn.id, "spike")
+        for cache in caches:
+            cache.warm([key])
+        for cache in caches:
+            self.assertTrue(cache.should_notify(*key, 0.5, self.now))
+            self.assertEqual(cache.save(), 1)
+
+        self.assertEqual(AlertState.objects.count(), 1)
+
+
+class _DebugSmtpHandler(socketserver.StreamRequestHandler):
+    """Minimal SMTP server that keeps every received mail, like a local debugging server"""
+
+    def _reply(self, line: str):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        self.server.connections += 1
+        self._reply("220 localhost")
+        for line in self.rfile:
+            command = line.decode().strip().upper()
+            if command == "DATA":
+                self._reply("354 End data with <CR><LF>.<CR><LF>")
+                data = b"".join(iter(self.rfile.readline, b".\r\n"))
+                self.server.mails.append(message_from_bytes(data))
+                self._reply("250 OK")
+            elif command == "QUIT":
+                self._reply("221 Bye")
+                return
+            else:
+                self._reply("250 OK")
+
+
+class AlertDigestTest(SimpleTestCase):
+    """Alerts from a run should be sent as digests over a single SMTP connection"""
+
+    def setUp(self):
+        self.server = socketserver.ThreadingTCPServer(
+            ("localhost", 0), _DebugSmtpHandler
+        )
+        self.server.connections = 0
+        self.server.mails = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _monitor(self, grouping: str) -> AnomalyMonitor:
+        mailer = SmtpMailer(
+            host="localhost",
+            port=self.server.server_address[1],
+            use_ssl=False,
+            sender="monitor@localhost",
+            password=None,
+            recipient="alerts@localhost",
+        )
+        return AnomalyMonitor(digest_grouping=grouping, mailer=mailer)
+
+    def _issues(self):
+        hour = datetime(2022, 1, 1, tzinfo=utc)
+        metrics = [MetricRow(id=1, hour=hour, anomaly_count=5, measurement_count=10)]
+        asns = [ASN(id=1, code="AS1"), ASN(id=2, code="AS2")]
+        alert = Url(id=1, url="http://a.com", alert_level=Url.AlertCategory.ALERT)
+        muted = Url(id=2, url="http://b.com", alert_level=Url.AlertCategory.MUTED)
+
+        return [
+            IssueDescription(asns[0], metrics, alert, IssueType.SPIKE),
+            IssueDescription(asns[1], metrics, alert, IssueType.HIGH_ANOMALY_RATE),
+            IssueDescription(asns[1], metrics, alert, IssueType.SPIKE),
+            IssueDescription(asns[0], metrics, muted, IssueType.SPIKE),
+            IssueDescription(asns[0], [], alert, IssueType.OK),
+        ]
+
+    def test_digests_by_asn(self):
+        self.assertEqual(self._monitor("asn").dispatch_alerts(self._issues()), 2)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(
+            sorted(m["Subject"] for m in self.server.mails),
+            ["ALERT: 1 issue(s) for asn AS1", "ALERT: 2 issue(s) for asn AS2"],
+        )
+
+    def test_digests_by_severity(self):
+        self._monitor("severity").dispatch_alerts(self._issues())
+        self.assertEqual(
+            [m["Subject"] for m in self.server.mails],
+            [
+                "ALERT: 1 issue(s) for high severity issues",
+                "ALERT: 2 issue(s) for low severity issues",
+            ],
+        )
+
+    def test_mail_per_issue(self):
+        self.assertEqual(self._monitor("none").dispatch_alerts(self._issues()), 3)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_nothing_to_send(self):
+        self.assertEqual(self._monitor("asn").dispatch_alerts(self._issues()[3:]), 0)
+        self.assertEqual(self.server.connections, 0)
+
+
+# Answers a request to the local http server: (method, path, query, json body) -> (status, json body, headers)
+Responder = Callable[[str, str, Dict[str, str], Any], Tuple[int, Any, Dict[str, str]]]
+
+
+class _LocalHttpHandler(BaseHTTPRequestHandler):
+    """Json http handler answering with the responder of its server"""
+
+    def _answer(self, method: str):
+        parts = urlsplit(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+
+        with self.server.lock:
+            self.server.requests.append((method, self.path, body))
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(
+                self.server.max_in_flight, self.server.in_flight
+            )
+
+        try:
+            (status, content, headers) = self.server.respond(
+                method, parts.path, dict(parse_qsl(parts.query)), body
+            )
+        finally:
+            with self.server.lock:
+                self.server.in_flight -= 1
+
+        data = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._answer("GET")
+
+    def do_POST(self):
+        self._answer("POST")
+
+    def log_message(self, *args):
+        pass
+
+
+class _LocalHttpServer(ThreadingHTTPServer):
+    """Local stand-in for remote http apis, like ooni or a webhook. Keeps every request
+    and the max number of requests handled at the same time"""
+
+    def __init__(self, respond: Responder):
+        super().__init__(("localhost", 0), _LocalHttpHandler)
+        self.respond = respond
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return f"http://localhost:{self.server_address[1]}"
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class OoniFetcherTest(SimpleTestCase):
+    """Windows are fetched in parallel, but pages should come out in order as soon as they can"""
+
+    SINCE = datetime(2022, 1, 1, tzinfo=utc)
+    PAGES_PER_WINDOW = 3
+
+    def setUp(self):
+        self.delays = {}
+        self.failures = {}
+        self.held = None
+        self.release = threading.Event()
+        self.server = _LocalHttpServer(self._respond)
+
+    def tearDown(self):
+        self.release.set()
+        self.server.close()
+
+    def _respond(self, method, path, query, body):
+        window = query["since"]
+        page = int(query.get("page", 0))
+        time.sleep(self.delays.get(window, 0))
+
+        if self.failures.get((window, page), 0) > 0:
+            self.failures[(window, page)] -= 1
+            return (503, {}, {"Retry-After": "0"})
+
+        if page == self.PAGES_PER_WINDOW - 1 and window == self.held:
+            self.release.wait(5)
+
+        next_url = None
+        if page + 1 < self.PAGES_PER_WINDOW:
+            next_url = f"{self.server.url}/measurements?since={window}&page={page + 1}"
+
+        return (
+            200,
+            {"results": [f"{window}-{page}"], "metadata": {"next_url": next_url}},
+            {},
+        )
+
+    def _fetcher(self, concurrency: int = 4, **options) -> OoniFetcher:
+        return OoniFetcher(
+            concurrency=concurrency,
+            window_hours=1,
+            rate_limiter=TokenBucket(1000, 1000),
+            page_size=AdaptivePageSize(),
+            backoff_seconds=0.01,
+            max_backoff_seconds=0.01,
+            **options,
+        )
+
+    def _pages(self, fetcher: OoniFetcher, hours: int):
+        return list(
+            fetcher.iter_pages(
+                f"{self.server.url}/measurements",
+                {},
+                self.SINCE,
+                self.SINCE + timedelta(hours=hours),
+                date_format="%H",
+            )
+        )
+
+    def _expected(self, hours: int):
+        return [
+            [f"{hour:02}-{page}"]
+            for hour in range(hours)
+            for page in range(self.PAGES_PER_WINDOW)
+        ]
+
+    def test_pages_in_order(self):
+        # Earlier windows are slower, so later windows finish first
+        self.delays = {f"{hour:02}": 0.05 * (6 - hour) for hour in range(6)}
+        self.assertEqual(self._pages(self._fetcher(), 6), self._expected(6))
+
+    def test_concurrency_limit(self):
+        self.delays = {f"{hour:02}": 0.05 for hour in range(8)}
+        self.assertEqual(
+            self._pages(self._fetcher(concurrency=2), 8), self._expected(8)
+        )
+        self.assertEqual(self.server.max_in_flight, 2)
+
+    def test_pages_are_streamed(self):
+        # The last page of the first window is held until its first page was consumed
+        self.held = "00"
+        pages = self._fetcher().iter_pages(
+            f"{self.server.url}/measurements",
+            {},
+            self.SINCE,
+            self.SINCE + timedelta(hours=2),
+            date_format="%H",
+        )
+
+        start = time.monotonic()
+        self.assertEqual(next(pages), ["00-0"])
+        self.assertLess(time.monotonic() - start, 2)
+
+        self.release.set()
+        self.assertEqual(list(pages), self._expected(2)[1:])
+
+    def test_retry_with_backoff(self):
+        self.failures = {("00", 1): 2, ("01", 0): 1}
+        self.assertEqual(self._pages(self._fetcher(), 2), self._expected(2))
+        self.assertEqual(len(self.server.requests), 2 * self.PAGES_PER_WINDOW + 3)
+
+    def test_too_many_failures(self):
+        self.failures = {("01", 2): 3}
+        with self.assertRaises(HTTPError):
+            self._pages(self._fetcher(max_retries=2), 3)
+
+
+# Ooni api responses used by the ooni stand-in
+TEST_DATA_DIR = os.path.join(os.path.dirname(__file__), "test_data")
+
+
+class _OoniStandIn:
+    """Answers like the ooni measurements and aggregation apis, from fixture responses.
+    Measurements are filtered and paginated like ooni does, aggregations are answered
+    with the response stored for their asn"""
+
+    def __init__(self):
+        with open(os.path.join(TEST_DATA_DIR, "ooni_measurements.json")) as f:
+            self.measurements = json.load(f)
+        with open(os.path.join(TEST_DATA_DIR, "ooni_aggregation.json")) as f:
+            self.aggregations = json.load(f)
+
+        self.server = _LocalHttpServer(self.respond)
+
+    def respond(self, method, path, query, body):
+        if path == "/api/v1/aggregation":
+            return (200, self.aggregations[query["probe_asn"]], {})
+
+        filters = ("probe_cc", "probe_asn", "input")
+        results = [
+            m
+            for m in self.measurements
+            if all(m[f] == query[f] for f in filters if f in query)
+            and query["since"] <= m["measurement_start_time"] < query["until"]
+        ]
+
+        limit = int(query["limit"])
+        offset = int(query.get("offset", 0))
+        next_url = None
+        if offset + limit < len(results):
+            next_query = urlencode({**query, "offset": offset + limit})
+            next_url = f"{self.server.url}{path}?{next_query}"
+
+        return (
+            200,
+            {
+                "metadata": {
+                    "count": len(results),
+                    "limit": limit,
+                    "offset": offset,
+                    "next_url": next_url,
+                },
+                "results": results[offset : offset + limit],
+            },
+            {},
+        )
+
+
+class IngestionStrategyTest(TestCase):
+    """Every ingestion strategy should store exactly the same metrics for the same ooni data"""
+
+    SINCE = datetime(2022, 6, 1, 10, tzinfo=utc)
+    UNTIL = datetime(2022, 6, 1, 16, tzinfo=utc)
+
+    def setUp(self):
+        self.ooni = _OoniStandIn()
+        for code in ("AS8048", "AS21826"):
+            ASN.objects.create(code=code)
+        for url in (
+            "https://www.bbc.com/mundo",
+            "https://twitter.com/",
+            "https://www.instagram.com/",
+            "https://www.el-carabobeno.com/",
+        ):
+            Url.objects.create(url=url)
+
+    def tearDown(self):
+        self.ooni.server.close()
+
+    def _client(self, strategy: str, **options) -> DBMetricsClient:
+        return DBMetricsClient(
+            ooni_endpoint=f"{self.ooni.server.url}/api/v1/measurements",
+            ooni_aggregation_endpoint=f"{self.ooni.server.url}/api/v1/aggregation",
+            ingestion_strategy=strategy,
+            fetcher=OoniFetcher(
+                rate_limiter=TokenBucket(1000, 1000),
+                page_size=AdaptivePageSize(min_size=10, max_size=10),
+            ),
+            page_size=10,
+            archive_dir=None,
+            update_rollups=False,
+            store_series=False,
+            **options,
+        )
+
+    def _sync(self, strategy: str, **options):
+        client = self._client(strategy, update_statistics=False, **options)
+        client.sync_interval(self.SINCE, self.UNTIL)
+
+        metrics = set(
+            Metric.objects.values_list(
+                "url__url", "asn__code", "hour", "anomaly_count", "measurement_count"
+            )
+        )
+        Metric.objects.all().delete()
+        return metrics
+
+    def test_same_metrics(self):
+        expected = self._sync("aggregation")
+        self.assertEqual(len(expected), 35)
+
+        for (streaming, sharded) in [(True, True), (True, False), (False, True)]:
+            with self.subTest(streaming=streaming, sharded=sharded):
+                self.assertEqual(
+                    self._sync("measurements", streaming=streaming, sharded=sharded),
+                    expected,
+                )
+
+    def test_interval_sync_keeps_statistics(self):
+        # Past intervals can't be folded in order, so only a rebuild adds them
+        self._client("aggregation", update_statistics=True).sync_interval(
+            self.SINCE, self.UNTIL
+        )
+        self.assertFalse(MetricStatistics.objects.exists())
+
+        self.assertGreater(RunningStatisticsManager().rebuild(), 0)
+
+
+class _RecordingClient:
+    """Metrics client that only keeps the intervals it was asked to sync"""
+
+    def __init__(self):
+        self.synced = []
+
+    def sync_interval(self, since: datetime, until: datetime):
+        self.synced.append(since.date())
+
+
+class BackfillerTest(TestCase):
+    """Every unit should be run by a single worker, unless its worker is gone"""
+
+    SINCE = date(2022, 1, 1)
+    UNTIL = date(2022, 1, 3)
+
+    def setUp(self):
+        self.client = _RecordingClient()
+        self.backfiller = Backfiller(
+            country_code="VE", client=self.client, stale_seconds=3600
+        )
+
+    def test_claimed_once(self):
+        (first, *_) = self.backfiller.plan(self.SINCE, self.UNTIL)
+        self.assertTrue(self.backfiller.run_unit(first.id))
+        self.assertFalse(self.backfiller.run_unit(first.id))
+        self.assertEqual(self.client.synced, [self.SINCE])
+        self.assertEqual(
+            BackfillUnit.objects.get(id=first.id).status, BackfillUnit.Status.DONE
+        )
+
+    def test_running_units(self):
+        units = self.backfiller.plan(self.SINCE, self.UNTIL)
+        (running, stale) = (units[0], units[1])
+        now = timezone.now()
+        BackfillUnit.objects.filter(id=running.id).update(
+            status=BackfillUnit.Status.RUNNING, started_at=now - timedelta(minutes=5)
+        )
+        BackfillUnit.objects.filter(id=stale.id).update(
+            status=BackfillUnit.Status.RUNNING, started_at=now - timedelta(hours=2)
+        )
+
+        # Only abandoned units are planned and run again
+        self.assertEqual(
+            [unit.day for unit in self.backfiller.plan(self.SINCE, self.UNTIL)],
+            [stale.day, self.UNTIL],
+        )
+        self.assertFalse(self.backfiller.run_unit(running.id))
+        self.assertTrue(self.backfiller.run_unit(stale.id))
+        self.assertEqual(self.client.synced, [stale.day])
+
+
+class MeasurementArchiveTest(SimpleTestCase):
+    """Archives used by many processes at once, like parallel backfill tasks, shouldn't lose hours"""
+
+    def test_concurrent_writers(self):
+        start = datetime(2022, 6, 1, tzinfo=utc)
+        n_writers = 8
+
+        def measurement(i: int, hour: datetime):
+            return {
+                "measurement_uid": f"{i}-{hour:%H}",
+                "measurement_start_time": f"{hour:%Y-%m-%dT%H}:30:00Z",
+            }
+
+        with tempfile.TemporaryDirectory() as root:
+            # Every writer loads the index before any of them saves it
+            archives = [MeasurementArchive(root, "VE") for _ in range(n_writers)]
+            barrier = threading.Barrier(n_writers)
+
+            def write(i: int):
+                own_hour = start + timedelta(hours=i + 1)
+                barrier.wait()
+                archives[i].write_page(
+                    [measurement(i, start), measurement(i, own_hour)]
+                )
+                archives[i].save_index()
+
+            threads = [
+                threading.Thread(target=write, args=(i,)) for i in range(n_writers)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            archive = MeasurementArchive(root, "VE")
+            self.assertEqual(
+                archive.hours,
+                [start + timedelta(hours=h) for h in range(n_writers + 1)],
+            )
+
+            # Pages appended by every writer to the same hour are all readable
+            pages = list(archive.iter_pages(start, start + timedelta(hours=1)))
+            self.assertEqual(
+                sorted(m["measurement_uid"] for m in pages[0]),
+                sorted(f"{i}-00" for i in range(n_writers)),
+            )
+
+
+@skipUnless(
+    connection.vendor == "postgresql", "Query plans are only checked on PostgreSQL"
+)
+class MetricIndexPlanTest(TransactionTestCase):
+    """Hot metric queries should be served by the metric indexes"""
+
+    START = datetime(2022, 1, 1, tzinfo=utc)
+
+    def setUp(self):
+        asns = [ASN.objects.create(code=f"AS{i}") for i in range(5)]
+        urls = [Url.objects.create(url=f"http://{i}.com") for i in range(20)]
+        Metric.objects.bulk_create(
+            Metric(
+                asn=asn,
+                url=url,
+                hour=self.START + timedelta(hours=h),
+                anomaly_count=1,
+                measurement_count=3,
+            )
+            for asn in asns
+            for url in urls
+            for h in range(72)
+        )
+
+        # Up to date statistics and visibility map, so plans are like in production
+        with connection.cursor() as cursor:
+            cursor.execute(f"VACUUM ANALYZE {Metric._meta.db_table}")
+
+    def _plan(self, run: Callable[[], Any], seqscan: bool = True) -> str:
+        """Query plan for the last query performed by 'run'"""
+        with CaptureQueriesContext(connection) as queries:
+            run()
+
+        with connection.cursor() as cursor:
+            if not seqscan:
+                cursor.execute("SET enable_seqscan = off")
+            try:
+                cursor.execute(f"EXPLAIN {queries.captured_queries[-1]['sql']}")
+                return "\n".join(row[0] for row in cursor.fetchall())
+            finally:
+                cursor.execute("RESET enable_seqscan")
+
+    def test_pair_filter(self):
+        plan = self._plan(
+            lambda: HistogramGenerator._hourly_histogram(
+                "http://3.com", "AS1", self.START, self.START + timedelta(hours=24)
+            )
+        )
+        self.assertIn("unique_metric_url_asn_hour", plan)
+        self.assertNotIn("Seq Scan on blocking_early_warnings_metric", plan)
+
+    def test_hour_range_scan(self):
+        plan = self._plan(
+            lambda: HistogramGenerator._hourly_histogram(
+                None,
+                None,
+                self.START + timedelta(hours=70),
+                self.START + timedelta(hours=72),
+            )
+        )
+        self.assertIn("metric_hour_asn_url_idx", plan)
+        self.assertNotIn("Seq Scan", plan)
+
+    def test_max_hour(self):
+        # Every metric is read, so a sequential scan is fine. The index should still cover it
+        plan = self._plan(
+            lambda: DBMetricsClient(archive_dir=None)._get_max_hours(), seqscan=False
+        )
+        self.assertIn("Index Only Scan using unique_metric_url_asn_hour", plan)
+
+
+@skipUnless(
+    connection.vendor == "postgresql", "Partitioning is only supported on PostgreSQL"
+)
+class MetricPartitioningTest(TestCase):
+    """Partitioned metrics should keep every row, and partitions should be created and dropped safely"""
+
+    START = datetime(2022, 1, 1, tzinfo=utc)
+
+    def setUp(self):
+        self.asn = ASN.objects.create(code="AS1")
+        self.url = Url.objects.create(url="http://a.com")
+        Metric.objects.bulk_create(
+            self._metric(self.START + timedelta(hours=h)) for h in range(60)
+        )
+
+        # Partitioning alters the table, so check the deferred foreign keys of those rows now
+        with connection.cursor() as cursor:
+            cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+
+        self.table = Metric._meta.db_table
+        self.manager = MetricStorageManager(granularity="day", partitions_ahead=1)
+        self.manager.partition_table(now=self.START + timedelta(days=2, hours=12))
+
+    def _metric(self, hour: datetime) -> Metric:
+        return Metric(
+            asn=self.asn, url=self.url, hour=hour, anomaly_count=1, measurement_count=2
+        )
+
+    def _count(self, table: str) -> int:
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT COUNT(*) FROM "{table}"')
+            return cursor.fetchone()[0]
+
+    def test_partition_table(self):
+        self.assertTrue(self.manager.is_partitioned())
+        self.assertEqual(Metric.objects.count(), 60)
+        self.assertEqual(
+            sorted(name for (name, _) in self.manager._get_partitions()),
+            [f"{self.table}_p2022010{day}" for day in range(1, 5)],
+        )
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT a.attname FROM pg_index i
+                JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+                WHERE i.indrelid = %s::regclass AND i.indisprimary
+                """,
+                [self.table],
+            )
+            self.assertEqual({row[0] for row in cursor.fetchall()}, {"id", "hour"})
+
+        # New ids keep growing after the copied ones
+        metric = self._metric(self.START + timedelta(days=3))
+        metric.save()
+        self.assertEqual(Metric.objects.get(pk=metric.pk).hour, metric.hour)
+        self.assertEqual(metric.pk, Metric.objects.order_by("-id")[0].pk)
+
+    def test_future_partitions_take_default_rows(self):
+        # Beyond every partition, so it's stored in the default partition
+        self._metric(self.START + timedelta(days=5, hours=10)).save()
+        self.assertEqual(self._count(f"{self.table}_default"), 1)
+
+        created = self.manager.create_future_partitions(
+            now=self.START + timedelta(days=4)
+        )
+        self.assertEqual(
+            created, [f"{self.table}_p20220105", f"{self.table}_p20220106"]
+        )
+        self.assertEqual(self._count(f"{self.table}_default"), 0)
+        self.assertEqual(self._count(f"{self.table}_p20220106"), 1)
+        self.assertEqual(Metric.objects.count(), 61)
+
+    def test_retention(self):
+        settings = EarlyWarningSettings.load()
+        settings.number_of_days_back = 1
+        settings.save()
+
+        now = self.START + timedelta(days=2, hours=12)
+        (dropped, deleted) = self.manager.apply_retention(now=now)
+
+        self.assertEqual(dropped, [f"{self.table}_p20220101"])
+        self.assertEqual(deleted, 12)
+        self.assertEqual(
+            Metric.objects.order_by("hour")[0].hour, now - timedelta(days=1)
+        )
+
+
+class RollupTest(TestCase):
+    """Rollups should add up hourly metrics, and only be recomputed for periods still stored as hourly metrics"""
+
+    # A monday
+    START = datetime(2022, 1, 3, tzinfo=utc)
+    DAYS = 10
+
+    def setUp(self):
+        asn = ASN.objects.create(code="AS1")
+        urls = [Url.objects.create(url=f"http://{i}.com") for i in range(2)]
+
+        Metric.objects.bulk_create(
+            Metric(
+                asn=asn,
+                url=url,
+                hour=self.START + timedelta(hours=h),
+                anomaly_count=(h + i) % 3,
+                measurement_count=4,
+            )
+            for (i, url) in enumerate(urls)
+            for h in range(self.DAYS * 24)
+        )
+
+    def _expected(self, resolution: str) -> Dict[Tuple, Tuple[int, int]]:
+        """Rollups computed from hourly metrics, by (period start, url id, asn id)"""
+        expected = {}
+        for metric in Metric.objects.all():
+            period = RollupManager.period_start(metric.hour, resolution)
+            for url_id in (metric.url_id, None):
+                key = (period, url_id, metric.asn_id)
+                (anomalies, measurements) = expected.get(key, (0, 0))
+                expected[key] = (
+                    anomalies + metric.anomaly_count,
+                    measurements + metric.measurement_count,
+                )
+
+        return expected
+
+    def _rollups(self, resolution: str) -> Dict[Tuple, Tuple[int, int]]:
+        return {
+            (r.period_start, r.url_id, r.asn_id): (r.anomaly_count, r.measurement_count)
+            for r in MetricRollup.objects.filter(resolution=resolution)
+        }
+
+    def test_update(self):
+        RollupManager().update(self.START, self.START + timedelta(days=self.DAYS))
+
+        for resolution in MetricRollup.Resolution:
+            self.assertEqual(self._rollups(resolution), self._expected(resolution))
+        self.assertEqual(len(self._rollups(MetricRollup.Resolution.WEEK)), 2 * 3)
+
+    def test_update_affected_periods(self):
+        manager = RollupManager()
+        manager.update(self.START, self.START + timedelta(days=self.DAYS))
+
+        # Changing a single hour should only recompute its own day and week
+        hour = self.START + timedelta(days=8, hours=5)
+        Metric.objects.filter(hour=hour).update(anomaly_count=4)
+        MetricRollup.objects.filter(period_start=self.START).update(anomaly_count=-1)
+        manager.update(hour, hour + timedelta(hours=1))
+
+        for resolution in MetricRollup.Resolution:
+            rollups = self._rollups(resolution)
+            for (key, counts) in self._expected(resolution).items():
+                if key[0] == self.START:
+                    self.assertEqual(rollups[key], (-1, counts[1]))
+                else:
+                    self.assertEqual(rollups[key], counts)
+
+    def test_rebuild_all_keeps_pruned_days(self):
+        manager = RollupManager()
+        manager.update(self.START, self.START + timedelta(days=self.DAYS))
+        expected = {r: self._rollups(r) for r in MetricRollup.Resolution}
+
+        # Prune hourly metrics up to the middle of the third day
+        Metric.objects.filter(
+            hour__lt=self.START + timedelta(days=2, hours=12)
+        ).delete()
+        manager.rebuild_all()
+
+        for resolution in MetricRollup.Resolution:
+            self.assertEqual(self._rollups(resolution), expected[resolution])
+
+    def test_histogram_resolution(self):
+        RollupManager().update(self.START, self.START + timedelta(days=self.DAYS))
+        end_date = self.START + timedelta(days=self.DAYS)
+
+        hourly = HistogramGenerator.histogram(start_date=self.START, end_date=end_date)
+        self.assertEqual(len(hourly), self.DAYS * 24)
+
+        daily = HistogramGenerator.histogram(
+            start_date=self.START, end_date=end_date, resolution="auto"
+        )
+        self.assertEqual(
+            [b.hour for b in daily][:2], [self.START, self.START + timedelta(days=1)]
+        )
+        self.assertEqual(len(daily), self.DAYS)
+        self.assertEqual(
+            sum(b.anomaly_count for b in daily), sum(b.anomaly_count for b in hourly)
+        )
+
+
+@skipUnless(connection.vendor == "postgresql", "Concurrent writers need PostgreSQL")
+class ConcurrentRollupTest(TransactionTestCase):
+    """Updates refreshing the same periods at once should never duplicate rollups"""
+
+    START = RollupTest.START
+
+    def setUp(self):
+        asn = ASN.objects.create(code="AS1")
+        urls = [Url.objects.create(url=f"http://{i}.com") for i in range(20)]
+        Metric.objects.bulk_create(
+            Metric(
+                asn=asn,
+                url=url,
+                hour=self.START + timedelta(hours=h),
+                anomaly_count=h % 3,
+                measurement_count=4,
+            )
+            for url in urls
+            for h in range(7 * 24)
+        )
+
+    def test_overlapping_updates(self):
+        n_updates = 6
+        barrier = threading.Barrier(n_updates)
+        errors = []
+
+        def update(day: int):
+            try:
+                barrier.wait()
+                since = self.START + timedelta(days=day)
+                RollupManager().update(since, since + timedelta(days=2))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=update, args=(i,)) for i in range(n_updates)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        (week,) = MetricRollup.objects.filter(
+            resolution=MetricRollup.Resolution.WEEK, url__isnull=True
+        )
+        self.assertEqual(week.measurement_count, 20 * 7 * 24 * 4)
+        self.assertEqual(
+            MetricRollup.objects.filter(resolution=MetricRollup.Resolution.DAY).count(),
+            7 * 21,
+        )
+
+
+class SeriesMonitorTest(TestCase):
+    """The monitor should find the same issues reading packed series as reading hourly metrics"""
+
+    START = datetime(2022, 1, 3, tzinfo=utc)
+
+    def setUp(self):
+        rng = random.Random(15)
+        url_list = UrlList.objects.create(
+            name="test", storage_type=UrlList.StorageType.DB, parse_strategy=None
+        )
+        asns = [ASN.objects.create(code=f"AS{i}") for i in range(3)]
+        urls = [Url.objects.create(url=f"http://{i}.com") for i in range(6)]
+        url_list.url_set.add(*urls[:3])
+
+        metrics = []
+        for asn in asns:
+            for url in urls:
+                blocked_from = rng.choice([None, 18, 20])
+                for h in range(30):
+                    measurement_count = rng.choice([0, 5, 10, 50])
+                    blocked = blocked_from is not None and h >= blocked_from
+                    metrics.append(
+                        Metric(
+                            asn=asn,
+                            url=url,
+                            hour=self.START + timedelta(hours=h),
+                            measurement_count=measurement_count,
+                            anomaly_count=measurement_count
+                            if blocked
+                            else rng.randint(0, measurement_count // 5),
+                        )
+                    )
+
+        Metric.objects.bulk_create(metrics)
+        MetricSeriesStore().convert_from_metrics()
+
+    def _issues(self, **options):
+        monitor = AnomalyMonitor(**options)
+        issues = monitor._compute_anomalies(
+            start_time=self.START + timedelta(minutes=30),
+            end_time=self.START + timedelta(hours=26, minutes=30),
+            tolerance=0.1,
+        )
+        return [
+            (issue.asn.id, issue.url.id, issue.issue_type, issue.metrics)
+            for issue in issues
+        ]
+
+    def test_same_issues(self):
+        for batch_detection in (True, False):
+            for hierarchical in (True, False):
+                options = dict(
+                    batch_detection=batch_detection,
+                    hierarchical=hierarchical,
+                    drilldown_std=0.3,
+                )
+                with self.subTest(**options):
+                    expected = self._issues(read_series=False, **options)
+                    self.assertTrue(
+                        any(
+                            issue_type != IssueType.OK
+                            for (*_, issue_type, _) in expected
+                        )
+                    )
+                    self.assertEqual(
+                        self._issues(read_series=True, **options), expected
+                    )
+
+    def test_pruned_metrics(self):
+        monitor = AnomalyMonitor(read_series=True)
+        (reported, *_) = [
+            issue
+            for issue in monitor._compute_anomalies(
+                start_time=self.START,
+                end_time=self.START + timedelta(hours=30),
+                tolerance=0.1,
+            )
+            if issue.issue_type != IssueType.OK
+        ]
+        AnomalyReport.bulk_create_from_issue_descriptions([reported])
+
+        # Only hourly metrics linked to reports are kept
+        n_metrics = Metric.objects.count()
+        pruned = MetricSeriesStore().prune_metrics(
+            now=self.START + timedelta(days=2), days=0
+        )
+        self.assertEqual(pruned, n_metrics - len(reported.metrics))
+        self.assertEqual(
+            set(Metric.objects.values_list("id", flat=True)),
+            {m.id for m in reported.metrics},
+        )
+
+        # Issues whose metrics are gone can't be linked to reports anymore
+        issues = [
+            issue
+            for issue in monitor._compute_anomalies(
+                start_time=self.START,
+                end_time=self.START + timedelta(hours=30),
+                tolerance=0.1,
+            )
+            if issue.issue_type != IssueType.OK
+        ]
+        self.assertEqual(issues, [reported])
+
+        reported.metrics = []
+        (title, _) = monitor._compose_mail(reported)
+        self.assertIn(reported.url.url, title)
+
+
+class RunningStatisticsTest(TestCase):
+    """Running statistics should fold every hour once, and their spikes should be notified like the monitor's"""
+
+    def setUp(self):
+        self.asn = ASN.objects.create(code="AS1")
+        self.url = Url.objects.create(
+            url="http://a.com", alert_level=Url.AlertCategory.ALERT
+        )
+        self.start = datetime.now(tz=utc).replace(
+            minute=0, second=0, microsecond=0
+        ) - timedelta(hours=30)
+        self.manager = RunningStatisticsManager(alpha=0.5, min_hours=6, tolerance=0.1)
+
+    def _add(self, first_hour: int, anomaly_counts: List[int]) -> List[Metric]:
+        return Metric.objects.bulk_create(
+            Metric(
+                asn=self.asn,
+                url=self.url,
+                hour=self.start + timedelta(hours=first_hour + i),
+                anomaly_count=anomalies,
+                measurement_count=10,
+            )
+            for (i, anomalies) in enumerate(anomaly_counts)
+        )
+
+    def _expected(self, anomaly_counts: List[int]) -> Tuple[float, float]:
+        """Mean and variance folded one hour at a time"""
+        (mean, variance) = (anomaly_counts[0] / 10, 0.0)
+        for anomalies in anomaly_counts[1:]:
+            diff = anomalies / 10 - mean
+            mean += 0.5 * diff
+            variance = 0.5 * (variance + diff * 0.5 * diff)
+
+        return (mean, variance)
+
+    def test_update(self):
+        counts = [1, 2, 1, 0, 2, 1, 1, 2, 0, 1]
+        self._add(0, counts)
+        self.assertEqual(self.manager.update(), [])
+
+        stats = MetricStatistics.objects.get()
+        self.assertEqual(stats.count, len(counts))
+        self.assertEqual(stats.last_hour, self.start + timedelta(hours=len(counts) - 1))
+        for (value, expected) in zip(
+            (stats.mean, stats.variance), self._expected(counts)
+        ):
+            self.assertAlmostEqual(value, expected)
+
+    def test_incremental_update(self):
+        counts = [1, 2, 1, 0, 2, 1, 1, 2, 0, 1, 2, 1]
+        self._add(0, counts[:8])
+        self.manager.update()
+        self._add(8, counts[8:])
+
+        self.manager.update(since=self.start + timedelta(hours=6))
+
+        # Hours already folded are skipped, even if they're read again
+        self.assertEqual(self.manager.update(since=self.start), [])
+
+        stats = MetricStatistics.objects.get()
+        self.assertEqual(stats.count, len(counts))
+        for (value, expected) in zip(
+            (stats.mean, stats.variance), self._expected(counts)
+        ):
+            self.assertAlmostEqual(value, expected)
+
+    def test_concurrent_updates(self):
+        counts = [1, 2, 1, 0, 2, 1]
+        self._add(0, counts)
+        managers = [RunningStatisticsManager(alpha=0.5) for _ in range(2)]
+
+        # Both updates fold the same new hours before any of them is saved
+        for folded in [manager._fold_new_hours(since=None)[0] for manager in managers]:
+            self.manager._save(folded)
+
+        stats = MetricStatistics.objects.get()
+        self.assertEqual(stats.count, len(counts))
+        self.assertAlmostEqual(stats.mean, self._expected(counts)[0])
+
+    def test_spikes(self):
+        # Not enough history to test the first hours for spikes
+        self._add(0, [0, 9, 0, 0, 0, 0, 0])
+        self.assertEqual(self.manager.update(), [])
+
+        (spike,) = self._add(7, [8])
+        (issue,) = self.manager.update()
+        self.assertEqual(issue.issue_type, IssueType.SPIKE)
+        self.assertEqual(
+            (issue.asn, issue.url, [m.id for m in issue.metrics]),
+            (self.asn, self.url, [spike.id]),
+        )
+
+    def test_spikes_notified_once(self):
+        self._add(0, [1] * 20 + [9])
+        spikes = self.manager.update()
+
+        monitor = AnomalyMonitor(
+            detectors=["spike"],
+            notification_queue=True,
+            alert_suppression=True,
+        )
+        monitor.handle_issues(spikes, should_act=True, should_report=True)
+        self.assertEqual(AnomalyReport.objects.count(), 1)
+        notified = Notification.objects.count()
+        self.assertGreater(notified, 0)
+
+        # The monitor finds the same spike, but it's already notified
+        issues = monitor.analize_db_metrics(start_time=self.start, should_act=True)
+        self.assertEqual([issue.issue_type for issue in issues], [IssueType.SPIKE])
+        self.assertEqual(Notification.objects.count(), notified)
+
+
+class MonitorDetectorsTest(TestCase):
+    """Detectors registered anywhere should run in the monitor, with the history they need"""
+
+    def setUp(self):
+        self.asn = ASN.objects.create(code="AS1")
+        self.url = Url.objects.create(
+            url="http://a.com", alert_level=Url.AlertCategory.ALERT
+        )
+        self.now = datetime.now(tz=utc).replace(minute=0, second=0, microsecond=0)
+
+    def _add(self, hours: int, anomalies: Dict[int, int]):
+        """Add a metric with 1 anomaly in 10 measurements for each of the last 'hours' hours,
+        or the given anomalies for some of them, by how many hours ago they are
+        """
+        Metric.objects.bulk_create(
+            Metric(
+                asn=self.asn,
+                url=self.url,
+                hour=self.now - timedelta(hours=h),
+                anomaly_count=anomalies.get(h, 1),
+                measurement_count=10,
+            )
+            for h in range(1, hours + 1)
+        )
+
+    def test_registered_detector(self):
+        class FullyBlockedDetector(Detector):
+            name = "fully_blocked"
+            issue_type = "fully_blocked"
+            description = "Every measurement is an anomaly"
+            human_readable = "Fully blocked"
+            severity = 3
+
+            def detect(self, batch: SeriesBatch):
+                return batch.valid & (batch.anomalies == batch.measurements)
+
+        register_detector(FullyBlockedDetector)
+        self.addCleanup(DETECTORS.pop, "fully_blocked")
+        self.addCleanup(ISSUE_TYPES.pop, "fully_blocked")
+
+        self._add(24, {3: 10})
+        monitor = AnomalyMonitor(
+            detectors=["fully_blocked", "spike"],
+            notification_queue=True,
+            alert_suppression=True,
+        )
+        (issue,) = monitor.analize_db_metrics(should_act=True, should_report=True)
+
+        self.assertIs(issue.issue_type, IssueType("fully_blocked"))
+        self.assertEqual(issue.issue_type.human_readable, "Fully blocked")
+        self.assertEqual(issue.issue_type.severity, 3)
+        self.assertEqual(
+            [m.hour for m in issue.metrics], [self.now - timedelta(hours=3)]
+        )
+        self.assertEqual(IssueDescription.from_dicts([issue.to_dict()]), [issue])
+
+        self.assertEqual(AnomalyReport.objects.get().issue_type, "fully_blocked")
+        self.assertEqual(AlertState.objects.get().issue_type, "fully_blocked")
+        self.assertIn("Fully blocked", Notification.objects.first().message)
+
+    def test_seasonal_lookback(self):
+        # Every monday at the same hour is a bit worse, and the last one is much worse.
+        # Last week's bad hour is only a baseline, it's out of the window
+        weeks = 3 * HOURS_PER_WEEK
+        self._add(
+            weeks, {5: 9, 5 + HOURS_PER_WEEK: 3, 5 + 2 * HOURS_PER_WEEK: 3, 30: 9}
+        )
+
+        for hierarchical in (False, True):
+            with self.subTest(hierarchical=hierarchical):
+                monitor = AnomalyMonitor(
+                    detectors=["seasonal"],
+                    hierarchical=hierarchical,
+                    drilldown_std=1,
+                )
+                (issue,) = monitor.analize_db_metrics()
+
+                self.assertEqual(issue.issue_type, IssueType.SEASONAL_DEVIATION)
+                self.assertEqual(
+                    [m.hour for m in issue.metrics], [self.now - timedelta(hours=5)]
+                )
+
+
+@skipUnless(connection.vendor == "postgresql", "Concurrent writers need PostgreSQL")
+class ConcurrentDeliveryTest(TransactionTestCase):
+    """Dispatchers delivering at the same time should share the concurrency of a channel"""
+
+    def setUp(self):
+        self.server = _LocalHttpServer(self._respond)
+
+    def tearDown(self):
+        self.server.close()
+
+    def _respond(self, method, path, query, body):
+        time.sleep(0.05)
+        return (200, {}, {})
+
+    def test_channel_concurrency(self):
+        n_dispatchers = 2
+        dispatchers = [
+            NotificationDispatcher(
+                channels={
+                    "webhook": WebhookChannel(
+                        url=f"{self.server.url}/hook", concurrency=2, batch_size=4
+                    )
+                }
+            )
+            for _ in range(n_dispatchers)
+        ]
+        dispatchers[0].enqueue([(f"title {i}", f"message {i}", []) for i in range(16)])
+        barrier = threading.Barrier(n_dispatchers)
+        errors = []
+
+        def deliver(dispatcher: NotificationDispatcher):
+            try:
+                barrier.wait()
+                while dispatcher.deliver() is not None:
+                    pass
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [
+            threading.Thread(target=deliver, args=(dispatcher,))
+            for dispatcher in dispatchers
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.server.requests), 16)
+        self.assertEqual(self.server.max_in_flight, 2)
+        self.assertEqual(
+            set(Notification.objects.values_list("status", flat=True)),
+            {Notification.Status.SENT},
+        )
+
+
+class NotificationDispatcherTest(TestCase):
+    """Queued notifications should be bounded, delivered once, and retried with backoff when they fail"""
+
+    def setUp(self):
+        self.failures = 0
+        self.server = _LocalHttpServer(self._respond)
+
+    def tearDown(self):
+        self.server.close()
+
+    def _respond(self, method, path, query, body):
+        if self.failures > 0:
+            self.failures -= 1
+            return (500, {"error": "unavailable"}, {})
+
+        # Slow enough for many workers to deliver at the same time
+        time.sleep(0.05)
+        return (200, {}, {})
+
+    def _dispatcher(self, **options) -> NotificationDispatcher:
+        options.setdefault("backoff_seconds", 10.0)
+        channel = WebhookChannel(url=f"{self.server.url}/hook", **options)
+        return NotificationDispatcher(channels={"webhook": channel})
+
+    def _enqueue(self, dispatcher: NotificationDispatcher, n: int):
+        return dispatcher.enqueue(
+            [(f"title {i}", f"message {i}", [{"id": i}]) for i in range(n)]
+        )
+
+    def test_backpressure(self):
+        dispatcher = self._dispatcher(max_pending=3)
+        self._enqueue(dispatcher, 2)
+
+        statuses = [n.status for n in self._enqueue(dispatcher, 3)]
+        self.assertEqual(
+            statuses,
+            [
+                Notification.Status.PENDING,
+                Notification.Status.DROPPED,
+                Notification.Status.DROPPED,
+            ],
+        )
+
+    def test_webhook_delivery(self):
+        dispatcher = self._dispatcher(concurrency=3)
+        self._enqueue(dispatcher, 6)
+
+        self.assertIsNone(dispatcher.deliver())
+        self.assertEqual(
+            set(Notification.objects.values_list("status", flat=True)),
+            {Notification.Status.SENT},
+        )
+        self.assertEqual(
+            sorted(body["title"] for (_, _, body) in self.server.requests),
+            [f"title {i}" for i in range(6)],
+        )
+        self.assertEqual(self.server.requests[0][2]["issues"][0].keys(), {"id"})
+        self.assertGreater(self.server.max_in_flight, 1)
+        self.assertLessEqual(self.server.max_in_flight, 3)
+
+    def test_retry_backoff(self):
+        dispatcher = self._dispatcher(max_retries=2)
+        self._enqueue(dispatcher, 1)
+        self.failures = 3
+
+        for attempt in (1, 2):
+            before = timezone.now()
+            next_attempt = dispatcher.deliver()
+
+            notification = Notification.objects.get()
+            self.assertEqual(notification.status, Notification.Status.PENDING)
+            self.assertEqual(notification.attempts, attempt)
+            self.assertIn("HTTPError", notification.last_error)
+            self.assertEqual(next_attempt, notification.next_attempt_at)
+
+            # Backoff doubles after every failure, with up to half of it as jitter
+            backoff = timedelta(seconds=10 * 2 ** (attempt - 1))
+            self.assertGreaterEqual(next_attempt, before + backoff / 2)
+            self.assertLessEqual(next_attempt, timezone.now() + backoff)
+
+            # Not due yet
+            dispatcher.deliver()
+            self.assertEqual(Notification.objects.get().attempts, attempt)
+            Notification.objects.update(next_attempt_at=timezone.now())
+
+        # Out of retries
+        self.assertIsNone(dispatcher.deliver())
+        notification = Notification.objects.get()
+        self.assertEqual(notification.status, Notification.Status.FAILED)
+        self.assertEqual(notification.attempts, 3)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_claim_timeout(self):
+        dispatcher = NotificationDispatcher(
+            channels={"webhook": WebhookChannel(url=f"{self.server.url}/hook")},
+            claim_timeout_seconds=600,
+        )
+        (abandoned, working) = self._enqueue(dispatcher, 2)
+
+        # A worker took both of them, but only the first one was abandoned
+        now = timezone.now()
+        Notification.objects.filter(id=abandoned.id).update(
+            status=Notification.Status.SENDING, claimed_at=now - timedelta(minutes=20)
+        )
+        Notification.objects.filter(id=working.id).update(
+            status=Notification.Status.SENDING, claimed_at=now - timedelta(minutes=1)
+        )
+
+        dispatcher.deliver()
+        abandoned.refresh_from_db()
+        working.refresh_from_db()
+        self.assertEqual(abandoned.status, Notification.Status.SENT)
+        self.assertEqual(working.status, Notification.Status.SENDING)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_single_scheduled_run(self):
+        dispatcher = self._dispatcher()
+        now = timezone.now()
+
+        later = dispatcher.schedule("webhook", now + timedelta(minutes=5))
+        self.assertIsNotNone(later)
+        self.assertIsNone(dispatcher.schedule("webhook", now + timedelta(minutes=10)))
+
+        # An earlier run replaces the scheduled one
+        earlier = dispatcher.schedule("webhook", now)
+        self.assertIsNotNone(earlier)
+        self.assertIsNone(dispatcher.schedule("webhook", now))
+        self.assertFalse(dispatcher.start_run("webhook", later))
+        self.assertTrue(dispatcher.start_run("webhook", earlier))
+
+        # Once started, the next run can be scheduled
+        self.assertIsNotNone(dispatcher.schedule("webhook", now))
+
+    def test_leased_channel(self):
+        dispatcher = self._dispatcher()
+        self._enqueue(dispatcher, 1)
+
+        with dispatcher._lease("webhook") as leased:
+            # Another dispatcher holds the lease, so this one waits until it expires
+            self.assertTrue(leased)
+            self.assertEqual(
+                dispatcher.deliver_channel("webhook", dispatcher.channels["webhook"]), 0
+            )
+            self.assertGreaterEqual(
+                dispatcher.next_run("webhook"),
+                timezone.now() + timedelta(minutes=5),
+            )
+
+        self.assertIsNone(dispatcher.deliver())
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_workers_without_connection(self):
+        class Interrupted(BaseException):
+            pass
+
+        class FailingChannel(NotificationChannel):
+            name = "failing"
+
+            def __init__(self, error: BaseException):
+                super().__init__(concurrency=2)
+                self.error = error
+
+            @contextmanager
+            def connect(self):
+                raise self.error
+                yield
+
+        for (error, expected) in [
+            (ConnectionError("refused"), "ConnectionError: refused"),
+            (Interrupted(), "RuntimeError: No worker could deliver this notification"),
+        ]:
+            with self.subTest(error=expected):
+                Notification.objects.all().delete()
+                dispatcher = NotificationDispatcher(
+                    channels={"failing": FailingChannel(error)}
+                )
+                self._enqueue(dispatcher, 3)
+                dispatcher.deliver()
+
+                for notification in Notification.objects.all():
+                    self.assertEqual(notification.status, Notification.Status.PENDING)
+                    self.assertEqual(notification.last_error, expected)
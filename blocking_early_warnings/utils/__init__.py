@@ -1,4 +1,6 @@
 from .anomaly_monitor import AnomalyMonitor
 from .histogram_generator import HistogramGenerator, HistogramBlockData
 from .ooni_requests import DBMetricsClient
+from .ooni_fetcher import OoniFetcher
+from .measurement_archive import MeasurementArchive
 from .list_loaders import ListLoader
\ No newline at end of file
@@ -0,0 +1,162 @@
+"""
+    Alert cooldown and suppression, so ongoing issues are only notified when they're new or escalate
+"""
+# Django imports
+from django.db import transaction
+
+# Local imports
+from blocking_early_warnings.models import AlertState
+from blocking_early_warnings.settings import (
+    ALERT_COOLDOWN_HOURS,
+    ALERT_ESCALATION_RATIO,
+    ALERT_RESOLVE_HOURS,
+    METRIC_WRITE_CHUNK_SIZE,
+)
+
+# Python imports
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Optional, Tuple
+
+# url id, asn id and issue type value
+AlertKey = Tuple[int, int, str]
+
+
+class AlertStateCache:
+    """In-process copy of the alert state of the issues in a run. It's warmed with a single query
+    at the start of a run, so checking if an issue should be notified needs no query at all,
+    and changed states are upserted at once when the run finishes
+    """
+
+    def __init__(
+        self,
+        cooldown_hours: float = ALERT_COOLDOWN_HOURS,
+        escalation_ratio: float = ALERT_ESCALATION_RATIO,
+        resolve_hours: float = ALERT_RESOLVE_HOURS,
+        batch_size: int = METRIC_WRITE_CHUNK_SIZE,
+    ):
+        """
+        Args:
+            cooldown_hours (float): Hours before notifying the same issue again, unless it escalates
+            escalation_ratio (float): How much higher the peak anomaly ratio should be to escalate an issue
+            resolve_hours (float): Hours without seeing an issue before it's resolved
+            batch_size (int): How many states are written to database at once
+        """
+        self._cooldown = timedelta(hours=cooldown_hours)
+        self._escalation_ratio = escalation_ratio
+        self._resolve = timedelta(hours=resolve_hours)
+        self._batch_size = batch_size
+
+        self._states: Dict[AlertKey, AlertState] = {}
+        self._changed: Dict[AlertKey, AlertState] = {}
+
+    def warm(
+        self, keys: Iterable[AlertKey], states: Optional[Iterable[AlertState]] = None
+    ):
+        """Load the stored state of every issue in this run, however old it is
+
+        Args:
+            keys (Iterable[AlertKey]): Url id, asn id and issue type value of every issue in this run
+            states (Optional[Iterable[AlertState]]): States to load. Defaults to the stored states for the given keys.
+        """
+        keys = set(keys)
+        if states is None and keys:
+            # Ids are filtered by the database, exact keys here
+            stored = AlertState.objects.filter(
+                url_id__in={url_id for (url_id, _, _) in keys},
+                asn_id__in={asn_id for (_, asn_id, _) in keys},
+                issue_type__in={issue_type for (_, _, issue_type) in keys},
+            )
+            states = (
+                s
+                for s in stored.iterator(chunk_size=self._batch_size)
+                if (s.url_id, s.asn_id, s.issue_type) in keys
+            )
+
+        self._states = {(s.url_id, s.asn_id, s.issue_type): s for s in states or []}
+        self._changed = {}
+
+    def should_notify(
+        self,
+        url_id: int,
+        asn_id: int,
+        issue_type: str,
+        peak_ratio: float,
+        now: datetime,
+    ) -> bool:
+        """Record that an issue was found in this run, and check if it should be notified: it's new, it was
+        resolved and came back, its cooldown expired, or it escalated since it was last notified
+
+        Args:
+            url_id (int): Url id for this issue
+            asn_id (int): Asn id for this issue
+            issue_type (str): Issue type value
+            peak_ratio (float): Highest anomaly ratio in the offending metrics of this issue
+            now (datetime): Time of this run
+
+        Returns:
+            bool: If this issue should be notified
+        """
+        key = (url_id, asn_id, issue_type)
+        state = self._states.get(key)
+
+        if state is None or state.last_seen_at < now - self._resolve:
+            # New issue, or it was resolved and came back
+            state = state or AlertState(
+                url_id=url_id, asn_id=asn_id, issue_type=issue_type
+            )
+            state.opened_at = now
+            notify = True
+        elif state.last_notified_at is None:
+            notify = True
+        elif state.last_notified_at <= now - self._cooldown:
+            notify = True
+        else:
+            notify = peak_ratio > state.notified_peak_ratio * (
+                1 + self._escalation_ratio
+            )
+
+        state.last_seen_at = now
+        if notify:
+            state.last_notified_at = now
+            state.notified_peak_ratio = peak_ratio
+
+        self._states[key] = state
+        self._changed[key] = state
+        return notify
+
+    def save(self) -> int:
+        """Upsert every state changed in this run, so states created by another run at the same
+        time are overwritten instead of failing
+
+        Returns:
+            int: How many states were written
+        """
+        states = [
+            AlertState(
+                url_id=s.url_id,
+                asn_id=s.asn_id,
+                issue_type=s.issue_type,
+                opened_at=s.opened_at,
+                last_seen_at=s.last_seen_at,
+                last_notified_at=s.last_notified_at,
+                notified_peak_ratio=s.notified_peak_ratio,
+            )
+            for s in self._changed.values()
+        ]
+
+        with transaction.atomic():
+            AlertState.objects.bulk_create(
+                states,
+                update_conflicts=True,
+                unique_fields=["url", "asn", "issue_type"],
+                update_fields=[
+                    "opened_at",
+                    "last_seen_at",
+                    "last_notified_at",
+                    "notified_peak_ratio",
+                ],
+                batch_size=self._batch_size,
+            )
+
+        self._changed = {}
+        return len(states)
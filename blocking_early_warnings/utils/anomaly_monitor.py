@@ -1,25 +1,53 @@
 """
     This module implements the anomaly monitoring logic, like sending emails on relevant alerts
 """
-
+# Django imports
+from django.db.models import Q, Sum
 
 # Python imports
 from datetime import datetime, timedelta
 from enum import Enum
-from typing import Dict, List, Optional, Tuple
-from itertools import product
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+from itertools import groupby, islice
+from operator import attrgetter, itemgetter
 import dataclasses
-import ssl, smtplib
+import math
 from pytz import utc
+import numpy as np
 
 # Local imports
-from blocking_early_warnings.models import ASN, Metric, Url
+from blocking_early_warnings.models import ASN, AnomalyReport, Metric, Url, UrlList
 from blocking_early_warnings.settings import (
     TOLERANCE,
     MAIL_TO_NOTIFY,
     SENDER_MAIL,
     SENDER_MAIL_PSWD,
+    MONITOR_READ_CHUNK_SIZE,
+    MONITOR_BATCH_DETECTION,
+    MONITOR_BATCH_ROWS,
+    MONITOR_SHARD_SIZE,
+    MONITOR_PARALLELISM,
+    MONITOR_HIERARCHICAL,
+    MONITOR_DRILLDOWN_STD,
+    MONITOR_DETECTORS,
+    MONITOR_DETECTOR_OPTIONS,
+    ALERT_DIGEST_GROUPING,
+    ALERT_SUPPRESSION,
+    NOTIFICATION_QUEUE,
+    METRIC_SERIES_STORAGE,
+)
+from blocking_early_warnings.utils.alert_state import AlertStateCache
+from blocking_early_warnings.utils.detectors import (
+    ISSUE_TYPES,
+    Detector,
+    HighAnomalyRateDetector,
+    SeriesBatch,
+    SpikeDetector,
+    create_detector,
 )
+from blocking_early_warnings.utils.mailer import SmtpMailer
+from blocking_early_warnings.utils.metric_series import MetricSeriesStore
+from blocking_early_warnings.utils.notifications import NotificationDispatcher
 
 
 class IssueType(Enum):
@@ -27,11 +55,34 @@ class IssueType(Enum):
     ok: Everything ok, there's no issue
     spike: There was a sudden spike of anomalies for a given pair (url,asn)
     high_anomaly_rate: There's too many measurements with anomalies
+    ewma_deviation: A metric is far above the recent weighted average
+    robust_outlier: A metric is far above the median
+    level_shift: Anomalies increased and stayed high
+    seasonal_deviation: A metric is far above the usual for the same hour of the week
+
+    Every variant but ok is reported by a detector, which registers its description
+    and human readable name (see utils/detectors.py). Issue types registered by other
+    detectors are resolved through the registry, like IssueType("my_issue")
     """
 
     OK = "ok"
     SPIKE = "spike"
     HIGH_ANOMALY_RATE = "high_anomaly_rate"
+    EWMA_DEVIATION = "ewma_deviation"
+    ROBUST_OUTLIER = "robust_outlier"
+    LEVEL_SHIFT = "level_shift"
+    SEASONAL_DEVIATION = "seasonal_deviation"
+
+    @classmethod
+    def _missing_(cls, value: Any) -> Optional["IssueType"]:
+        """Create a member for an issue type registered by a detector, the same one for every lookup"""
+        if value not in ISSUE_TYPES:
+            return None
+
+        member = object.__new__(cls)
+        member._name_ = value.upper()
+        member._value_ = value
+        return cls._value2member_map_.setdefault(value, member)
 
     @property
     def description(self) -> str:
@@ -42,13 +93,15 @@ class IssueType(Enum):
         """
         desc_map = {
             IssueType.OK: "Everything ok, no actual issue was found",
-            IssueType.SPIKE: "There is a metric with high a amount of anomalies",
-            IssueType.HIGH_ANOMALY_RATE: "There is a high amount of anomalies in multiple metrics",
         }
+        desc_map.update(
+            (IssueType(value), info.description)
+            for (value, info) in ISSUE_TYPES.items()
+        )
 
         assert (
             self in desc_map
-        ), f"'{self}' does not have a description. Maybe you added a new issue type variant but forgot to add its description?"
+        ), f"'{self}' does not have a description. Maybe you added a new issue type variant but forgot to register its detector?"
 
         return desc_map[self]
 
@@ -62,25 +115,326 @@ class IssueType(Enum):
 
         human_map = {
             IssueType.OK: "ok",
-            IssueType.SPIKE: "Spike in amount of anomalies",
-            IssueType.HIGH_ANOMALY_RATE: "High anomaly rate",
         }
+        human_map.update(
+            (IssueType(value), info.human_readable)
+            for (value, info) in ISSUE_TYPES.items()
+        )
 
         assert (
             self in human_map
-        ), f"'{self}' does not have an human readable name. Maybe you added a new issue type variant but forgot to add its human readable name?"
+        ), f"'{self}' does not have an human readable name. Maybe you added a new issue type variant but forgot to register its detector?"
         return human_map[self]
 
+    @property
+    def severity(self) -> int:
+        """Return how serious this type of issue is, from 1 (low) to 3 (high). OK issues have no severity
+
+        Returns:
+            int: severity level
+        """
+        if self == IssueType.OK:
+            return 0
+
+        assert (
+            self.value in ISSUE_TYPES
+        ), f"'{self}' does not have a severity. Maybe you added a new issue type variant but forgot to register its detector?"
+        return ISSUE_TYPES[self.value].severity
+
+
+class DigestGrouping(Enum):
+    """Possible ways to group alerts from a run in digest mails
+    asn: a digest for every asn
+    url_list: a digest for every url list. Urls in many lists are in each of their digests
+    severity: a digest for every severity level
+    none: a mail for every issue
+    """
+
+    ASN = "asn"
+    URL_LIST = "url_list"
+    SEVERITY = "severity"
+    NONE = "none"
+
+
+# Names for every severity level, used in digests
+SEVERITY_NAMES = {3: "high", 2: "medium", 1: "low"}
+
+
+class MetricRow(NamedTuple):
+    """Lightweight read-only view of a stored Metric, with only the fields needed to detect anomalies"""
+
+    # None for metrics read from packed series, until it's looked up
+    id: Optional[int]
+    hour: datetime
+    anomaly_count: int
+    measurement_count: int
+
 
 @dataclasses.dataclass
 class IssueDescription:
     """Information describing an issue"""
 
     asn: ASN
-    metrics: List[Metric]
+    metrics: List[MetricRow]
     url: Url
     issue_type: IssueType
 
+    def to_dict(self) -> Dict[str, Any]:
+        """Serialize this issue into a json compatible dict, so it can be sent between tasks
+
+        Returns:
+            Dict[str, Any]: Issue with asn and url ids instead of instances, as expected by 'from_dicts'
+        """
+        return {
+            "asn_id": self.asn.id,
+            "url_id": self.url.id,
+            "issue_type": self.issue_type.value,
+            "metrics": [
+                [m.id, m.hour.isoformat(), m.anomaly_count, m.measurement_count]
+                for m in self.metrics
+            ],
+        }
+
+    def peak_ratio(self) -> float:
+        """Highest anomaly ratio among the metrics of this issue
+
+        Returns:
+            float: Anomaly count over measurement count for its worst hour, 0 if there's no measurement
+        """
+        return max(
+            (
+                m.anomaly_count / m.measurement_count
+                for m in self.metrics
+                if m.measurement_count
+            ),
+            default=0.0,
+        )
+
+    @classmethod
+    def from_dicts(cls, data: Iterable[Dict[str, Any]]) -> List["IssueDescription"]:
+        """Deserialize issues created with 'to_dict'. Asns and urls for every issue are loaded at once
+
+        Args:
+            data (Iterable[Dict[str, Any]]): Serialized issues
+
+        Returns:
+            List[IssueDescription]: Issues in the same order
+        """
+        data = list(data)
+        asns = ASN.objects.in_bulk({d["asn_id"] for d in data})
+        urls = Url.objects.in_bulk({d["url_id"] for d in data})
+
+        return [
+            cls(
+                asn=asns[d["asn_id"]],
+                metrics=[
+                    MetricRow(
+                        id=id,
+                        hour=datetime.fromisoformat(hour),
+                        anomaly_count=anomaly_count,
+                        measurement_count=measurement_count,
+                    )
+                    for (id, hour, anomaly_count, measurement_count) in d["metrics"]
+                ],
+                url=urls[d["url_id"]],
+                issue_type=IssueType(d["issue_type"]),
+            )
+            for d in data
+        ]
+
+
+def _to_counts(values: List[Optional[int]]) -> np.ndarray:
+    """Convert counts to an integer array, where missing counts are zero"""
+    try:
+        return np.array(values, dtype=np.int64)
+    except TypeError:
+        return np.array([v or 0 for v in values], dtype=np.int64)
+
+
+def _to_hours(times: Iterable[datetime], count: int) -> np.ndarray:
+    """Convert times to hours since epoch"""
+    return np.fromiter(
+        (int(t.timestamp()) // 3600 for t in times), dtype=np.int64, count=count
+    )
+
+
+class BatchDetection(NamedTuple):
+    """Issues found by the batch detector for a group of pairs"""
+
+    # Issue type for every pair
+    issue_types: List[IssueType]
+
+    # Indexes of offending metrics for all pairs, sorted by pair. Offending metrics for
+    # pair i are selected[bounds[i]:bounds[i + 1]]
+    selected: List[int]
+    bounds: List[int]
+
+    def offending(self, i: int) -> List[int]:
+        """Indexes of offending metrics for the i-th pair"""
+        return self.selected[self.bounds[i] : self.bounds[i + 1]]
+
+
+class BatchAnomalyDetector:
+    """Detect anomalies for many pairs of (asn, url) at once. Counts for every pair are loaded in
+    (pairs x metrics) matrices once, and a pipeline of detectors runs over them with a few array
+    operations each instead of a python loop per pair. Detectors are sorted by priority: every
+    pair gets the issue type of the first detector that flags it.
+
+    With the default pipeline, results are the same as running AnomalyMonitor.compute_anomaly on every pair
+    """
+
+    def __init__(
+        self,
+        spike_tolerance: float,
+        anomaly_ratio_avg_tolerance: float = 0.2,
+        detectors: Optional[List[Detector]] = None,
+    ):
+        """
+        Args:
+            spike_tolerance (float): Tolerance for spikes, like in AnomalyMonitor.compute_anomaly
+            anomaly_ratio_avg_tolerance (float): Tolerance for the average anomaly ratio, like in AnomalyMonitor.compute_anomaly
+            detectors (Optional[List[Detector]]): Detectors to run, by priority. Defaults to high anomaly rate and
+                spike detectors with the given tolerances.
+        """
+        if detectors is None:
+            detectors = [
+                HighAnomalyRateDetector(tolerance=anomaly_ratio_avg_tolerance),
+                SpikeDetector(tolerance=spike_tolerance),
+            ]
+
+        self._detectors = detectors
+
+    @property
+    def needs_hours(self) -> bool:
+        """If some detector in the pipeline needs the hour of every metric"""
+        return self.lookback_hours > 0 or any(d.needs_hours for d in self._detectors)
+
+    @property
+    def lookback_hours(self) -> int:
+        """Hours of metrics before the analized window needed by some detector in the pipeline"""
+        return max((d.lookback_hours for d in self._detectors), default=0)
+
+    def detect(
+        self, pairs: Iterable[Tuple[Tuple[ASN, Url], List[MetricRow]]]
+    ) -> List[IssueDescription]:
+        """Compute an issue for every given pair
+
+        Args:
+            pairs (Iterable[Tuple[Tuple[ASN, Url], List[MetricRow]]]): Every pair of asn and url with its metrics
+                sorted by hour, as returned by AnomalyMonitor._get_metrics_for_url_and_asn
+
+        Returns:
+            List[IssueDescription]: An issue for each pair, in the same order. Pairs without anomalies get an OK issue
+        """
+        pairs = list(pairs)
+        if not pairs:
+            return []
+
+        flat = [m for (_, metrics) in pairs for m in metrics]
+        detection = self.detect_arrays(
+            lengths=np.array([len(metrics) for (_, metrics) in pairs], dtype=np.int64),
+            measurement_counts=_to_counts(
+                list(map(attrgetter("measurement_count"), flat))
+            ),
+            anomaly_counts=_to_counts(list(map(attrgetter("anomaly_count"), flat))),
+            hours=_to_hours(map(attrgetter("hour"), flat), len(flat))
+            if self.needs_hours
+            else None,
+        )
+
+        return [
+            IssueDescription(
+                asn=asn,
+                metrics=[flat[k] for k in detection.offending(i)],
+                url=url,
+                issue_type=issue_type,
+            )
+            for (i, (((asn, url), _), issue_type)) in enumerate(
+                zip(pairs, detection.issue_types)
+            )
+        ]
+
+    def detect_arrays(
+        self,
+        lengths: np.ndarray,
+        measurement_counts: np.ndarray,
+        anomaly_counts: np.ndarray,
+        hours: Optional[np.ndarray] = None,
+        window_start: Optional[int] = None,
+    ) -> BatchDetection:
+        """Compute issues for pairs whose metrics are given as flat arrays, where metrics for
+        the same pair are contiguous and sorted by hour
+
+        Args:
+            lengths (np.ndarray): How many metrics there are for each pair
+            measurement_counts (np.ndarray): Measurement count for every metric
+            anomaly_counts (np.ndarray): Anomaly count for every metric
+            hours (Optional[np.ndarray]): Hours since epoch for every metric, only needed if 'needs_hours'
+            window_start (Optional[int]): Hour since epoch where the analized window starts. Earlier metrics
+                are only seen by detectors with a lookback, and never flagged. Defaults to every metric.
+
+        Returns:
+            BatchDetection: Issue type and indexes of offending metrics for every pair
+        """
+        batch = SeriesBatch.from_arrays(
+            lengths=lengths,
+            measurement_counts=measurement_counts,
+            anomaly_counts=anomaly_counts,
+            hours=hours,
+        )
+        n_pairs = len(lengths)
+
+        # Detectors without lookback only see metrics in the window
+        window_batch = batch
+        window_cells = None
+        if window_start is not None:
+            if hours is None:
+                raise ValueError(
+                    "The hour of every metric is needed to split the window"
+                )
+
+            in_window = hours >= window_start
+            window_batch = SeriesBatch.from_arrays(
+                lengths=np.bincount(batch.rows[in_window], minlength=n_pairs),
+                measurement_counts=measurement_counts[in_window],
+                anomaly_counts=anomaly_counts[in_window],
+                hours=hours[in_window],
+            )
+            window_cells = np.zeros(batch.ratios.shape, dtype=bool)
+            window_cells[batch.rows[in_window], batch.cols[in_window]] = True
+
+        # Index of the detector that flagged every pair, -1 if none did
+        flagged_by = np.full(n_pairs, -1, dtype=np.int64)
+        offending = np.zeros(batch.ratios.shape, dtype=bool)
+        for (i, detector) in enumerate(self._detectors):
+            if window_cells is None:
+                found = detector.detect(batch)
+            elif detector.lookback_hours:
+                found = detector.detect(batch) & window_cells
+            else:
+                found = np.zeros(batch.ratios.shape, dtype=bool)
+                found[window_cells] = detector.detect(window_batch)[
+                    window_batch.rows, window_batch.cols
+                ]
+
+            flagged = (flagged_by < 0) & found.any(axis=1)
+
+            flagged_by[flagged] = i
+            offending |= found & flagged[:, np.newaxis]
+
+        selected = np.flatnonzero(offending[batch.rows, batch.cols])
+        bounds = np.searchsorted(batch.rows[selected], np.arange(n_pairs + 1))
+
+        issue_types = [IssueType(d.issue_type) for d in self._detectors] + [
+            IssueType.OK
+        ]
+
+        return BatchDetection(
+            issue_types=[issue_types[i] for i in flagged_by.tolist()],
+            selected=selected.tolist(),
+            bounds=bounds.tolist(),
+        )
+
 
 class AnomalyMonitor:
     """Compute anomalies for each pair (asn, url), and update them in the database."""
@@ -90,24 +444,56 @@ class AnomalyMonitor:
         sender_mail: Optional[str] = SENDER_MAIL,
         sender_mail_pswd: Optional[str] = SENDER_MAIL_PSWD,
         mail_to_notify: Optional[str] = MAIL_TO_NOTIFY,
+        read_chunk_size: int = MONITOR_READ_CHUNK_SIZE,
+        batch_detection: bool = MONITOR_BATCH_DETECTION,
+        batch_rows: int = MONITOR_BATCH_ROWS,
+        shard_size: int = MONITOR_SHARD_SIZE,
+        parallelism: int = MONITOR_PARALLELISM,
+        hierarchical: bool = MONITOR_HIERARCHICAL,
+        drilldown_std: float = MONITOR_DRILLDOWN_STD,
+        detectors: List[str] = MONITOR_DETECTORS,
+        detector_options: Dict[str, Dict[str, Any]] = MONITOR_DETECTOR_OPTIONS,
+        digest_grouping: str = ALERT_DIGEST_GROUPING,
+        mailer: Optional[SmtpMailer] = None,
+        notification_queue: bool = NOTIFICATION_QUEUE,
+        dispatcher: Optional[NotificationDispatcher] = None,
+        alert_suppression: bool = ALERT_SUPPRESSION,
+        read_series: bool = METRIC_SERIES_STORAGE,
     ) -> None:
 
-        self._sender_mail = sender_mail
-        self._sender_mail_pswd = sender_mail_pswd
-        self._mail_to_notify = mail_to_notify
+        self._digest_grouping = DigestGrouping(digest_grouping)
+        self._mailer = mailer or SmtpMailer(
+            sender=sender_mail, password=sender_mail_pswd, recipient=mail_to_notify
+        )
+        self._notification_queue = notification_queue
+        self._dispatcher = dispatcher
+        self._alert_suppression = alert_suppression
+        self._read_chunk_size = read_chunk_size
+        self._batch_detection = batch_detection
+        self._batch_rows = batch_rows
+        self._shard_size = shard_size
+        self._parallelism = parallelism
+        self._hierarchical = hierarchical
+        self._drilldown_std = drilldown_std
+        self._detectors = detectors
+        self._detector_options = detector_options
+        self._series = MetricSeriesStore() if read_series else None
 
     def analize_db_metrics(
         self,
         start_time: Optional[datetime] = None,
         tolerance: float = TOLERANCE,
         should_act: bool = False,
+        should_report: bool = False,
     ) -> List[IssueDescription]:
         """Analize currently stored metrics in db, return the list of found issues
 
         Args:
             start_time (Optional[datetime], optional): The lastest time to look for metrics. Defaults to 24 hours ago.
             tolerance (float, optional): A tolerance value telling how much variation  in the anomaly rate to accept. Defaults to TOLERANCE.
-            should_act (bool, optional) : If should do something if issues are found. Defaults to False. 
+            should_act (bool, optional) : If should do something if issues are found. Defaults to False.
+            should_report (bool, optional) : If should store an AnomalyReport for every issue found. Reports are created
+                all at once at the end of the run, already reported issues are not stored again. Defaults to False.
         Raises:
             NotImplementedError: _description_
 
@@ -115,57 +501,662 @@ class AnomalyMonitor:
             List[IssueDescription]: _description_
         """
 
+        (start_time, end_time) = self.get_time_window(start_time)
+
+        # Return only if important
+        results = [
+            issue
+            for issue in self._compute_anomalies(
+                start_time=start_time, end_time=end_time, tolerance=tolerance
+            )
+            if issue.issue_type != IssueType.OK
+        ]
+
+        self.handle_issues(results, should_act=should_act, should_report=should_report)
+        return results
+
+    def analize_shard(
+        self,
+        start_time: datetime,
+        end_time: datetime,
+        url_range: Tuple[int, int],
+        tolerance: float = TOLERANCE,
+    ) -> List[IssueDescription]:
+        """Analize only metrics for urls in the given id range. Nothing is reported or notified,
+        so results for every shard can be merged and handled at once with 'handle_issues'
+
+        Args:
+            start_time (datetime): earliest date to look metrics from.
+            end_time (datetime): latest date to look metrics from.
+            url_range (Tuple[int, int]): First and last url id in this shard, as returned by 'plan_shards'
+            tolerance (float, optional): Spike tolerance. Defaults to TOLERANCE.
+
+        Returns:
+            List[IssueDescription]: Issues found in this shard, without OK issues
+        """
+        return [
+            issue
+            for issue in self._compute_anomalies(
+                start_time=start_time,
+                end_time=end_time,
+                tolerance=tolerance,
+                url_range=url_range,
+            )
+            if issue.issue_type != IssueType.OK
+        ]
+
+    def plan_shards(self) -> List[Tuple[int, int]]:
+        """Split urls in shards of contiguous ids. Every shard has about 'shard_size' urls,
+        but shards grow if needed so there's at most 'parallelism' of them
+
+        Returns:
+            List[Tuple[int, int]]: First and last url id for every shard, both included
+        """
+        url_ids = list(Url.objects.order_by("id").values_list("id", flat=True))
+        if not url_ids:
+            return []
+
+        size = max(self._shard_size, math.ceil(len(url_ids) / self._parallelism))
+        return [
+            (url_ids[i], url_ids[min(i + size, len(url_ids)) - 1])
+            for i in range(0, len(url_ids), size)
+        ]
+
+    def handle_issues(
+        self,
+        issues: List[IssueDescription],
+        should_act: bool = False,
+        should_report: bool = False,
+    ):
+        """Act on and report issues found in a run
+
+        Args:
+            issues (List[IssueDescription]): Issues found in a run
+            should_act (bool, optional): If should do something about these issues. Alerts are queued to be
+                delivered later if the notification queue is enabled, or sent right away otherwise. If alert
+                suppression is enabled, only new or escalated issues are notified. Defaults to False.
+            should_report (bool, optional): If should store an AnomalyReport for every issue. Already reported
+                issues are not stored again. Defaults to False.
+        """
+        # Act only if requested to
+        if should_act:
+            self._act(issues)
+
+        if should_report:
+            AnomalyReport.bulk_create_from_issue_descriptions(issues)
+
+    def _act(self, issues: List[IssueDescription]):
+        """Notify actionable issues, skipping ongoing issues that were already notified if suppression is enabled.
+        Alert state is only saved once alerts were sent or queued, so they're not lost if that fails
+
+        Args:
+            issues (List[IssueDescription]): Issues found in a run
+        """
+        alert_state = None
+        if self._alert_suppression:
+            now = datetime.now(tz=utc)
+            alert_state = AlertStateCache()
+            alert_state.warm(
+                (issue.url.id, issue.asn.id, issue.issue_type.value) for issue in issues
+            )
+            issues = [
+                issue
+                for issue in issues
+                if self.is_actionable(issue)
+                and alert_state.should_notify(
+                    issue.url.id,
+                    issue.asn.id,
+                    issue.issue_type.value,
+                    issue.peak_ratio(),
+                    now,
+                )
+            ]
+
+        if self._notification_queue:
+            self.enqueue_alerts(issues)
+        else:
+            self.dispatch_alerts(issues)
+
+        if alert_state is not None:
+            alert_state.save()
+
+    @staticmethod
+    def get_time_window(
+        start_time: Optional[datetime] = None,
+    ) -> Tuple[datetime, datetime]:
+        """Compute the interval of metrics to analize in a run
+
+        Args:
+            start_time (Optional[datetime], optional): The lastest time to look for metrics. Defaults to 24 hours ago.
+
+        Returns:
+            Tuple[datetime, datetime]: start and end time for metrics to analize
+        """
         # Defaults to 24 hours ago
         end_time = datetime.now(tz=utc) - timedelta(hours=1)
         start_time = start_time or end_time - timedelta(hours=24)
+        return (start_time, end_time)
+
+    def _compute_anomalies(
+        self,
+        start_time: datetime,
+        end_time: datetime,
+        tolerance: float,
+        url_range: Optional[Tuple[int, int]] = None,
+    ) -> Iterator[IssueDescription]:
+        """Compute an issue for every pair of (asn, url) with metrics from 'start_time' to 'end_time',
+        using the batch detector if enabled, or 'compute_anomaly' on each pair otherwise. In hierarchical
+        mode, only pairs selected by '_plan_drilldown' are checked. Metrics are read from packed daily
+        series if enabled
+
+        Args:
+            start_time (datetime): earliest date to look metrics from.
+            end_time (datetime): latest date to look metrics from.
+            tolerance (float): Spike tolerance
+            url_range (Optional[Tuple[int, int]]): Only compute issues for urls with ids in this range,
+                both included. Defaults to every url.
+
+        Returns:
+            Iterator[IssueDescription]: An issue for every checked pair with metrics
+        """
+        issues = self._detect_anomalies(start_time, end_time, tolerance, url_range)
+        if self._series is None:
+            return issues
+
+        return self._with_metric_ids(issues)
+
+    def _detect_anomalies(
+        self,
+        start_time: datetime,
+        end_time: datetime,
+        tolerance: float,
+        url_range: Optional[Tuple[int, int]] = None,
+    ) -> Iterator[IssueDescription]:
+        """Detect issues for '_compute_anomalies'. Offending metrics read from series have no id yet"""
+        pairs = None
+        if self._hierarchical:
+            pairs = self._plan_drilldown(start_time, end_time, tolerance, url_range)
+
+        if not self._batch_detection:
+            for ((asn, url), metric_list) in self._get_metrics_for_url_and_asn(
+                start_time=start_time,
+                end_time=end_time,
+                url_range=url_range,
+                pairs=pairs,
+            ):
+                yield self.compute_anomaly(
+                    asn=asn, url=url, metrics=metric_list, spike_tolerance=tolerance
+                )
+            return
+
+        asns = ASN.objects.in_bulk()
+        urls = self._get_urls(url_range)
+        detector = BatchAnomalyDetector(
+            spike_tolerance=tolerance, detectors=self._build_detectors(tolerance)
+        )
+        (read_since, window_start) = self._lookback(detector, start_time)
+
+        # Rows go straight from the database cursor to arrays, only offending metrics are built
+        for rows in self._iter_row_batches(
+            self._iter_metric_rows(read_since, end_time, url_range, pairs)
+        ):
+            url_ids = np.fromiter(
+                map(itemgetter(0), rows), dtype=np.int64, count=len(rows)
+            )
+            asn_ids = np.fromiter(
+                map(itemgetter(1), rows), dtype=np.int64, count=len(rows)
+            )
+            starts = np.flatnonzero(
+                np.concatenate(
+                    (
+                        [True],
+                        (url_ids[1:] != url_ids[:-1]) | (asn_ids[1:] != asn_ids[:-1]),
+                    )
+                )
+            )
+
+            detection = detector.detect_arrays(
+                lengths=np.diff(starts, append=len(rows)),
+                measurement_counts=_to_counts(list(map(itemgetter(5), rows))),
+                anomaly_counts=_to_counts(list(map(itemgetter(4), rows))),
+                hours=_to_hours(map(itemgetter(3), rows), len(rows))
+                if detector.needs_hours
+                else None,
+                window_start=window_start,
+            )
+
+            for (i, (start, issue_type)) in enumerate(
+                zip(starts.tolist(), detection.issue_types)
+            ):
+                (url_id, asn_id) = rows[start][:2]
+                yield IssueDescription(
+                    asn=asns[asn_id],
+                    metrics=[MetricRow(*rows[k][2:]) for k in detection.offending(i)],
+                    url=urls[url_id],
+                    issue_type=issue_type,
+                )
+
+    def _with_metric_ids(
+        self, issues: Iterator[IssueDescription]
+    ) -> Iterator[IssueDescription]:
+        """Fill in the ids of offending metrics read from packed daily series, which don't store them.
+        Ids are looked up for many issues at once, and only for offending metrics. Metrics that are
+        no longer stored, like hourly metrics pruned after being packed, are dropped from their issue,
+        and issues left without any of them are dropped too
+
+        Args:
+            issues (Iterator[IssueDescription]): Issues with offending metrics without id
+
+        Returns:
+            Iterator[IssueDescription]: The same issues with metric ids, if any of their metrics is still stored
+        """
+        while True:
+            chunk = list(islice(issues, self._read_chunk_size))
+            if not chunk:
+                return
+
+            offending = [issue for issue in chunk if issue.metrics]
+            ids: Dict[Tuple[int, int, datetime], int] = {}
+            if offending:
+                hours = [m.hour for issue in offending for m in issue.metrics]
+                metrics = Metric.objects.filter(
+                    url_id__in={issue.url.id for issue in offending},
+                    asn_id__in={issue.asn.id for issue in offending},
+                    hour__range=(min(hours), max(hours)),
+                ).values_list("url_id", "asn_id", "hour", "id")
+                ids = {
+                    (url_id, asn_id, hour): metric_id
+                    for (url_id, asn_id, hour, metric_id) in metrics.iterator(
+                        chunk_size=self._read_chunk_size
+                    )
+                }
+
+            for issue in offending:
+                keys = [(issue.url.id, issue.asn.id, m.hour) for m in issue.metrics]
+                issue.metrics = [
+                    m._replace(id=ids[key])
+                    for (m, key) in zip(issue.metrics, keys)
+                    if key in ids
+                ]
+
+            lost = {id(issue) for issue in offending if not issue.metrics}
+            yield from (issue for issue in chunk if id(issue) not in lost)
+
+    def _plan_drilldown(
+        self,
+        start_time: datetime,
+        end_time: datetime,
+        tolerance: float,
+        url_range: Optional[Tuple[int, int]] = None,
+    ) -> Q:
+        """Run the detectors on the aggregated series of every asn and every url list, and select
+        the pairs worth checking one by one: pairs under flagged aggregates, and pairs for urls
+        whose alert level is ALERT
+
+        Args:
+            start_time (datetime): earliest date to look metrics from.
+            end_time (datetime): latest date to look metrics from.
+            tolerance (float): Spike tolerance
+            url_range (Optional[Tuple[int, int]]): Only aggregate urls with ids in this range, both included.
+                Defaults to every url.
+
+        Returns:
+            Q: Filter for metrics of the selected pairs
+        """
+        detector = BatchAnomalyDetector(
+            spike_tolerance=tolerance, detectors=self._build_detectors(tolerance)
+        )
+        (read_since, window_start) = self._lookback(detector, start_time)
+
+        flagged_asns = self._flag_aggregates(
+            detector,
+            self._iter_aggregate_rows(read_since, end_time, "asn_id", url_range),
+            window_start,
+        )
+        flagged_lists = self._flag_aggregates(
+            detector,
+            self._iter_aggregate_rows(read_since, end_time, "url__lists", url_range),
+            window_start,
+        )
+
+        urls = Url.objects.filter(
+            Q(lists__id__in=flagged_lists) | Q(alert_level=Url.AlertCategory.ALERT)
+        )
+        return Q(asn_id__in=flagged_asns) | Q(url__id__in=urls.values("id"))
+
+    def _flag_aggregates(
+        self,
+        detector: BatchAnomalyDetector,
+        rows: Iterable[tuple],
+        window_start: Optional[int] = None,
+    ) -> List[int]:
+        """Find aggregates that should be drilled down: flagged by some detector, or with an hourly
+        anomaly ratio whose standard deviation is above the drill down threshold
+
+        Args:
+            detector (BatchAnomalyDetector): Detector to run on aggregated series
+            rows (Iterable[tuple]): (aggregate id, hour, anomaly count, measurement count) for every
+                hour with measurements, sorted by aggregate and hour, as returned by '_iter_aggregate_rows'
+            window_start (Optional[int]): Hour since epoch where the analized window starts, earlier
+                hours are only a baseline for detectors with a lookback. Defaults to every hour.
+
+        Returns:
+            List[int]: Ids of the aggregates to drill down
+        """
+        rows = list(rows)
+        if not rows:
+            return []
+
+        keys = np.fromiter(map(itemgetter(0), rows), dtype=np.int64, count=len(rows))
+        starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+        lengths = np.diff(starts, append=len(rows))
+        anomaly_counts = _to_counts(list(map(itemgetter(2), rows)))
+        measurement_counts = _to_counts(list(map(itemgetter(3), rows)))
+
+        hours = (
+            _to_hours(map(itemgetter(1), rows), len(rows))
+            if detector.needs_hours
+            else None
+        )
+
+        detection = detector.detect_arrays(
+            lengths=lengths,
+            measurement_counts=measurement_counts,
+            anomaly_counts=anomaly_counts,
+            hours=hours,
+            window_start=window_start,
+        )
+        suspicious = np.array(
+            [issue_type != IssueType.OK for issue_type in detection.issue_types]
+        )
+
+        # Volatility only counts hours in the window
+        in_window = np.ones(len(rows))
+        if window_start is not None:
+            in_window = (hours >= window_start).astype(np.float64)
+
+        ratios = anomaly_counts / measurement_counts
+        n_hours = np.maximum(np.add.reduceat(in_window, starts), 1)
+        mean = np.add.reduceat(ratios * in_window, starts) / n_hours
+        variance = (
+            np.add.reduceat(ratios**2 * in_window, starts) / n_hours - mean**2
+        )
+        volatile = variance > self._drilldown_std**2
+
+        return keys[starts][suspicious | volatile].tolist()
 
-        # Get metrics to analyze
-        metrics = self._get_metrics_for_url_and_asn(
-            start_time=start_time, end_time=end_time
+    def _iter_aggregate_rows(
+        self,
+        start_time: datetime,
+        end_time: datetime,
+        key: str,
+        url_range: Optional[Tuple[int, int]] = None,
+    ) -> Iterator[tuple]:
+        """Iterate over hourly metrics aggregated by the given key, summed by the database
+
+        Parameters:
+            start_time (datetime) : earliest date to look metrics from.
+            end_time (datetime) : latest date to look metrics from.
+            key (str) : field to aggregate by, like "asn_id" or "url__lists"
+            url_range (Optional[Tuple[int, int]]) : only metrics for urls with ids in this range, both included
+
+        Returns:
+            Iterator[tuple]: (key, hour, anomaly count, measurement count) for every aggregate and hour, sorted by key and hour
+        """
+        if self._series is not None:
+            return self._iter_series_aggregate_rows(
+                start_time, end_time, key, url_range
+            )
+
+        metrics = Metric.objects.filter(
+            hour__gte=start_time,
+            hour__lte=end_time,
+            measurement_count__gt=0,
+            **{f"{key}__isnull": False},
         )
+        if url_range is not None:
+            metrics = metrics.filter(url__id__range=url_range)
 
-        results = []
-        for ((asn, url), metric_list) in metrics.items():
-            issue = self.compute_anomaly(
-                asn=asn, url=url, metrics=metric_list, spike_tolerance=tolerance
+        return (
+            metrics.values(key, "hour")
+            .annotate(
+                anomalies=Sum("anomaly_count"), measurements=Sum("measurement_count")
             )
-            # Return only if important
-            if issue.issue_type != IssueType.OK:
-                results.append(issue)
+            .order_by(key, "hour")
+            .values_list(key, "hour", "anomalies", "measurements")
+            .iterator()
+        )
 
-            # Act only if requested to
-            if should_act:
-                self.act(issue)
+    def _iter_series_aggregate_rows(
+        self,
+        start_time: datetime,
+        end_time: datetime,
+        key: str,
+        url_range: Optional[Tuple[int, int]] = None,
+    ) -> Iterator[tuple]:
+        """Same as '_iter_aggregate_rows', adding up packed daily series instead of hourly metrics"""
+        (since, until) = self._series_interval(start_time, end_time)
+        n_hours = int((until - since) / timedelta(hours=1))
+
+        # Series only know their url, so url lists are resolved here
+        url_lists: Dict[int, List[int]] = {}
+        if key == "url__lists":
+            for (url_id, list_id) in Url.lists.through.objects.values_list(
+                "url_id", "urllist_id"
+            ):
+                url_lists.setdefault(url_id, []).append(list_id)
+
+        totals: Dict[int, Tuple[np.ndarray, np.ndarray]] = {}
+        for series in self._series.read(since, until, url_range=url_range):
+            if key == "url__lists":
+                keys = url_lists.get(series.url_id, [])
+            else:
+                keys = [getattr(series, key)]
+
+            for k in keys:
+                (anomalies, measurements) = totals.setdefault(
+                    k, (np.zeros(n_hours, np.int64), np.zeros(n_hours, np.int64))
+                )
+                anomalies += np.asarray(series.anomaly_counts)
+                measurements += np.asarray(series.measurement_counts)
+
+        for k in sorted(totals):
+            (anomalies, measurements) = totals[k]
+            for i in np.flatnonzero(measurements).tolist():
+                yield (
+                    k,
+                    since + timedelta(hours=i),
+                    int(anomalies[i]),
+                    int(measurements[i]),
+                )
+
+    @staticmethod
+    def _lookback(
+        detector: BatchAnomalyDetector, start_time: datetime
+    ) -> Tuple[datetime, Optional[int]]:
+        """Where to start reading metrics for the window starting at 'start_time', so every detector
+        gets its lookback
 
-        return results
+        Returns:
+            Tuple[datetime, Optional[int]]: Time to read metrics from, and hour since epoch where the window
+                starts if some detector needs a lookback, None otherwise
+        """
+        if not detector.lookback_hours:
+            return (start_time, None)
 
-    def _get_metrics_for_url_and_asn(
-        self, start_time: datetime, end_time: datetime
-    ) -> Dict[Tuple[ASN, Url], List[Metric]]:
-        """Built a mapping from (ASN, URL) to a list of metrics starting from 'start_time'
+        window_start = math.ceil(start_time.timestamp() / 3600)
+        return (start_time - timedelta(hours=detector.lookback_hours), window_start)
+
+    def _build_detectors(self, tolerance: float) -> List[Detector]:
+        """Create the configured detectors for a run
+
+        Args:
+            tolerance (float): Spike tolerance for this run, it overrides the configured one
+
+        Returns:
+            List[Detector]: Detectors to run, by priority
+        """
+        detectors = []
+        for name in self._detectors:
+            options = dict(self._detector_options.get(name, {}))
+            if name == SpikeDetector.name:
+                options["tolerance"] = tolerance
+
+            detectors.append(create_detector(name, **options))
+
+        return detectors
+
+    def _iter_row_batches(self, rows: Iterator[tuple]) -> Iterator[List[tuple]]:
+        """Split metric rows sorted by pair in batches of about MONITOR_BATCH_ROWS rows,
+        without splitting the rows of any pair across batches
+
+        Args:
+            rows (Iterator[tuple]): Metric rows as returned by '_iter_metric_rows'
+
+        Returns:
+            Iterator[List[tuple]]: Batches of rows with complete pairs
+        """
+        carry = []
+        while True:
+            new_rows = list(islice(rows, self._batch_rows))
+            batch = carry + new_rows
+            if len(new_rows) < self._batch_rows:
+                if batch:
+                    yield batch
+                return
+
+            # The last pair might continue in the next rows, so it's kept for the next batch
+            last_pair = batch[-1][:2]
+            split = len(batch) - 1
+            while split > 0 and batch[split - 1][:2] == last_pair:
+                split -= 1
+
+            if split:
+                yield batch[:split]
+            carry = batch[split:]
+
+    def _iter_metric_rows(
+        self,
+        start_time: datetime,
+        end_time: datetime,
+        url_range: Optional[Tuple[int, int]] = None,
+        pairs: Optional[Q] = None,
+    ) -> Iterator[tuple]:
+        """Iterate over metrics with measurements from 'start_time' to 'end_time' in a single
+        query sorted by url, asn and hour, streamed from the database cursor
 
         Parameters:
-            start_time (Optional[datetime]) : latest date to look metrics from.
-            start_time (Optional[datetime]) : earliest date to look metrics from.
+            start_time (datetime) : earliest date to look metrics from.
+            end_time (datetime) : latest date to look metrics from.
+            url_range (Optional[Tuple[int, int]]) : only metrics for urls with ids in this range, both included
+            pairs (Optional[Q]) : only metrics matching this filter, like the pairs selected by '_plan_drilldown'
 
         Returns:
-            Dict[Tuple[ASN, Url], List[Metric]]: Return a Dict mapping from a tuple of ASN and a list of metrics. Every metric holds:
-            start_time <= metric.hour <= end_time
+            Iterator[tuple]: (url id, asn id, metric id, hour, anomaly count, measurement count) for every metric
         """
-        asns = ASN.objects.all()
-        urls = Url.objects.all()
+        if self._series is not None:
+            return self._iter_series_rows(start_time, end_time, url_range, pairs)
 
-        result = {}
-        for (url, asn) in product(urls, asns):
-            result[(asn, url)] = Metric.objects.all().filter(
-                url=url, asn=asn, hour__gte=start_time, hour__lte=end_time
+        metrics = Metric.objects.filter(
+            hour__gte=start_time, hour__lte=end_time, measurement_count__gt=0
+        )
+        if url_range is not None:
+            metrics = metrics.filter(url__id__range=url_range)
+        if pairs is not None:
+            metrics = metrics.filter(pairs)
+
+        return (
+            metrics.order_by("url_id", "asn_id", "hour")
+            .values_list(
+                "url_id", "asn_id", "id", "hour", "anomaly_count", "measurement_count"
             )
+            .iterator(chunk_size=self._read_chunk_size)
+        )
+
+    def _iter_series_rows(
+        self,
+        start_time: datetime,
+        end_time: datetime,
+        url_range: Optional[Tuple[int, int]] = None,
+        pairs: Optional[Q] = None,
+    ) -> Iterator[tuple]:
+        """Same as '_iter_metric_rows', reading hours with measurements from packed daily series.
+        Series don't store metric ids, so they're always None
+        """
+        (since, until) = self._series_interval(start_time, end_time)
+        for series in self._series.read(since, until, url_range=url_range, pairs=pairs):
+            for (hour, anomaly_count, measurement_count) in zip(
+                series.hours(), series.anomaly_counts, series.measurement_counts
+            ):
+                if measurement_count:
+                    yield (
+                        series.url_id,
+                        series.asn_id,
+                        None,
+                        hour,
+                        anomaly_count,
+                        measurement_count,
+                    )
+
+    @staticmethod
+    def _series_interval(
+        start_time: datetime, end_time: datetime
+    ) -> Tuple[datetime, datetime]:
+        """Exact hours to read from series for metrics from 'start_time' to 'end_time', both included
+
+        Returns:
+            Tuple[datetime, datetime]: First hour and the hour after the last one
+        """
+        (start_time, end_time) = (start_time.astimezone(utc), end_time.astimezone(utc))
+        since = start_time.replace(minute=0, second=0, microsecond=0)
+        if since < start_time:
+            since += timedelta(hours=1)
+
+        until = end_time.replace(minute=0, second=0, microsecond=0)
+        return (since, until + timedelta(hours=1))
+
+    def _get_metrics_for_url_and_asn(
+        self,
+        start_time: datetime,
+        end_time: datetime,
+        url_range: Optional[Tuple[int, int]] = None,
+        pairs: Optional[Q] = None,
+    ) -> Iterator[Tuple[Tuple[ASN, Url], List[MetricRow]]]:
+        """Iterate over every pair of (ASN, URL) with metrics from 'start_time' to 'end_time'.
+        Metrics are requested in a single query sorted by url, asn and hour, and grouped
+        by pair while they're read, so only one pair is kept in memory at a time
+
+        Parameters:
+            start_time (datetime) : earliest date to look metrics from.
+            end_time (datetime) : latest date to look metrics from.
+            url_range (Optional[Tuple[int, int]]) : only metrics for urls with ids in this range, both included
+            pairs (Optional[Q]) : only metrics matching this filter, like the pairs selected by '_plan_drilldown'
+
+        Returns:
+            Iterator[Tuple[Tuple[ASN, Url], List[MetricRow]]]: Every pair of ASN and URL with its metrics, sorted by hour.
+            Every metric holds start_time <= metric.hour <= end_time and has measurements. Pairs without such
+            metrics are skipped
+        """
+        asns = ASN.objects.in_bulk()
+        urls = self._get_urls(url_range)
 
-        return result
+        rows = self._iter_metric_rows(start_time, end_time, url_range, pairs)
+        for ((url_id, asn_id), group) in groupby(rows, key=lambda row: row[:2]):
+            metrics = [MetricRow(*row[2:]) for row in group]
+            yield ((asns[asn_id], urls[url_id]), metrics)
+
+    @staticmethod
+    def _get_urls(url_range: Optional[Tuple[int, int]] = None) -> Dict[int, Url]:
+        """Load urls by id, only the ones in the given id range if provided"""
+        urls = Url.objects.all()
+        if url_range is not None:
+            urls = urls.filter(id__range=url_range)
+
+        return urls.in_bulk()
 
     def compute_anomaly(
         self,
-        metrics: List[Metric],
+        metrics: List[MetricRow],
         spike_tolerance: float,
         asn: ASN,
         url: Url,
@@ -178,7 +1169,7 @@ class AnomalyMonitor:
         and computing the mean and variance of the anomaly ratio at each hoyr
 
         Args:
-            metrics (List[Metric]): A list of metrics to check for anomalies. It is expected that all of them
+            metrics (List[MetricRow]): A list of metrics to check for anomalies. It is expected that all of them
             will have the same asn and url, but this is not actually checked for performance reasons
 
             should_sort (bool) : Sort the provided list of metrics to ascending order by hour if true.  Defaults to false.
@@ -190,6 +1181,9 @@ class AnomalyMonitor:
             IssueType: The type of issue detected on the given set of metrics
         """
 
+        # Metrics without measurements have no anomaly ratio
+        metrics = [m for m in metrics if m.measurement_count]
+
         # Quit if nothing to do
         ok_issue = IssueDescription(
             asn=asn, metrics=[], url=url, issue_type=IssueType.OK
@@ -240,16 +1234,158 @@ class AnomalyMonitor:
             issue (IssueDescription): An issue, namely an anomaly and its corresponding data
         """
 
-        if IssueType.OK == issue.issue_type:
-            return  # Do nothing about it if everything ok
-
-        if issue.url.alert_level != Url.AlertCategory.ALERT:
-            return  # Do nothing about it if alert level won't require it
+        if not self.is_actionable(issue):
+            return
 
         # If important enough to mail it, then compose email and send it
         title, mail_content = self._compose_mail(issue)
         self._send_mail(title, mail_content)
 
+    def dispatch_alerts(self, issues: List[IssueDescription]) -> int:
+        """Send alerts for every actionable issue from a run, grouped in digests as configured.
+        Every digest is sent over the same SMTP connection
+
+        Args:
+            issues (List[IssueDescription]): Issues found in a run
+
+        Returns:
+            int: How many mails were sent
+        """
+        alerts = self._compose_alerts(issues)
+        if not alerts:
+            return 0
+
+        with self._mailer.session() as session:
+            for (title, message, _) in alerts:
+                session.send(title, message)
+
+            return session.sent
+
+    def enqueue_alerts(self, issues: List[IssueDescription]) -> int:
+        """Queue alerts for every actionable issue from a run, grouped in digests as configured.
+        They're delivered later for every notification channel by the notification dispatcher
+
+        Args:
+            issues (List[IssueDescription]): Issues found in a run
+
+        Returns:
+            int: How many notifications were queued, counting every channel
+        """
+        alerts = self._compose_alerts(issues)
+        if not alerts:
+            return 0
+
+        dispatcher = self._dispatcher or NotificationDispatcher()
+        notifications = dispatcher.enqueue(
+            [
+                (title, message, [issue.to_dict() for issue in alert_issues])
+                for (title, message, alert_issues) in alerts
+            ]
+        )
+        return len(notifications)
+
+    def _compose_alerts(
+        self, issues: List[IssueDescription]
+    ) -> List[Tuple[str, str, List[IssueDescription]]]:
+        """Compose a digest for every group of actionable issues
+
+        Args:
+            issues (List[IssueDescription]): Issues found in a run
+
+        Returns:
+            List[Tuple[str, str, List[IssueDescription]]]: title, message and issues for every digest
+        """
+        actionable = [issue for issue in issues if self.is_actionable(issue)]
+
+        alerts = []
+        for (group, group_issues) in self._group_issues(actionable):
+            if self._digest_grouping == DigestGrouping.NONE:
+                (title, message) = self._compose_mail(group_issues[0])
+            else:
+                (title, message) = self._compose_digest(group, group_issues)
+
+            alerts.append((title, message, group_issues))
+
+        return alerts
+
+    @staticmethod
+    def is_actionable(issue: IssueDescription) -> bool:
+        """Check if something should be done about an issue
+
+        Args:
+            issue (IssueDescription): An issue
+
+        Returns:
+            bool: If it's an actual issue, on an url whose alert level requires it
+        """
+        if IssueType.OK == issue.issue_type:
+            return False  # Do nothing about it if everything ok
+
+        # Do nothing about it if alert level won't require it
+        return issue.url.alert_level == Url.AlertCategory.ALERT
+
+    def _group_issues(
+        self, issues: List[IssueDescription]
+    ) -> List[Tuple[str, List[IssueDescription]]]:
+        """Group issues in digests using the configured grouping
+
+        Args:
+            issues (List[IssueDescription]): Issues to group
+
+        Returns:
+            List[Tuple[str, List[IssueDescription]]]: Name and issues for every digest
+        """
+        if self._digest_grouping == DigestGrouping.NONE:
+            return [(issue.url.url, [issue]) for issue in issues]
+
+        groups: Dict[str, List[IssueDescription]] = {}
+        if self._digest_grouping == DigestGrouping.ASN:
+            for issue in issues:
+                name = f"asn {issue.asn.name or issue.asn.code}"
+                groups.setdefault(name, []).append(issue)
+
+        elif self._digest_grouping == DigestGrouping.SEVERITY:
+            for issue in sorted(issues, key=lambda i: -i.issue_type.severity):
+                name = f"{SEVERITY_NAMES[issue.issue_type.severity]} severity issues"
+                groups.setdefault(name, []).append(issue)
+
+        elif self._digest_grouping == DigestGrouping.URL_LIST:
+            # Lists for every url, in a single query
+            url_lists: Dict[int, List[str]] = {}
+            for (url_id, name) in UrlList.objects.filter(
+                url__in={issue.url.id for issue in issues}
+            ).values_list("url", "name"):
+                url_lists.setdefault(url_id, []).append(name)
+
+            for issue in issues:
+                for name in url_lists.get(issue.url.id, [None]):
+                    name = f"list {name}" if name else "urls without list"
+                    groups.setdefault(name, []).append(issue)
+
+        return list(groups.items())
+
+    def _compose_digest(
+        self, group: str, issues: List[IssueDescription]
+    ) -> Tuple[str, str]:
+        """Compose an email describing every issue in a digest
+
+        Args:
+            group (str): Name of the digest group
+            issues (List[IssueDescription]): Issues in this digest
+
+        Returns:
+            Tuple[str, str]: title, and a summary followed by the description of every issue
+        """
+        email_title = f"ALERT: {len(issues)} issue(s) for {group}"
+
+        summary = "\n".join(
+            f"\t- [{issue.issue_type.human_readable}] On {issue.url.url} for {issue.asn.name or issue.asn.code}"
+            for issue in issues
+        )
+        details = "\n\n".join(self._compose_mail(issue)[1] for issue in issues)
+
+        return email_title, f"Issues found:\n{summary}\n\n{details}"
+
     def _compose_mail(self, issue: IssueDescription) -> Tuple[str, str]:
         """Compose an email describing the provided issue. Return a string with the message to send
 
@@ -259,15 +1395,11 @@ class AnomalyMonitor:
         Returns:
             Tuple[str, str]: title, and a string with a message explaining the specified issue in an human readable manner
         """
-        assert issue.metrics
-
-        sample_issue = issue.metrics[0]
-
         issue_description = issue.issue_type.description
         issue_name = issue.issue_type.human_readable
 
         email_title = f"ALERT: [{issue_name}] On {issue.url.url} for {issue.asn.name or issue.asn.code}"
-        email_content = f"{issue_description}, on url '{sample_issue.url.url}' for asn '{sample_issue.asn.name}' ('{sample_issue.asn.code}')\nAlarming metric(s): \n"
+        email_content = f"{issue_description}, on url '{issue.url.url}' for asn '{issue.asn.name}' ('{issue.asn.code}')\nAlarming metric(s): \n"
 
         email_content = email_content + "\n".join(
             [
@@ -276,6 +1408,9 @@ class AnomalyMonitor:
             ]
         )
 
+        if not issue.metrics:
+            return email_title, email_content
+
         avg_anomaly_ratio = sum(
             m.anomaly_count / m.measurement_count for m in issue.metrics
         ) / len(issue.metrics)
@@ -287,24 +1422,4 @@ class AnomalyMonitor:
         return email_title, email_content
 
     def _send_mail(self, title: str, message: str):
-
-        sender = self._sender_mail
-        reciever = self._mail_to_notify
-        psswd = self._sender_mail_pswd
-
-        print(sender, psswd)
-
-        # Don't try anything if parameters are not properly configured
-        if not psswd or not reciever or not sender:
-            raise ValueError(
-                f"Can't send email because there's a missing configuration parameter"
-            )
-
-        msg = f"Subject: {title}\n\n{message}"
-
-        # set up email server config
-        port = 465
-        context = ssl.create_default_context()
-        with smtplib.SMTP_SSL("smtp.gmail.com", port, context=context) as server:
-            server.login(sender, psswd)
-            server.sendmail(sender, reciever, msg)
+        self._mailer.send(title, message)
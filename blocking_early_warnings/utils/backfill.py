@@ -0,0 +1,132 @@
+"""
+    Historical metrics backfill, split in day-sized units that can be processed in parallel
+"""
+# Django imports
+from django.db.models import Q
+from django.utils import timezone
+
+# Local imports
+from blocking_early_warnings.models import BackfillUnit
+from blocking_early_warnings.settings import BACKFILL_STALE_SECONDS, COUNTRY_CODE
+from blocking_early_warnings.utils.ooni_requests import DBMetricsClient
+
+# Python imports
+from datetime import date, datetime, timedelta
+from pytz import utc
+from typing import List, Optional
+
+
+class Backfiller:
+    """Fill metrics for days further back than the regular sync window. Every day is
+    tracked by a BackfillUnit, so completed days are skipped when a backfill is run again.
+    Units are claimed atomically before running them, so a day is never synced by
+    many workers at once, unless its worker is gone for longer than the stale timeout
+    """
+
+    def __init__(
+        self,
+        country_code: str = COUNTRY_CODE,
+        client: Optional[DBMetricsClient] = None,
+        stale_seconds: float = BACKFILL_STALE_SECONDS,
+    ):
+        """
+        Args:
+            country_code (str): Country to backfill. Defaults to COUNTRY_CODE.
+            client (Optional[DBMetricsClient]): Client to sync every day with. Defaults to a new client for the country.
+            stale_seconds (float): Running units started this many seconds ago are considered abandoned,
+                and can be run again. Defaults to BACKFILL_STALE_SECONDS.
+        """
+        self._country_code = country_code
+        self._client = client or DBMetricsClient(country_code=country_code)
+        self._stale = timedelta(seconds=stale_seconds)
+
+    def plan(self, since: date, until: date) -> List[BackfillUnit]:
+        """Create a unit for every day from "since" to "until" (both included) and
+        return the ones that are still not done, nor running in another worker
+
+        Args:
+            since (date): First day to backfill
+            until (date): Last day to backfill
+
+        Returns:
+            List[BackfillUnit]: Units to process, sorted by day
+        """
+        assert since <= until, f"Invalid backfill interval: {since} is after {until}"
+
+        n_days = (until - since).days + 1
+        BackfillUnit.objects.bulk_create(
+            [
+                BackfillUnit(
+                    country_code=self._country_code, day=since + timedelta(days=i)
+                )
+                for i in range(n_days)
+            ],
+            ignore_conflicts=True,
+        )
+
+        return list(
+            BackfillUnit.objects.filter(
+                self._runnable(),
+                country_code=self._country_code,
+                day__gte=since,
+                day__lte=until,
+            ).order_by("day")
+        )
+
+    def run_unit(self, unit_id: int) -> bool:
+        """Sync metrics for the day represented by the given unit, unless it's already done
+        or running in another worker
+
+        Args:
+            unit_id (int): Id of the unit to process
+
+        Returns:
+            bool: If the unit was run
+        """
+        # Claiming and checking the status in a single update, so only one worker takes it
+        claimed = BackfillUnit.objects.filter(self._runnable(), id=unit_id).update(
+            status=BackfillUnit.Status.RUNNING, started_at=timezone.now()
+        )
+        if not claimed:
+            return False
+
+        unit = BackfillUnit.objects.get(id=unit_id)
+
+        since = datetime(unit.day.year, unit.day.month, unit.day.day, tzinfo=utc)
+        try:
+            self._client.sync_interval(since=since, until=since + timedelta(days=1))
+        except Exception:
+            self._set_status(unit, BackfillUnit.Status.FAILED)
+            raise
+
+        unit.completed_at = timezone.now()
+        self._set_status(unit, BackfillUnit.Status.DONE)
+        return True
+
+    def run(self, since: date, until: date):
+        """Process every pending unit from "since" to "until" in this process, one after another.
+        Use the backfill celery task to process them in parallel across workers instead
+
+        Args:
+            since (date): First day to backfill
+            until (date): Last day to backfill
+        """
+        for unit in self.plan(since, until):
+            self.run_unit(unit.id)
+
+    def _runnable(self) -> Q:
+        """Filter for units that can be run: pending, failed, or running for too long"""
+        return Q(
+            status__in=[BackfillUnit.Status.PENDING, BackfillUnit.Status.FAILED]
+        ) | Q(
+            status=BackfillUnit.Status.RUNNING,
+            started_at__lt=timezone.now() - self._stale,
+        )
+
+    @staticmethod
+    def _set_status(unit: BackfillUnit, status: str):
+        """Update the status of a unit, unless another worker took it again since this one did"""
+        unit.status = status
+        BackfillUnit.objects.filter(id=unit.id, started_at=unit.started_at).update(
+            status=unit.status, completed_at=unit.completed_at
+        )
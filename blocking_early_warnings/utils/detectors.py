@@ -0,0 +1,477 @@
+"""
+    Vectorized anomaly detectors. Every detector works on the metrics of many (asn, url) pairs
+    at once, and registers the issue type it reports along with its description
+"""
+
+# Local imports
+from blocking_early_warnings.settings import TOLERANCE
+
+# Python imports
+from dataclasses import dataclass
+from typing import Any, Dict, NamedTuple, Optional, Type
+import numpy as np
+
+HOURS_PER_WEEK = 7 * 24
+
+
+@dataclass
+class SeriesBatch:
+    """Metrics for many pairs, loaded in (pairs x metrics) matrices. Metrics for every pair are
+    packed to the left in the same order they were given, so column j is the j-th metric of the
+    pair, not a fixed hour. Cells after the last metric of a pair have no measurements
+    """
+
+    # How many metrics there are for each pair
+    lengths: np.ndarray
+
+    # Row and column for every given metric
+    rows: np.ndarray
+    cols: np.ndarray
+
+    measurements: np.ndarray
+    anomalies: np.ndarray
+
+    # Cells with measurements, and how many of them there are per pair
+    valid: np.ndarray
+    n_valid: np.ndarray
+
+    # Anomaly ratio for every cell, zero if there are no measurements
+    ratios: np.ndarray
+
+    # Mean and sample variance of the anomaly ratio per pair
+    avg: np.ndarray
+    var: np.ndarray
+
+    # Hours since epoch for every cell, only if requested by some detector
+    hours: Optional[np.ndarray] = None
+
+    @classmethod
+    def from_arrays(
+        cls,
+        lengths: np.ndarray,
+        measurement_counts: np.ndarray,
+        anomaly_counts: np.ndarray,
+        hours: Optional[np.ndarray] = None,
+    ) -> "SeriesBatch":
+        """Load metrics given as flat arrays, where metrics for the same pair are contiguous
+        and sorted by hour
+
+        Args:
+            lengths (np.ndarray): How many metrics there are for each pair
+            measurement_counts (np.ndarray): Measurement count for every metric
+            anomaly_counts (np.ndarray): Anomaly count for every metric
+            hours (Optional[np.ndarray]): Hours since epoch for every metric. Defaults to None.
+
+        Returns:
+            SeriesBatch: Matrices and statistics for every pair
+        """
+        n_pairs = len(lengths)
+        n_metrics = len(measurement_counts)
+
+        # Every metric goes to the row for its pair, in the column for its position in the pair.
+        # Statistics only depend on each pair's own metrics, so they're packed to the left instead
+        # of aligned by hour, and no time arithmetic is needed
+        rows = np.repeat(np.arange(n_pairs), lengths)
+        cols = np.arange(n_metrics) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+        # Missing hours have no measurements, so they're handled like metrics without measurements
+        shape = (n_pairs, max(lengths.max(initial=0), 1))
+        measurements = np.zeros(shape, dtype=np.int64)
+        anomalies = np.zeros(shape, dtype=np.int64)
+        measurements[rows, cols] = measurement_counts
+        anomalies[rows, cols] = anomaly_counts
+
+        valid = measurements > 0
+        n_valid = valid.sum(axis=1)
+        ratios = np.divide(
+            anomalies, measurements, out=np.zeros(shape, dtype=np.float64), where=valid
+        )
+
+        # Sums are accumulated from left to right, like python's sum, so results are exactly the
+        # same as AnomalyMonitor.compute_anomaly and comparisons against tolerances don't change
+        avg = np.cumsum(ratios, axis=1)[:, -1] / np.maximum(n_valid, 1)
+        squared_deviations = np.where(valid, (ratios - avg[:, np.newaxis]) ** 2, 0.0)
+        var = np.where(
+            n_valid > 1,
+            np.cumsum(squared_deviations, axis=1)[:, -1] / np.maximum(n_valid - 1, 1),
+            0.0,
+        )
+
+        hour_matrix = None
+        if hours is not None:
+            hour_matrix = np.zeros(shape, dtype=np.int64)
+            hour_matrix[rows, cols] = hours
+
+        return cls(
+            lengths=lengths,
+            rows=rows,
+            cols=cols,
+            measurements=measurements,
+            anomalies=anomalies,
+            valid=valid,
+            n_valid=n_valid,
+            ratios=ratios,
+            avg=avg,
+            var=var,
+            hours=hour_matrix,
+        )
+
+    def masked_median(self, values: np.ndarray) -> np.ndarray:
+        """Median per pair of the given matrix, using only cells with measurements. Zero for pairs without them"""
+        if values.shape[1] == 0:
+            return np.zeros(values.shape[0])
+
+        # Invalid cells are sorted after every valid one, so the median is taken from the first n_valid cells
+        ordered = np.sort(np.where(self.valid, values, np.inf), axis=1)
+        n = np.maximum(self.n_valid, 1)
+        pairs = np.arange(values.shape[0])
+        low = ordered[pairs, (n - 1) // 2]
+        high = ordered[pairs, n // 2]
+        return np.where(self.n_valid > 0, (low + high) / 2, 0.0)
+
+
+class Detector:
+    """Base class for anomaly detectors. Subclasses should define a unique 'name', the value for
+    the issue type they report with its description and human readable name, and implement 'detect'.
+    Register them with 'register_detector' so they can be used in the monitor pipeline
+    """
+
+    name: str = ""
+    issue_type: str = ""
+    description: str = ""
+    human_readable: str = ""
+
+    # How serious reported issues are, from 1 (low) to 3 (high)
+    severity: int = 1
+
+    # If this detector needs the hour of every metric in the batch
+    needs_hours: bool = False
+
+    # Hours of metrics before the analized window this detector needs as baseline. They're
+    # loaded along with the window, but only metrics in the window can be flagged
+    lookback_hours: int = 0
+
+    def detect(self, batch: SeriesBatch) -> np.ndarray:
+        """Find offending metrics for every pair in the batch
+
+        Args:
+            batch (SeriesBatch): Metrics for many pairs
+
+        Returns:
+            np.ndarray: Boolean matrix with the same shape as the batch, true for offending metrics.
+                A pair has an issue if it has any offending metric
+        """
+        raise NotImplementedError
+
+
+# Registered detectors by name
+DETECTORS: Dict[str, Type[Detector]] = {}
+
+
+class IssueTypeInfo(NamedTuple):
+    """Information registered for an issue type"""
+
+    description: str
+    human_readable: str
+    severity: int
+
+
+# Information for every issue type reported by a registered detector, by value
+ISSUE_TYPES: Dict[str, IssueTypeInfo] = {}
+
+
+def register_detector(detector: Type[Detector]) -> Type[Detector]:
+    """Register a detector class, along with the issue type it reports. Can be used as a decorator
+
+    Args:
+        detector (Type[Detector]): Detector class to register
+
+    Returns:
+        Type[Detector]: The same class
+    """
+    assert detector.name, f"Detector '{detector}' should have a name"
+    assert (
+        detector.name not in DETECTORS
+    ), f"There's already a detector named '{detector.name}'"
+    assert (
+        detector.issue_type and detector.description and detector.human_readable
+    ), f"Detector '{detector.name}' should have an issue type, a description and a human readable name"
+
+    DETECTORS[detector.name] = detector
+    ISSUE_TYPES[detector.issue_type] = IssueTypeInfo(
+        description=detector.description,
+        human_readable=detector.human_readable,
+        severity=detector.severity,
+    )
+    return detector
+
+
+def create_detector(name: str, **options: Any) -> Detector:
+    """Create a registered detector by name
+
+    Args:
+        name (str): Name of a registered detector
+        options: Parameters for the detector
+
+    Raises:
+        ValueError: If there's no detector with such name
+
+    Returns:
+        Detector: A new detector instance
+    """
+    if name not in DETECTORS:
+        raise ValueError(
+            f"Unknown detector: '{name}'. Available detectors: {', '.join(DETECTORS)}"
+        )
+
+    return DETECTORS[name](**options)
+
+
+@register_detector
+class HighAnomalyRateDetector(Detector):
+    """Flag pairs whose average anomaly ratio is above a tolerance. Every metric with measurements is offending"""
+
+    name = "high_anomaly_rate"
+    issue_type = "high_anomaly_rate"
+    description = "There is a high amount of anomalies in multiple metrics"
+    human_readable = "High anomaly rate"
+    severity = 3
+
+    def __init__(self, tolerance: float = 0.2):
+        """
+        Args:
+            tolerance (float): Max average anomaly ratio for a pair. Defaults to 0.2.
+        """
+        self._tolerance = tolerance
+
+    def detect(self, batch: SeriesBatch) -> np.ndarray:
+        high_anomaly_rate = (batch.n_valid > 0) & (batch.avg > self._tolerance)
+        return batch.valid & high_anomaly_rate[:, np.newaxis]
+
+
+@register_detector
+class SpikeDetector(Detector):
+    """Flag metrics whose anomaly ratio is above the pair's mean plus variance plus a tolerance"""
+
+    name = "spike"
+    issue_type = "spike"
+    description = "There is a metric with high a amount of anomalies"
+    human_readable = "Spike in amount of anomalies"
+
+    def __init__(self, tolerance: float = TOLERANCE):
+        """
+        Args:
+            tolerance (float): Spike tolerance. Defaults to TOLERANCE.
+        """
+        self._tolerance = tolerance
+
+    def detect(self, batch: SeriesBatch) -> np.ndarray:
+        threshold = batch.avg + batch.var + self._tolerance
+        return batch.valid & (batch.ratios > threshold[:, np.newaxis])
+
+
+@register_detector
+class EwmaDetector(Detector):
+    """Flag metrics that are far above the exponentially weighted mean of the metrics before them.
+    The weighted mean and variance are updated one column at a time for every pair at once
+    """
+
+    name = "ewma"
+    issue_type = "ewma_deviation"
+    description = (
+        "There is a metric with many more anomalies than its recent weighted average"
+    )
+    human_readable = "Deviation from recent average"
+
+    def __init__(
+        self,
+        alpha: float = 0.3,
+        threshold: float = 3.0,
+        min_delta: float = 0.1,
+        min_periods: int = 6,
+    ):
+        """
+        Args:
+            alpha (float): Weight of every new metric. Defaults to 0.3.
+            threshold (float): How many standard deviations above the average to flag a metric. Defaults to 3.0.
+            min_delta (float): Min difference between a flagged ratio and the average. Defaults to 0.1.
+            min_periods (int): Metrics needed before flagging anything. Defaults to 6.
+        """
+        assert 0 < alpha <= 1, f"Invalid alpha: {alpha}. It should be in (0, 1]"
+
+        self._alpha = alpha
+        self._threshold = threshold
+        self._min_delta = min_delta
+        self._min_periods = min_periods
+
+    def detect(self, batch: SeriesBatch) -> np.ndarray:
+        (n_pairs, n_cols) = batch.ratios.shape
+        mean = np.zeros(n_pairs)
+        var = np.zeros(n_pairs)
+        count = np.zeros(n_pairs, dtype=np.int64)
+        offending = np.zeros(batch.ratios.shape, dtype=bool)
+
+        for j in range(n_cols):
+            valid = batch.valid[:, j]
+            ratio = batch.ratios[:, j]
+
+            deviation = ratio - mean
+            offending[:, j] = (
+                valid
+                & (count >= self._min_periods)
+                & (deviation > self._min_delta)
+                & (deviation > self._threshold * np.sqrt(var))
+            )
+
+            # Metrics without measurements don't change the average
+            increment = self._alpha * deviation
+            first = count == 0
+            mean = np.where(valid, np.where(first, ratio, mean + increment), mean)
+            var = np.where(
+                valid & ~first,
+                (1 - self._alpha) * (var + deviation * increment),
+                var,
+            )
+            count += valid
+
+        return offending
+
+
+@register_detector
+class RobustOutlierDetector(Detector):
+    """Flag metrics with a high robust z-score, using the median and median absolute
+    deviation of the pair instead of its mean and variance, so outliers don't hide each other
+    """
+
+    name = "robust_outlier"
+    issue_type = "robust_outlier"
+    description = (
+        "There is a metric with an outlying amount of anomalies compared to the median"
+    )
+    human_readable = "Outlier in amount of anomalies"
+
+    # Scales the median absolute deviation to the standard deviation of a normal distribution
+    MAD_SCALE = 1.4826
+
+    def __init__(
+        self,
+        threshold: float = 3.5,
+        min_scale: float = 0.02,
+        min_delta: float = 0.1,
+        min_periods: int = 6,
+    ):
+        """
+        Args:
+            threshold (float): Min robust z-score to flag a metric. Defaults to 3.5.
+            min_scale (float): Min value for the scaled median absolute deviation, so pairs where
+                most ratios are the same don't flag every small change. Defaults to 0.02.
+            min_delta (float): Min difference between a flagged ratio and the median. Defaults to 0.1.
+            min_periods (int): Metrics needed before flagging anything. Defaults to 6.
+        """
+        self._threshold = threshold
+        self._min_scale = min_scale
+        self._min_delta = min_delta
+        self._min_periods = min_periods
+
+    def detect(self, batch: SeriesBatch) -> np.ndarray:
+        median = batch.masked_median(batch.ratios)
+        deviation = batch.ratios - median[:, np.newaxis]
+        mad = batch.masked_median(np.abs(deviation))
+        scale = np.maximum(self.MAD_SCALE * mad, self._min_scale)
+
+        return (
+            batch.valid
+            & (batch.n_valid >= self._min_periods)[:, np.newaxis]
+            & (deviation > self._min_delta)
+            & (deviation > self._threshold * scale[:, np.newaxis])
+        )
+
+
+@register_detector
+class CusumDetector(Detector):
+    """Flag sustained increases of the anomaly ratio with an upper CUSUM over the pair's median.
+    Every metric where the cumulative sum is above the decision threshold is offending
+    """
+
+    name = "cusum"
+    issue_type = "level_shift"
+    description = (
+        "The amount of anomalies increased and stayed high for several metrics"
+    )
+    human_readable = "Sustained increase in anomalies"
+    severity = 2
+
+    def __init__(self, slack: float = 0.05, threshold: float = 0.5):
+        """
+        Args:
+            slack (float): Increase over the median ignored by the cumulative sum. Defaults to 0.05.
+            threshold (float): Cumulative sum needed to flag a metric. Defaults to 0.5.
+        """
+        self._slack = slack
+        self._threshold = threshold
+
+    def detect(self, batch: SeriesBatch) -> np.ndarray:
+        reference = batch.masked_median(batch.ratios) + self._slack
+        cusum = np.zeros(batch.ratios.shape[0])
+        offending = np.zeros(batch.ratios.shape, dtype=bool)
+
+        for j in range(batch.ratios.shape[1]):
+            valid = batch.valid[:, j]
+            cusum = np.where(
+                valid, np.maximum(0.0, cusum + batch.ratios[:, j] - reference), cusum
+            )
+            offending[:, j] = valid & (cusum > self._threshold)
+
+        return offending
+
+
+@register_detector
+class SeasonalDetector(Detector):
+    """Flag metrics far above the average of metrics for the same pair at the same hour of
+    the week. The previous 'min_weeks' weeks are loaded as baseline for the analized window
+    """
+
+    name = "seasonal"
+    issue_type = "seasonal_deviation"
+    description = "There is a metric with many more anomalies than usual at the same hour of the week"
+    human_readable = "Deviation from weekly baseline"
+    needs_hours = True
+
+    def __init__(self, min_delta: float = 0.2, min_weeks: int = 2):
+        """
+        Args:
+            min_delta (float): Min difference between a flagged ratio and its weekly baseline. Defaults to 0.2.
+            min_weeks (int): Other metrics at the same hour of the week needed to build a baseline. Defaults to 2.
+        """
+        self._min_delta = min_delta
+        self._min_weeks = min_weeks
+        self.lookback_hours = min_weeks * HOURS_PER_WEEK
+
+    def detect(self, batch: SeriesBatch) -> np.ndarray:
+        (n_pairs, n_cols) = batch.ratios.shape
+        if batch.hours is None:
+            raise ValueError("Seasonal detector needs the hour of every metric")
+
+        # Every pair and hour of the week is a bucket, baselines exclude the metric itself
+        buckets = np.arange(n_pairs)[:, np.newaxis] * HOURS_PER_WEEK + (
+            batch.hours % HOURS_PER_WEEK
+        )
+        buckets, valid = buckets.ravel(), batch.valid.ravel()
+        ratios = batch.ratios.ravel()
+        size = n_pairs * HOURS_PER_WEEK
+
+        sums = np.bincount(buckets[valid], weights=ratios[valid], minlength=size)
+        counts = np.bincount(buckets[valid], minlength=size)
+
+        others = counts[buckets] - 1
+        baseline = np.divide(
+            sums[buckets] - ratios,
+            others,
+            out=np.zeros(len(ratios)),
+            where=others > 0,
+        )
+
+        offending = (
+            valid & (others >= self._min_weeks) & (ratios - baseline > self._min_delta)
+        )
+        return offending.reshape(n_pairs, n_cols)
@@ -13,8 +13,14 @@ from typing import Optional, List
 from dataclasses import dataclass
 from pytz import utc
 
+# Django imports
+from django.db.models import Sum
+
 # Local imports
-from blocking_early_warnings.models import Metric
+from blocking_early_warnings.models import Metric, MetricRollup
+from blocking_early_warnings.settings import HISTOGRAM_MAX_BLOCKS, METRIC_SERIES_STORAGE
+from blocking_early_warnings.utils.rollups import RollupManager
+from blocking_early_warnings.utils.metric_series import MetricSeriesStore
 
 @dataclass
 class HistogramBlockData:
@@ -36,8 +42,18 @@ class HistogramGenerator:
     For now is just an utility class to compute a query, but might get bigger in the future. 
     """
 
+    # Available histogram resolutions, from finest to coarsest, with the length of each block
+    RESOLUTIONS = {
+        "hour" : timedelta(hours=1),
+        MetricRollup.Resolution.DAY.value : timedelta(days=1),
+        MetricRollup.Resolution.WEEK.value : timedelta(weeks=1),
+    }
+
+    # Requested resolution to choose one from the interval length
+    AUTO_RESOLUTION = "auto"
+
     @staticmethod
-    def histogram(url : Optional[str] = None, asn : Optional[str] = None, start_date : Optional[datetime] = None, end_date : Optional[datetime] = None) -> List[HistogramBlockData]:
+    def histogram(url : Optional[str] = None, asn : Optional[str] = None, start_date : Optional[datetime] = None, end_date : Optional[datetime] = None, resolution : Optional[str] = None) -> List[HistogramBlockData]:
         """Generate the content of a histogram. Returns a list of metrics, which represent the blocks in
         the histogram.
 
@@ -46,9 +62,57 @@ class HistogramGenerator:
             asn (Optional[str]): String naming the asn (by code) that all metrics should share. Don't filter if not provided. Defaults to None.
             start_date (Optional[datetime]): Date of the earliest metric. Defaults to 24 before end_date if not provided. Defaults to None.
             end_date (Optional[datetime]): Date of the latest metric. Defaults to now if not provided. Defaults to None.
+            resolution (Optional[str]): Length of every block, "hour", "day" or "week". Use "auto" for the finest 
+                resolution with at most HISTOGRAM_MAX_BLOCKS blocks. Defaults to "hour" if not provided.
+
+        Returns:
+            List[Metric]: List of metrics that represent blocks for a histogram, where the block value is the start of its hour, day or week.
+        """
+
+        # Setup date
+        end_date = end_date or datetime.now(tz=utc)
+        start_date = start_date or end_date - timedelta(hours=24)
+
+        assert start_date < end_date, \
+                f"Provided invalid date interval to generate histograms, start_date ({start_date}) should be before end_date ({end_date})"
+
+        resolution = resolution or "hour"
+        if resolution == HistogramGenerator.AUTO_RESOLUTION:
+            resolution = HistogramGenerator.choose_resolution(start_date, end_date)
+
+        assert resolution in HistogramGenerator.RESOLUTIONS, \
+                f"Invalid histogram resolution: {resolution}. Expected one of: {', '.join(HistogramGenerator.RESOLUTIONS)}"
+
+        if resolution == "hour" and METRIC_SERIES_STORAGE:
+            return HistogramGenerator._series_histogram(url, asn, start_date, end_date)
+
+        if resolution == "hour":
+            return HistogramGenerator._hourly_histogram(url, asn, start_date, end_date)
+
+        return HistogramGenerator._rollup_histogram(url, asn, start_date, end_date, resolution)
+
+    @staticmethod
+    def choose_resolution(start_date : datetime, end_date : datetime, max_blocks : int = HISTOGRAM_MAX_BLOCKS) -> str:
+        """Choose the finest resolution that represents the given interval with at most 'max_blocks' blocks.
+        The coarsest resolution is used if none of them fits
+
+        Args:
+            start_date (datetime): Start of the interval
+            end_date (datetime): End of the interval
+            max_blocks (int): Max number of blocks. Defaults to HISTOGRAM_MAX_BLOCKS.
 
         Returns:
-            List[Metric]: List of metrics that represent blocks for a histogram, where the block value is the hour.
+            str: Name of the chosen resolution
+        """
+        for (resolution, block_length) in HistogramGenerator.RESOLUTIONS.items():
+            if (end_date - start_date) / block_length <= max_blocks:
+                return resolution
+
+        return resolution
+
+    @staticmethod
+    def _hourly_histogram(url : Optional[str], asn : Optional[str], start_date : datetime, end_date : datetime) -> List[HistogramBlockData]:
+        """Histogram with one block per hour, computed from hourly metrics
         """
         qs = Metric.objects.all()
 
@@ -58,13 +122,6 @@ class HistogramGenerator:
         if asn:
             qs = qs.filter(asn__code = asn)
 
-        # Setup date
-        end_date = end_date or datetime.now(tz=utc)
-        start_date = start_date or end_date - timedelta(hours=24)
-
-        assert start_date < end_date, \
-                f"Provided invalid date interval to generate histograms, start_date ({start_date}) should be before end_date ({end_date})"
-        
         # filter by hour
         qs = qs.filter(hour__gte = start_date, hour__lte = end_date)
 
@@ -92,3 +149,66 @@ class HistogramGenerator:
         result.sort(key=lambda b: b.hour)
         return result
 
+    @staticmethod
+    def _series_histogram(url : Optional[str], asn : Optional[str], start_date : datetime, end_date : datetime) -> List[HistogramBlockData]:
+        """Histogram with one block per hour, computed from packed daily series. Hours without 
+        measurements are skipped, like missing hourly metrics
+        """
+        # Same hours as the hourly metrics query, where both dates are included
+        since = start_date.replace(minute=0, second=0, microsecond=0)
+        if since < start_date:
+            since += timedelta(hours=1)
+        until = end_date.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+
+        n_hours = max(0, int((until - since) / timedelta(hours=1)))
+        total_counts = [0] * n_hours
+        anomaly_counts = [0] * n_hours
+
+        for series in MetricSeriesStore().read(since, until, url=url, asn=asn):
+            for i in range(n_hours):
+                total_counts[i] += series.measurement_counts[i]
+                anomaly_counts[i] += series.anomaly_counts[i]
+
+        return [
+            HistogramBlockData(
+                hour=since + timedelta(hours=i), 
+                total_count=total_counts[i], 
+                anomaly_count=anomaly_counts[i]
+            )
+            for i in range(n_hours)
+            if total_counts[i]
+        ]
+
+    @staticmethod
+    def _rollup_histogram(url : Optional[str], asn : Optional[str], start_date : datetime, end_date : datetime, resolution : str) -> List[HistogramBlockData]:
+        """Histogram with one block per day or week, computed from metric rollups. Every period
+        intersecting the requested interval is included as a whole
+        """
+        qs = MetricRollup.objects.filter(resolution = resolution)
+
+        # Rollups without url already aggregate every url for their asn
+        if url:
+            qs = qs.filter(url__url = url)
+        else:
+            qs = qs.filter(url__isnull = True)
+        if asn:
+            qs = qs.filter(asn__code = asn)
+
+        qs = qs.filter(
+            period_start__gte = RollupManager.period_start(start_date, resolution), 
+            period_start__lte = end_date
+        )
+
+        # Add up asns if not filtering by one
+        rows = qs.values("period_start") \
+                .annotate(total_count = Sum("measurement_count"), anomaly_count = Sum("anomaly_count")) \
+                .order_by("period_start")
+
+        return [
+            HistogramBlockData(
+                hour=row["period_start"], 
+                total_count=row["total_count"], 
+                anomaly_count=row["anomaly_count"]
+            )
+            for row in rows
+        ]
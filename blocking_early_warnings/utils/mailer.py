@@ -0,0 +1,130 @@
+"""
+    Send mails over SMTP, reusing a single connection for every mail in a session
+"""
+# Local imports
+from blocking_early_warnings.settings import (
+    MAIL_TO_NOTIFY,
+    SENDER_MAIL,
+    SENDER_MAIL_PSWD,
+    SMTP_HOST,
+    SMTP_PORT,
+    SMTP_STARTTLS,
+    SMTP_TIMEOUT,
+    SMTP_USE_SSL,
+)
+
+# Python imports
+from contextlib import contextmanager
+from email.message import EmailMessage
+from typing import Iterator, Optional
+import smtplib
+import ssl
+
+
+class SmtpSession:
+    """An open and authenticated SMTP connection, used to send many mails"""
+
+    def __init__(self, server: smtplib.SMTP, sender: str, recipient: str):
+        self._server = server
+        self._sender = sender
+        self._recipient = recipient
+
+        # How many mails were sent in this session
+        self.sent = 0
+
+    def send(self, title: str, message: str):
+        """Send a plain text mail to the configured recipient
+
+        Args:
+            title (str): Mail subject
+            message (str): Mail body
+        """
+        mail = EmailMessage()
+        mail["Subject"] = title
+        mail["From"] = self._sender
+        mail["To"] = self._recipient
+        mail.set_content(message)
+
+        self._server.send_message(mail)
+        self.sent += 1
+
+
+class SmtpMailer:
+    """Open SMTP sessions with the configured server and credentials"""
+
+    def __init__(
+        self,
+        host: str = SMTP_HOST,
+        port: int = SMTP_PORT,
+        use_ssl: bool = SMTP_USE_SSL,
+        starttls: bool = SMTP_STARTTLS,
+        timeout: float = SMTP_TIMEOUT,
+        sender: Optional[str] = SENDER_MAIL,
+        password: Optional[str] = SENDER_MAIL_PSWD,
+        recipient: Optional[str] = MAIL_TO_NOTIFY,
+    ):
+        """
+        Args:
+            host (str): SMTP server host
+            port (int): SMTP server port
+            use_ssl (bool): Connect with SSL from the start
+            starttls (bool): Upgrade a plain connection with STARTTLS. Ignored if using SSL
+            timeout (float): Seconds to wait for the server
+            sender (Optional[str]): Mail used as sender, and to log in
+            password (Optional[str]): Password for the sender mail. No login is performed without password,
+                like with a local debugging server
+            recipient (Optional[str]): Mail to send every mail to
+        """
+        self._host = host
+        self._port = port
+        self._use_ssl = use_ssl
+        self._starttls = starttls
+        self._timeout = timeout
+        self._sender = sender
+        self._password = password
+        self._recipient = recipient
+
+    @contextmanager
+    def session(self) -> Iterator[SmtpSession]:
+        """Open a connection to the server and log in. The connection is closed when the session ends
+
+        Raises:
+            ValueError: If sender or recipient are not configured
+
+        Returns:
+            Iterator[SmtpSession]: Session to send mails with
+        """
+        # Don't try anything if parameters are not properly configured
+        if not self._sender or not self._recipient:
+            raise ValueError(
+                "Can't send email because there's a missing configuration parameter"
+            )
+
+        if self._use_ssl:
+            server = smtplib.SMTP_SSL(
+                self._host,
+                self._port,
+                timeout=self._timeout,
+                context=ssl.create_default_context(),
+            )
+        else:
+            server = smtplib.SMTP(self._host, self._port, timeout=self._timeout)
+
+        with server:
+            if not self._use_ssl and self._starttls:
+                server.starttls(context=ssl.create_default_context())
+
+            if self._password:
+                server.login(self._sender, self._password)
+
+            yield SmtpSession(server, self._sender, self._recipient)
+
+    def send(self, title: str, message: str):
+        """Send a single mail in its own session
+
+        Args:
+            title (str): Mail subject
+            message (str): Mail body
+        """
+        with self.session() as session:
+            session.send(title, message)
@@ -0,0 +1,187 @@
+"""
+    Local archive of raw ooni measurements, so metrics can be rebuilt without requesting them again
+"""
+# Local imports
+from blocking_early_warnings.utils.misc import get_hour_from_time_str
+
+# Python imports
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from pytz import utc
+from typing import Any, Dict, Iterable, Iterator, List, Set, Union
+import fcntl
+import gzip
+import json
+import os
+import tempfile
+
+
+class MeasurementArchive:
+    """
+    Append-only archive of raw ooni measurements in compressed jsonl files, with one
+    file per hour:
+        <root>/<country code>/YYYY-MM-DD/HH.jsonl.gz
+
+    An index file at <root>/<country code>/index.json lists every hour stored in the
+    archive, so a replay only opens files for the hours it needs. Many processes can
+    archive pages at the same time, like parallel backfill tasks: the index is only
+    updated while holding a lock, merging hours added by other processes.
+
+    The same measurement may be archived more than once when overlapping intervals are
+    requested, so measurements are deduplicated when read.
+    """
+
+    # Format used for hours in the index file
+    INDEX_HOUR_FORMAT = "%Y-%m-%dT%H"
+
+    def __init__(self, root_dir: Union[str, Path], country_code: str):
+        """
+        Parameters:
+            + root_dir : str = directory where archives are stored
+            + country_code : str = country code for the archived measurements
+        """
+        self._dir = Path(root_dir) / country_code
+        self._index_path = self._dir / "index.json"
+        self._lock_path = self._dir / "index.lock"
+        self._hours = self._load_index()
+
+    @property
+    def hours(self) -> List[datetime]:
+        """
+        Sorted list of hours stored in this archive
+        """
+        return sorted(self._hours)
+
+    def write_page(self, measurements: Iterable[Dict[str, Any]]):
+        """
+        Append a page of measurements to the archive. The index is not saved until
+        'save_index' is called
+        Parameters:
+            + measurements : [dict] = List of measurement metadata as it comes from ooni
+        """
+        by_hour: Dict[datetime, List[str]] = {}
+        for measurement in measurements:
+            hour = get_hour_from_time_str(measurement["measurement_start_time"])
+            if (lines := by_hour.get(hour)) is None:
+                lines = by_hour[hour] = []
+
+            lines.append(json.dumps(measurement))
+
+        for (hour, lines) in by_hour.items():
+            path = self._hour_path(hour)
+            path.parent.mkdir(parents=True, exist_ok=True)
+
+            # Every append adds a new gzip member, which is still a valid gzip file. It's
+            # compressed first and appended at once, so appends from other processes don't mix
+            member = gzip.compress(("\n".join(lines) + "\n").encode("utf-8"))
+            with open(path, "ab") as file:
+                file.write(member)
+
+            self._hours.add(hour)
+
+    def save_index(self):
+        """
+        Store the list of archived hours, including hours stored by other processes since
+        this index was loaded. The file is replaced atomically so readers never see a
+        partially written index
+        """
+        with self._lock_index():
+            self._hours |= self._load_index()
+            self._write_index()
+
+    def rebuild_index(self):
+        """
+        Rebuild the index by scanning archived files. Useful if the process was killed
+        before the index could be saved
+        """
+        with self._lock_index():
+            hours = set()
+            for path in self._dir.glob("*/*.jsonl.gz"):
+                day = datetime.strptime(path.parent.name, "%Y-%m-%d")
+                hours.add(day.replace(hour=int(path.name[:2]), tzinfo=utc))
+
+            self._hours = hours
+            self._write_index()
+
+    @contextmanager
+    def _lock_index(self) -> Iterator[None]:
+        """
+        Hold an exclusive lock on the index, shared by every process using this archive
+        """
+        self._dir.mkdir(parents=True, exist_ok=True)
+        with open(self._lock_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _write_index(self):
+        """
+        Replace the index file with the hours in this archive. Should hold the index lock
+        """
+        (fd, tmp_path) = tempfile.mkstemp(dir=self._dir, suffix=".json.tmp")
+        with os.fdopen(fd, "w") as file:
+            json.dump(
+                {
+                    "hours": [
+                        datetime.strftime(h, self.INDEX_HOUR_FORMAT) for h in self.hours
+                    ]
+                },
+                file,
+            )
+
+        os.replace(tmp_path, self._index_path)
+
+    def iter_pages(
+        self, since: datetime, until: datetime
+    ) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Iterate over archived measurements from "since" until "until", one page per
+        archived hour. Duplicated measurements are returned only once
+        Parameters:
+            + since : datetime = Start time for measurements
+            + until : datetime = End time for measurements
+        Return:
+            Iterator of measurement lists, one per archived hour, sorted by hour
+        """
+        for hour in self.hours:
+            if not (since <= hour < until):
+                continue
+
+            page = []
+            seen: Set[str] = set()
+
+            with gzip.open(self._hour_path(hour), "rt", encoding="utf-8") as file:
+                for line in file:
+                    measurement = json.loads(line)
+                    key = measurement.get("measurement_uid") or line
+                    if key in seen:
+                        continue
+
+                    seen.add(key)
+                    page.append(measurement)
+
+            yield page
+
+    def _hour_path(self, hour: datetime) -> Path:
+        """
+        Path to the file storing measurements for the given hour
+        """
+        return self._dir / f"{hour:%Y-%m-%d}" / f"{hour:%H}.jsonl.gz"
+
+    def _load_index(self) -> Set[datetime]:
+        """
+        Load the set of archived hours from the index file, if any
+        """
+        if not self._index_path.exists():
+            return set()
+
+        with open(self._index_path, "r") as file:
+            index = json.load(file)
+
+        return {
+            datetime.strptime(h, self.INDEX_HOUR_FORMAT).replace(tzinfo=utc)
+            for h in index["hours"]
+        }
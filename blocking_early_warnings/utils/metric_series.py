@@ -0,0 +1,310 @@
+"""
+    Compact storage of hourly metrics, with one packed array per url, asn and day
+"""
+# Django imports
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.db.models.functions import TruncDate
+
+# Local imports
+from blocking_early_warnings.models import AnomalyReport, Metric, MetricSeries
+from blocking_early_warnings.settings import (
+    METRIC_SERIES_HOURLY_DAYS,
+    METRIC_WRITE_CHUNK_SIZE,
+)
+
+# Python imports
+from array import array
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from pytz import utc
+import struct
+
+HOURS_PER_DAY = 24
+
+# 24 measurement counts followed by 24 anomaly counts
+_DAY_STRUCT = struct.Struct(f"<{2 * HOURS_PER_DAY}I")
+
+
+def pack_day(measurement_counts: List[int], anomaly_counts: List[int]) -> bytes:
+    """Pack the hourly counts of a day into the binary format stored in MetricSeries
+
+    Args:
+        measurement_counts (List[int]): Measurement count for each hour in the day
+        anomaly_counts (List[int]): Anomaly count for each hour in the day
+
+    Returns:
+        bytes: Packed counts
+    """
+    return _DAY_STRUCT.pack(*measurement_counts, *anomaly_counts)
+
+
+def unpack_day(counts: bytes) -> Tuple[array, array]:
+    """Unpack counts stored in MetricSeries
+
+    Args:
+        counts (bytes): Packed counts, as returned by 'pack_day'
+
+    Returns:
+        Tuple[array, array]: Measurement counts and anomaly counts for each hour of the day
+    """
+    values = _DAY_STRUCT.unpack(bytes(counts))
+    return (
+        array("I", values[:HOURS_PER_DAY]),
+        array("I", values[HOURS_PER_DAY:]),
+    )
+
+
+@dataclass
+class HourlySeries:
+    """Hourly counts for an url and asn over contiguous hours. Hours without data count as zero"""
+
+    url_id: int
+    asn_id: int
+
+    # Hour for the first value in both arrays
+    start: datetime
+
+    measurement_counts: array
+    anomaly_counts: array
+
+    def hours(self) -> Iterator[datetime]:
+        """Iterate over the hour for every value in this series"""
+        for i in range(len(self.measurement_counts)):
+            yield self.start + timedelta(hours=i)
+
+
+class MetricSeriesStore:
+    """Read and write metrics stored as packed daily series"""
+
+    def __init__(self, batch_size: int = METRIC_WRITE_CHUNK_SIZE):
+        """
+        Args:
+            batch_size (int): How many series are written to database at once
+        """
+        self._batch_size = batch_size
+
+    def read(
+        self,
+        since: datetime,
+        until: datetime,
+        url: Optional[str] = None,
+        asn: Optional[str] = None,
+        url_range: Optional[Tuple[int, int]] = None,
+        pairs: Optional[Q] = None,
+    ) -> List[HourlySeries]:
+        """Read hourly counts from "since" until "until" for every url and asn with stored series,
+        sorted by url and asn
+
+        Args:
+            since (datetime): Start of the interval, should be an exact hour
+            until (datetime): End of the interval, not included. Should be an exact hour
+            url (Optional[str]): Only read series for this url if provided. Defaults to None.
+            asn (Optional[str]): Only read series for this asn code if provided. Defaults to None.
+            url_range (Optional[Tuple[int, int]]): Only read series for urls with ids in this range,
+                both included. Defaults to None.
+            pairs (Optional[Q]): Only read series matching this filter. Defaults to None.
+
+        Returns:
+            List[HourlySeries]: One series per url and asn, covering every hour in the interval
+        """
+        since, until = since.astimezone(utc), until.astimezone(utc)
+        first_day = since.date()
+        n_hours = int((until - since) / timedelta(hours=1))
+        if n_hours <= 0:
+            return []
+
+        qs = MetricSeries.objects.filter(
+            day__gte=first_day, day__lte=(until - timedelta(hours=1)).date()
+        )
+        if url:
+            qs = qs.filter(url__url=url)
+        if asn:
+            qs = qs.filter(asn__code=asn)
+        if url_range is not None:
+            qs = qs.filter(url__id__range=url_range)
+        if pairs is not None:
+            qs = qs.filter(pairs)
+
+        # Offset of the first requested hour in the first day
+        offset = since.hour
+
+        result: Dict[Tuple[int, int], HourlySeries] = {}
+        for (url_id, asn_id, day, counts) in (
+            qs.order_by("url_id", "asn_id", "day")
+            .values_list("url_id", "asn_id", "day", "counts")
+            .iterator()
+        ):
+            series = result.get((url_id, asn_id))
+            if series is None:
+                series = result[(url_id, asn_id)] = HourlySeries(
+                    url_id=url_id,
+                    asn_id=asn_id,
+                    start=since,
+                    measurement_counts=array("I", [0]) * n_hours,
+                    anomaly_counts=array("I", [0]) * n_hours,
+                )
+
+            # Copy the part of this day that falls inside the interval
+            day_measurements, day_anomalies = unpack_day(counts)
+            start = (day - first_day).days * HOURS_PER_DAY - offset
+            lo, hi = max(0, -start), min(HOURS_PER_DAY, n_hours - start)
+            if lo >= hi:
+                continue
+
+            series.measurement_counts[start + lo : start + hi] = day_measurements[lo:hi]
+            series.anomaly_counts[start + lo : start + hi] = day_anomalies[lo:hi]
+
+        return list(result.values())
+
+    def convert_from_metrics(
+        self, since: Optional[datetime] = None, until: Optional[datetime] = None
+    ) -> int:
+        """Store hourly metrics from "since" until "until" as daily series. Every day touched by
+        this interval is converted as a whole, overwriting already stored series. Converts every
+        stored metric if no interval is provided
+
+        Args:
+            since (Optional[datetime]): Start of the interval. Defaults to None.
+            until (Optional[datetime]): End of the interval. Defaults to None.
+
+        Returns:
+            int: How many daily series were written
+        """
+        metrics = Metric.objects.filter(hour__isnull=False)
+        if since is not None:
+            metrics = metrics.filter(hour__gte=self._day_start(since))
+        if until is not None:
+            metrics = metrics.filter(
+                hour__lt=self._day_start(until - timedelta(microseconds=1))
+                + timedelta(days=1)
+            )
+
+        # Metrics are sorted so every series is complete once the next one starts
+        rows = (
+            metrics.order_by("url_id", "asn_id", "hour")
+            .values_list(
+                "url_id", "asn_id", "hour", "measurement_count", "anomaly_count"
+            )
+            .iterator(chunk_size=self._batch_size)
+        )
+
+        written = 0
+        batch: List[MetricSeries] = []
+        with transaction.atomic():
+            for series in self._pack_rows(rows):
+                batch.append(series)
+                if len(batch) >= self._batch_size:
+                    written += self._write(batch)
+                    batch = []
+
+            written += self._write(batch)
+
+        return written
+
+    def prune_metrics(
+        self,
+        now: Optional[datetime] = None,
+        days: Optional[int] = METRIC_SERIES_HOURLY_DAYS,
+    ) -> int:
+        """Delete hourly metrics older than the given days whose day is already stored as a series,
+        a batch at a time. Metrics linked to anomaly reports are kept
+
+        Args:
+            now (Optional[datetime]): Current time. Defaults to now.
+            days (Optional[int]): Days of hourly metrics to keep. Nothing is pruned if None.
+                Defaults to METRIC_SERIES_HOURLY_DAYS.
+
+        Returns:
+            int: How many metrics were deleted
+        """
+        if days is None:
+            return 0
+
+        cutoff = self._day_start(now or datetime.now(tz=utc)) - timedelta(days=days)
+        packed = MetricSeries.objects.filter(
+            url_id=OuterRef("url_id"),
+            asn_id=OuterRef("asn_id"),
+            day=OuterRef("day"),
+        )
+        reported = AnomalyReport.metrics.through.objects.filter(
+            metric_id=OuterRef("id")
+        )
+        prunable = (
+            Metric.objects.filter(hour__lt=cutoff)
+            .annotate(day=TruncDate("hour", tzinfo=utc))
+            .filter(Exists(packed))
+            .exclude(Exists(reported))
+        )
+
+        deleted = 0
+        while True:
+            ids = list(prunable.values_list("id", flat=True)[: self._batch_size])
+            if not ids:
+                return deleted
+
+            Metric.objects.filter(id__in=ids).delete()
+            deleted += len(ids)
+
+    @staticmethod
+    def _pack_rows(
+        rows: Iterable[Tuple[int, int, datetime, Optional[int], Optional[int]]]
+    ) -> Iterator[MetricSeries]:
+        """Pack metric rows sorted by url, asn and hour into daily series
+
+        Args:
+            rows (Iterable[Tuple[int, int, datetime, Optional[int], Optional[int]]]): url id, asn id,
+                hour, measurement count and anomaly count for every metric
+
+        Returns:
+            Iterator[MetricSeries]: A series for every url, asn and day, not saved yet
+        """
+        current_key = None
+        measurement_counts: List[int] = []
+        anomaly_counts: List[int] = []
+
+        for (url_id, asn_id, hour, measurement_count, anomaly_count) in rows:
+            hour = hour.astimezone(utc)
+            key = (url_id, asn_id, hour.date())
+            if key != current_key:
+                if current_key is not None:
+                    yield MetricSeries(
+                        url_id=current_key[0],
+                        asn_id=current_key[1],
+                        day=current_key[2],
+                        counts=pack_day(measurement_counts, anomaly_counts),
+                    )
+
+                current_key = key
+                measurement_counts = [0] * HOURS_PER_DAY
+                anomaly_counts = [0] * HOURS_PER_DAY
+
+            measurement_counts[hour.hour] = measurement_count or 0
+            anomaly_counts[hour.hour] = anomaly_count or 0
+
+        if current_key is not None:
+            yield MetricSeries(
+                url_id=current_key[0],
+                asn_id=current_key[1],
+                day=current_key[2],
+                counts=pack_day(measurement_counts, anomaly_counts),
+            )
+
+    @staticmethod
+    def _write(batch: List[MetricSeries]) -> int:
+        """Upsert a batch of series by url, asn and day"""
+        if batch:
+            MetricSeries.objects.bulk_create(
+                batch,
+                update_conflicts=True,
+                unique_fields=["url", "asn", "day"],
+                update_fields=["counts"],
+            )
+
+        return len(batch)
+
+    @staticmethod
+    def _day_start(time: datetime) -> datetime:
+        time = time.astimezone(utc)
+        return datetime(time.year, time.month, time.day, tzinfo=utc)
@@ -0,0 +1,391 @@
+"""
+    Metric storage maintenance: optional time partitioning on PostgreSQL and retention of old metrics
+"""
+# Django imports
+from django.db import connection, transaction
+
+# Local imports
+from blocking_early_warnings.models import (
+    ASN,
+    AnomalyReport,
+    EarlyWarningSettings,
+    Metric,
+    Url,
+)
+from blocking_early_warnings.settings import (
+    METRIC_PARTITION_GRANULARITY,
+    METRIC_PARTITIONS_AHEAD,
+    METRIC_RETENTION_BATCH_SIZE,
+)
+
+# Python imports
+from datetime import datetime, timedelta
+from enum import Enum
+from typing import List, Optional, Tuple
+from pytz import utc
+
+
+class PartitionGranularity(Enum):
+    """Time span covered by each metric partition"""
+
+    DAY = "day"
+    MONTH = "month"
+
+
+class MetricStorageManager:
+    """Keep metric storage bounded. On PostgreSQL the metric table can be converted to a table
+    partitioned by hour, so range queries only scan relevant partitions and expired data is
+    removed by dropping whole partitions. Other databases, or rows outside of any partition,
+    fall back to deleting expired metrics in batches.
+
+    How long metrics are kept is configured by EarlyWarningSettings.number_of_days_back
+    """
+
+    def __init__(
+        self,
+        granularity: str = METRIC_PARTITION_GRANULARITY,
+        partitions_ahead: int = METRIC_PARTITIONS_AHEAD,
+        batch_size: int = METRIC_RETENTION_BATCH_SIZE,
+    ):
+        """
+        Args:
+            granularity (str): Time span of every partition, "day" or "month".
+            partitions_ahead (int): How many partitions after the current one should always exist.
+            batch_size (int): How many metrics are deleted at once by the batched fallback.
+        """
+        self._granularity = PartitionGranularity(granularity)
+        self._partitions_ahead = partitions_ahead
+        self._batch_size = batch_size
+        self._table = Metric._meta.db_table
+
+    def is_partitioned(self) -> bool:
+        """Check if the metric table is a partitioned table
+
+        Returns:
+            bool: True if the table is partitioned, False otherwise or if not using PostgreSQL
+        """
+        if connection.vendor != "postgresql":
+            return False
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT 1 FROM pg_partitioned_table pt
+                JOIN pg_class c ON c.oid = pt.partrelid
+                WHERE c.relname = %s
+                """,
+                [self._table],
+            )
+            return cursor.fetchone() is not None
+
+    def partition_table(self, now: Optional[datetime] = None):
+        """Convert the metric table in a table partitioned by hour range, copying every
+        stored metric. Partitions are created for the whole stored history and a few periods
+        ahead, plus a default partition for metrics outside of them, like backfilled hours
+        before the first partition. Does nothing if the table is already partitioned.
+
+        The primary key includes the partition key, as PostgreSQL requires, so it's (id, hour)
+        and metrics without hour, left by old versions that pre-allocated them, are not copied.
+
+        Note that the table is locked while metrics are copied, and that PostgreSQL can't keep
+        foreign keys pointing to a partitioned table unless they include the partition key, so
+        the foreign key from anomaly report metrics to metrics is dropped. Metrics removed by the
+        ORM still remove their anomaly report relations, and 'apply_retention' removes them
+        before dropping partitions.
+
+        Args:
+            now (Optional[datetime]): Current time. Defaults to now.
+
+        Raises:
+            ValueError: If not using PostgreSQL
+        """
+        if connection.vendor != "postgresql":
+            raise ValueError("Metric partitioning is only supported on PostgreSQL")
+
+        if self.is_partitioned():
+            return
+
+        now = now or datetime.now(tz=utc)
+        table = self._table
+        old_table = f"{table}_unpartitioned"
+        sequence = f"{table}_part_id_seq"
+        asn_table = ASN._meta.db_table
+        url_table = Url._meta.db_table
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f'ALTER TABLE "{table}" RENAME TO "{old_table}"')
+
+            # Names should match the ones in the model so later migrations can find them
+            cursor.execute(
+                f'ALTER TABLE "{old_table}" DROP CONSTRAINT "unique_metric_url_asn_hour"'
+            )
+            cursor.execute('DROP INDEX "metric_hour_asn_url_idx"')
+
+            cursor.execute(f'CREATE SEQUENCE "{sequence}"')
+            cursor.execute(
+                f"""
+                CREATE TABLE "{table}" (
+                    "id" bigint NOT NULL DEFAULT nextval('"{sequence}"'),
+                    "hour" timestamp with time zone NOT NULL,
+                    "anomaly_count" integer NULL,
+                    "measurement_count" integer NULL,
+                    "asn_id" bigint NOT NULL REFERENCES "{asn_table}" ("id") DEFERRABLE INITIALLY DEFERRED,
+                    "url_id" bigint NOT NULL REFERENCES "{url_table}" ("id") DEFERRABLE INITIALLY DEFERRED,
+                    PRIMARY KEY ("id", "hour")
+                ) PARTITION BY RANGE ("hour")
+                """
+            )
+            cursor.execute(f'ALTER SEQUENCE "{sequence}" OWNED BY "{table}"."id"')
+
+            cursor.execute(
+                f'CREATE INDEX "{table}_part_asn_id_idx" ON "{table}" ("asn_id")'
+            )
+            cursor.execute(
+                f'CREATE INDEX "{table}_part_url_id_idx" ON "{table}" ("url_id")'
+            )
+            cursor.execute(
+                f'ALTER TABLE "{table}" ADD CONSTRAINT "unique_metric_url_asn_hour" UNIQUE ("url_id", "asn_id", "hour")'
+            )
+            cursor.execute(
+                f'CREATE INDEX "metric_hour_asn_url_idx" ON "{table}" ("hour", "asn_id", "url_id") INCLUDE ("anomaly_count", "measurement_count")'
+            )
+
+            # Partitions for every stored hour and the following ones
+            cursor.execute(
+                f'CREATE TABLE "{table}_default" PARTITION OF "{table}" DEFAULT'
+            )
+            cursor.execute(f'SELECT MIN("hour") FROM "{old_table}"')
+            first_hour = cursor.fetchone()[0] or now
+            self._create_partitions(
+                cursor, since=first_hour, until=self._last_period(now)
+            )
+
+            cursor.execute(
+                f"""
+                INSERT INTO "{table}" ("id", "hour", "anomaly_count", "measurement_count", "asn_id", "url_id")
+                SELECT "id", "hour", "anomaly_count", "measurement_count", "asn_id", "url_id" FROM "{old_table}"
+                WHERE "hour" IS NOT NULL
+                """
+            )
+            cursor.execute(
+                f'SELECT setval(\'"{sequence}"\', COALESCE((SELECT MAX("id") FROM "{table}"), 0) + 1, false)'
+            )
+
+            cursor.execute(f'DROP TABLE "{old_table}" CASCADE')
+
+    def create_future_partitions(self, now: Optional[datetime] = None) -> List[str]:
+        """Make sure there's a partition for the current period and the following ones.
+        Does nothing if the table is not partitioned
+
+        Args:
+            now (Optional[datetime]): Current time. Defaults to now.
+
+        Returns:
+            List[str]: Names of the created partitions
+        """
+        if not self.is_partitioned():
+            return []
+
+        now = now or datetime.now(tz=utc)
+        with transaction.atomic(), connection.cursor() as cursor:
+            return self._create_partitions(
+                cursor, since=now, until=self._last_period(now)
+            )
+
+    def apply_retention(self, now: Optional[datetime] = None) -> Tuple[List[str], int]:
+        """Remove metrics older than EarlyWarningSettings.number_of_days_back days. Expired partitions
+        are dropped if the table is partitioned, and any remaining expired metric is deleted in batches
+
+        Args:
+            now (Optional[datetime]): Current time. Defaults to now.
+
+        Returns:
+            Tuple[List[str], int]: Names of the dropped partitions, and how many metrics were deleted in batches
+        """
+        now = now or datetime.now(tz=utc)
+        days_back = EarlyWarningSettings.load().number_of_days_back
+        cutoff = now - timedelta(days=days_back)
+
+        dropped = []
+        if self.is_partitioned():
+            expired = [
+                name
+                for (name, period_end) in self._get_partitions()
+                if period_end <= cutoff
+            ]
+
+            with transaction.atomic(), connection.cursor() as cursor:
+                # There's no foreign key to cascade deletion to report metrics
+                AnomalyReport.metrics.through.objects.filter(
+                    metric__hour__lt=cutoff
+                ).delete()
+
+                for name in expired:
+                    cursor.execute(f'DROP TABLE "{name}"')
+                    dropped.append(name)
+
+        return dropped, self._delete_in_batches(cutoff)
+
+    def _delete_in_batches(self, cutoff: datetime) -> int:
+        """Delete metrics older than the given cutoff, a batch at a time
+
+        Args:
+            cutoff (datetime): Metrics before this hour are deleted
+
+        Returns:
+            int: How many metrics were deleted
+        """
+        deleted = 0
+        while True:
+            ids = list(
+                Metric.objects.filter(hour__lt=cutoff).values_list("id", flat=True)[
+                    : self._batch_size
+                ]
+            )
+            if not ids:
+                return deleted
+
+            Metric.objects.filter(id__in=ids).delete()
+            deleted += len(ids)
+
+    def _create_partitions(self, cursor, since: datetime, until: datetime) -> List[str]:
+        """Create every missing partition from the period containing "since" until the
+        period containing "until".
+
+        PostgreSQL refuses to create a partition if the default partition has rows for its
+        period, so those rows are moved to the new partitions: the default partition is
+        detached, partitions are created, rows are moved and it's attached again
+
+        Returns:
+            List[str]: Names of the created partitions
+        """
+        existing = {name for (name, _) in self._get_partitions()}
+        missing = []
+
+        start = self._period_start(since)
+        while start <= until:
+            end = self._next_period(start)
+            name = self._partition_name(start)
+
+            if name not in existing:
+                missing.append((name, start, end))
+
+            start = end
+
+        if not missing:
+            return []
+
+        table = self._table
+        default = f"{table}_default"
+        in_missing_periods = " OR ".join(
+            ['("hour" >= %s AND "hour" < %s)'] * len(missing)
+        )
+        bounds = [bound for (_, start, end) in missing for bound in (start, end)]
+
+        cursor.execute(
+            f'SELECT EXISTS (SELECT 1 FROM "{default}" WHERE {in_missing_periods})',
+            bounds,
+        )
+        move_rows = cursor.fetchone()[0]
+        if move_rows:
+            cursor.execute(f'ALTER TABLE "{table}" DETACH PARTITION "{default}"')
+
+        for (name, start, end) in missing:
+            cursor.execute(
+                f'CREATE TABLE "{name}" PARTITION OF "{table}" FOR VALUES FROM (%s) TO (%s)',
+                [start, end],
+            )
+
+        if move_rows:
+            columns = (
+                '"id", "hour", "anomaly_count", "measurement_count", "asn_id", "url_id"'
+            )
+            cursor.execute(
+                f'INSERT INTO "{table}" ({columns}) SELECT {columns} FROM "{default}" WHERE {in_missing_periods}',
+                bounds,
+            )
+            cursor.execute(
+                f'DELETE FROM "{default}" WHERE {in_missing_periods}', bounds
+            )
+            cursor.execute(
+                f'ALTER TABLE "{table}" ATTACH PARTITION "{default}" DEFAULT'
+            )
+
+        return [name for (name, _, _) in missing]
+
+    def _get_partitions(self) -> List[Tuple[str, datetime]]:
+        """List existing range partitions, without the default one
+
+        Returns:
+            List[Tuple[str, datetime]]: Every partition name, with the hour where its period ends
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT c.relname FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                JOIN pg_class p ON p.oid = i.inhparent
+                WHERE p.relname = %s
+                """,
+                [self._table],
+            )
+            names = [row[0] for row in cursor.fetchall()]
+
+        prefix = f"{self._table}_p"
+        partitions = []
+        for name in names:
+            suffix = name[len(prefix) :]
+            if not name.startswith(prefix) or not suffix.isdigit():
+                continue
+
+            # Period is encoded as YYYYMMDD for days or YYYYMM for months
+            start = datetime(
+                year=int(suffix[0:4]),
+                month=int(suffix[4:6]),
+                day=int(suffix[6:8] or 1),
+                tzinfo=utc,
+            )
+            end = (
+                start + timedelta(days=1)
+                if len(suffix) == 8
+                else self._next_month(start)
+            )
+            partitions.append((name, end))
+
+        return partitions
+
+    def _partition_name(self, start: datetime) -> str:
+        if self._granularity == PartitionGranularity.DAY:
+            return f"{self._table}_p{start:%Y%m%d}"
+
+        return f"{self._table}_p{start:%Y%m}"
+
+    def _period_start(self, time: datetime) -> datetime:
+        time = time.astimezone(utc)
+        start = datetime(time.year, time.month, time.day, tzinfo=utc)
+
+        if self._granularity == PartitionGranularity.MONTH:
+            start = start.replace(day=1)
+
+        return start
+
+    def _next_period(self, start: datetime) -> datetime:
+        if self._granularity == PartitionGranularity.DAY:
+            return start + timedelta(days=1)
+
+        return self._next_month(start)
+
+    def _last_period(self, now: datetime) -> datetime:
+        """Start of the last period that should have a partition"""
+        start = self._period_start(now)
+        for _ in range(self._partitions_ahead):
+            start = self._next_period(start)
+
+        return start
+
+    @staticmethod
+    def _next_month(start: datetime) -> datetime:
+        if start.month == 12:
+            return start.replace(year=start.year + 1, month=1)
+
+        return start.replace(month=start.month + 1)
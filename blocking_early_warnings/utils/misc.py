@@ -10,6 +10,7 @@ from blocking_early_warnings.settings import DATE_FORMAT
 # Python imports
 from typing import Type, List, Callable, Any
 from datetime import datetime, timedelta
+from functools import lru_cache
 from pytz import utc
 
 
@@ -24,6 +25,29 @@ def get_hour_from_str(str_time: str) -> datetime:
     return hour.replace(tzinfo=utc)
 
 
+def get_hour_from_time_str(str_time: str) -> datetime:
+    """
+    Fast version of get_hour_from_str for ooni time strings, like "2022-06-01T10:42:12Z"
+    or "2022-06-01 10:00:00". No general purpose parsing is performed: the hour is taken from
+    the fixed position date and hour prefix, and the resulting datetime is cached for that prefix
+    """
+    return _get_hour_from_prefix(str_time[:13])
+
+
+@lru_cache(maxsize=4096)
+def _get_hour_from_prefix(prefix: str) -> datetime:
+    """
+    Return the hour for a "YYYY-MM-DD?HH" prefix. Cached, as many measurements share the same hour
+    """
+    return datetime(
+        year=int(prefix[0:4]),
+        month=int(prefix[5:7]),
+        day=int(prefix[8:10]),
+        hour=int(prefix[11:13]),
+        tzinfo=utc,
+    )
+
+
 def get_hour(time: datetime) -> datetime:
     """
     Return the same datetime object but with minutes, seconds,
@@ -36,7 +60,8 @@ class Accumulator:
     """
     Object holding a set of
     elements to be processed by a function once a
-    certain ammount of elements is reached
+    certain ammount of elements is reached. Remaining
+    elements are only processed by an explicit flush
     """
 
     def __init__(
@@ -71,6 +96,3 @@ class Accumulator:
         """
         self.callback(self.queue)
         self.queue = []
-
-    def __del__(self):
-        self.flush()
@@ -0,0 +1,518 @@
+"""
+    Queue of outbound alerts, delivered by a pool of workers through pluggable channels
+"""
+# External imports
+from django.db import transaction
+from django.db.models import Min, Q
+from django.utils import timezone
+import requests as req
+
+# Local imports
+from blocking_early_warnings.models import Notification, NotificationChannelLease
+from blocking_early_warnings.settings import (
+    NOTIFICATION_CHANNELS,
+    NOTIFICATION_CLAIM_TIMEOUT_SECONDS,
+)
+from blocking_early_warnings.utils.mailer import SmtpMailer
+
+# Python imports
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Type
+import queue
+import random
+import uuid
+
+# Sends a single notification over an open connection, raising an exception if it fails
+SendFunction = Callable[[Notification], None]
+
+
+class NotificationChannel:
+    """Base class for notification channels. Subclasses should define a unique 'name' and implement
+    'connect'. Every channel has its own concurrency, retry policy and queue bounds. Register them
+    with 'register_channel' so they can be configured in NOTIFICATION_CHANNELS
+    """
+
+    name: str = ""
+
+    def __init__(
+        self,
+        concurrency: int = 1,
+        max_retries: int = 5,
+        backoff_seconds: float = 30.0,
+        max_backoff_seconds: float = 3600.0,
+        max_pending: int = 1000,
+        batch_size: int = 100,
+    ):
+        """
+        Args:
+            concurrency (int): Workers delivering notifications for this channel at the same time. Defaults to 1.
+            max_retries (int): Failed deliveries before giving up on a notification. Defaults to 5.
+            backoff_seconds (float): Base time to wait before retrying, doubled after every failure. Defaults to 30.0.
+            max_backoff_seconds (float): Max time to wait before retrying. Defaults to 3600.0.
+            max_pending (int): Max notifications waiting for this channel, new ones are dropped beyond it. Defaults to 1000.
+            batch_size (int): Max notifications taken by every delivery run. Defaults to 100.
+        """
+        assert concurrency > 0, "concurrency should be greater than 0"
+        assert batch_size > 0, "batch size should be greater than 0"
+
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+
+    @contextmanager
+    def connect(self) -> Iterator[SendFunction]:
+        """Open a connection to deliver many notifications. Every worker opens its own
+
+        Returns:
+            Iterator[SendFunction]: Function to send a notification with this connection
+        """
+        raise NotImplementedError
+
+    def retry_delay(self, attempts: int) -> timedelta:
+        """Time to wait before retrying a notification, exponential backoff with jitter
+
+        Args:
+            attempts (int): Failed deliveries so far
+
+        Returns:
+            timedelta: Time to wait
+        """
+        backoff = min(
+            self.max_backoff_seconds, self.backoff_seconds * 2 ** max(attempts - 1, 0)
+        )
+        return timedelta(seconds=random.uniform(backoff / 2, backoff))
+
+
+# Registered channels by name
+CHANNELS: Dict[str, Type[NotificationChannel]] = {}
+
+
+def register_channel(channel: Type[NotificationChannel]) -> Type[NotificationChannel]:
+    """Register a channel class. Can be used as a decorator
+
+    Args:
+        channel (Type[NotificationChannel]): Channel class to register
+
+    Returns:
+        Type[NotificationChannel]: The same class
+    """
+    assert channel.name, f"Channel '{channel}' should have a name"
+    assert (
+        channel.name not in CHANNELS
+    ), f"There's already a channel named '{channel.name}'"
+
+    CHANNELS[channel.name] = channel
+    return channel
+
+
+def create_channels(
+    config: Dict[str, Dict[str, Any]]
+) -> Dict[str, NotificationChannel]:
+    """Create registered channels from their configuration
+
+    Args:
+        config (Dict[str, Dict[str, Any]]): Options for every channel, by name. Like NOTIFICATION_CHANNELS
+
+    Raises:
+        ValueError: If there's no channel with some of the given names
+
+    Returns:
+        Dict[str, NotificationChannel]: New channel instances by name
+    """
+    unknown = set(config) - set(CHANNELS)
+    if unknown:
+        raise ValueError(
+            f"Unknown notification channels: {', '.join(sorted(unknown))}. Available channels: {', '.join(CHANNELS)}"
+        )
+
+    return {name: CHANNELS[name](**options) for (name, options) in config.items()}
+
+
+@register_channel
+class SmtpChannel(NotificationChannel):
+    """Send notifications as mails. Every worker sends all of its notifications over one SMTP session"""
+
+    name = "smtp"
+
+    def __init__(self, mailer: Optional[SmtpMailer] = None, **options: Any):
+        """
+        Args:
+            mailer (Optional[SmtpMailer]): Mailer to open sessions with. Defaults to the configured SMTP server.
+            options: Options for NotificationChannel
+        """
+        super().__init__(**options)
+        self._mailer = mailer or SmtpMailer()
+
+    @contextmanager
+    def connect(self) -> Iterator[SendFunction]:
+        with self._mailer.session() as session:
+            yield lambda notification: session.send(
+                notification.title, notification.message
+            )
+
+
+@register_channel
+class WebhookChannel(NotificationChannel):
+    """Post notifications as json to an url: title, message and serialized issues"""
+
+    name = "webhook"
+
+    def __init__(
+        self,
+        url: str,
+        timeout: float = 10.0,
+        headers: Optional[Dict[str, str]] = None,
+        **options: Any,
+    ):
+        """
+        Args:
+            url (str): Url to post notifications to
+            timeout (float): Seconds to wait for a response. Defaults to 10.0.
+            headers (Optional[Dict[str, str]]): Extra headers for every request, like authorization. Defaults to None.
+            options: Options for NotificationChannel
+        """
+        super().__init__(**options)
+        self._url = url
+        self._timeout = timeout
+        self._headers = headers or {}
+
+    @contextmanager
+    def connect(self) -> Iterator[SendFunction]:
+        # Keep-alive session shared by every request of this worker
+        with req.Session() as session:
+            session.headers.update(self._headers)
+
+            def send(notification: Notification):
+                response = session.post(
+                    self._url,
+                    json={
+                        "title": notification.title,
+                        "message": notification.message,
+                        "issues": notification.payload,
+                    },
+                    timeout=self._timeout,
+                )
+                response.raise_for_status()
+
+            yield send
+
+
+class NotificationDispatcher:
+    """Queue notifications for every channel, and deliver them with a pool of workers per channel.
+    A channel is delivered by a single dispatcher at a time, holding the channel's lease, so
+    concurrent dispatchers never exceed the concurrency of a channel
+    """
+
+    def __init__(
+        self,
+        channels: Optional[Dict[str, NotificationChannel]] = None,
+        claim_timeout_seconds: float = NOTIFICATION_CLAIM_TIMEOUT_SECONDS,
+    ):
+        """
+        Args:
+            channels (Optional[Dict[str, NotificationChannel]]): Channels by name. Defaults to NOTIFICATION_CHANNELS.
+            claim_timeout_seconds (float): Notifications and channel leases taken by a worker that didn't finish
+                after this many seconds can be taken again. Defaults to NOTIFICATION_CLAIM_TIMEOUT_SECONDS.
+        """
+        self._channels = (
+            channels if channels is not None else create_channels(NOTIFICATION_CHANNELS)
+        )
+        self._claim_timeout = timedelta(seconds=claim_timeout_seconds)
+
+    @property
+    def channels(self) -> Dict[str, NotificationChannel]:
+        """Channels of this dispatcher by name"""
+        return self._channels
+
+    def enqueue(
+        self, notifications: List[Tuple[str, str, List[Dict[str, Any]]]]
+    ) -> List[Notification]:
+        """Queue the given notifications for every channel. Notifications beyond the max pending
+        notifications of a channel are stored as dropped instead, so a channel that can't keep up
+        doesn't grow the queue forever
+
+        Args:
+            notifications (List[Tuple[str, str, List[Dict[str, Any]]]]): Title, message and payload for every notification
+
+        Returns:
+            List[Notification]: Stored notifications
+        """
+        if not notifications:
+            return []
+
+        created = []
+        for (name, channel) in self._channels.items():
+            pending = Notification.objects.filter(
+                channel=name,
+                status__in=[Notification.Status.PENDING, Notification.Status.SENDING],
+            ).count()
+            free = max(channel.max_pending - pending, 0)
+
+            created.extend(
+                Notification(
+                    channel=name,
+                    title=title,
+                    message=message,
+                    payload=payload,
+                    status=Notification.Status.PENDING
+                    if i < free
+                    else Notification.Status.DROPPED,
+                )
+                for (i, (title, message, payload)) in enumerate(notifications)
+            )
+
+        return Notification.objects.bulk_create(created)
+
+    def deliver(self) -> Optional[datetime]:
+        """Deliver due notifications for every channel
+
+        Returns:
+            Optional[datetime]: When the next pending notification is due, None if there's nothing pending
+        """
+        for (name, channel) in self._channels.items():
+            self.deliver_channel(name, channel)
+
+        return self._next_attempt(list(self._channels))
+
+    def deliver_channel(self, name: str, channel: NotificationChannel) -> int:
+        """Take a batch of due notifications for a channel and deliver them with its workers.
+        Nothing is delivered if another dispatcher is delivering for the channel
+
+        Args:
+            name (str): Channel name
+            channel (NotificationChannel): Channel to deliver with
+
+        Returns:
+            int: How many notifications were sent
+        """
+        with self._lease(name) as leased:
+            if not leased:
+                return 0
+
+            notifications = self._claim(name, channel.batch_size)
+            if not notifications:
+                return 0
+
+            results = self._run_workers(channel, notifications)
+            return self._record(channel, results)
+
+    def next_run(self, name: str) -> Optional[datetime]:
+        """When the next delivery run for a channel should start: when its next pending notification
+        is due, but not before the lease of the dispatcher delivering it now expires
+
+        Args:
+            name (str): Channel name
+
+        Returns:
+            Optional[datetime]: When to deliver again, None if there's nothing pending
+        """
+        next_attempt = self._next_attempt([name])
+        leased_until = (
+            NotificationChannelLease.objects.filter(channel=name)
+            .values_list("leased_until", flat=True)
+            .first()
+        )
+        if next_attempt is None or leased_until is None:
+            return next_attempt
+
+        return max(next_attempt, leased_until)
+
+    def schedule(self, name: str, at: datetime) -> Optional[str]:
+        """Schedule the next delivery run for a channel, unless there's already one scheduled
+        for the same time or earlier. A run scheduled for later is replaced by this one, and
+        a run that should have started a claim timeout ago is considered lost
+
+        Args:
+            name (str): Channel name
+            at (datetime): When the run should start
+
+        Returns:
+            Optional[str]: Token to start the new run with, None if there's no need for a new run
+        """
+        token = uuid.uuid4().hex
+        self._create_lease(name)
+        scheduled = NotificationChannelLease.objects.filter(
+            Q(scheduled_at__isnull=True)
+            | Q(scheduled_at__gt=at)
+            | Q(scheduled_at__lt=timezone.now() - self._claim_timeout),
+            channel=name,
+        ).update(scheduled_at=at, scheduled_token=token)
+
+        return token if scheduled else None
+
+    def start_run(self, name: str, token: str) -> bool:
+        """Start the scheduled delivery run for a channel, so a new one can be scheduled
+
+        Args:
+            name (str): Channel name
+            token (str): Token of the run, as returned by 'schedule'
+
+        Returns:
+            bool: If the run is still the scheduled one. False if another run replaced it
+        """
+        return (
+            NotificationChannelLease.objects.filter(
+                channel=name, scheduled_token=token
+            ).update(scheduled_at=None, scheduled_token=None)
+            > 0
+        )
+
+    @contextmanager
+    def _lease(self, name: str) -> Iterator[bool]:
+        """Take the lease of a channel while in this context, if no other dispatcher holds it
+
+        Returns:
+            Iterator[bool]: If the lease was taken
+        """
+        now = timezone.now()
+        token = uuid.uuid4().hex
+        self._create_lease(name)
+        leased = NotificationChannelLease.objects.filter(
+            Q(leased_until__isnull=True) | Q(leased_until__lt=now), channel=name
+        ).update(leased_until=now + self._claim_timeout, lease_token=token)
+
+        if not leased:
+            yield False
+            return
+
+        try:
+            yield True
+        finally:
+            NotificationChannelLease.objects.filter(
+                channel=name, lease_token=token
+            ).update(leased_until=None, lease_token=None)
+
+    @staticmethod
+    def _create_lease(name: str):
+        NotificationChannelLease.objects.bulk_create(
+            [NotificationChannelLease(channel=name)], ignore_conflicts=True
+        )
+
+    @staticmethod
+    def _next_attempt(names: List[str]) -> Optional[datetime]:
+        """When the next pending notification for the given channels is due"""
+        pending = Notification.objects.filter(
+            channel__in=names, status=Notification.Status.PENDING
+        )
+
+        # Notifications without next attempt are due right away, like the ones left by batch limits
+        if pending.filter(next_attempt_at__isnull=True).exists():
+            return timezone.now()
+
+        return pending.aggregate(next_attempt=Min("next_attempt_at"))["next_attempt"]
+
+    def _claim(self, name: str, limit: int) -> List[Notification]:
+        """Mark due notifications for a channel as being sent, so no other worker takes them"""
+        now = timezone.now()
+        due = (
+            Q(status=Notification.Status.PENDING, next_attempt_at__isnull=True)
+            | Q(status=Notification.Status.PENDING, next_attempt_at__lte=now)
+            | Q(
+                status=Notification.Status.SENDING,
+                claimed_at__lt=now - self._claim_timeout,
+            )
+        )
+
+        with transaction.atomic():
+            ids = list(
+                Notification.objects.select_for_update(skip_locked=True)
+                .filter(due, channel=name)
+                .order_by("id")
+                .values_list("id", flat=True)[:limit]
+            )
+            Notification.objects.filter(id__in=ids).update(
+                status=Notification.Status.SENDING, claimed_at=now
+            )
+
+        return list(Notification.objects.filter(id__in=ids).order_by("id"))
+
+    @staticmethod
+    def _run_workers(
+        channel: NotificationChannel, notifications: List[Notification]
+    ) -> List[Tuple[Notification, Optional[Exception]]]:
+        """Deliver notifications with up to 'concurrency' workers, each one with its own connection
+
+        Returns:
+            List[Tuple[Notification, Optional[Exception]]]: Every notification with its delivery error, if any
+        """
+        pending: "queue.Queue[Notification]" = queue.Queue()
+        for notification in notifications:
+            pending.put(notification)
+
+        results: List[Tuple[Notification, Optional[Exception]]] = []
+        connection_errors: List[Exception] = []
+
+        def work():
+            try:
+                with channel.connect() as send:
+                    while True:
+                        try:
+                            notification = pending.get_nowait()
+                        except queue.Empty:
+                            return
+
+                        try:
+                            send(notification)
+                            results.append((notification, None))
+                        except Exception as e:
+                            results.append((notification, e))
+            except Exception as e:
+                connection_errors.append(e)
+
+        n_workers = min(channel.concurrency, len(notifications))
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            for _ in range(n_workers):
+                executor.submit(work)
+
+        # Notifications left behind by workers that couldn't connect
+        error = (
+            connection_errors[-1]
+            if connection_errors
+            else RuntimeError("No worker could deliver this notification")
+        )
+        while not pending.empty():
+            results.append((pending.get_nowait(), error))
+
+        return results
+
+    @staticmethod
+    def _record(
+        channel: NotificationChannel,
+        results: List[Tuple[Notification, Optional[Exception]]],
+    ) -> int:
+        """Store delivery results, scheduling a retry for failed notifications if possible
+
+        Returns:
+            int: How many notifications were sent
+        """
+        now = timezone.now()
+        sent = 0
+        for (notification, error) in results:
+            if error is None:
+                notification.status = Notification.Status.SENT
+                notification.sent_at = now
+                notification.last_error = None
+                sent += 1
+                continue
+
+            notification.attempts += 1
+            notification.last_error = f"{type(error).__name__}: {error}"
+            if notification.attempts > channel.max_retries:
+                notification.status = Notification.Status.FAILED
+            else:
+                notification.status = Notification.Status.PENDING
+                notification.next_attempt_at = now + channel.retry_delay(
+                    notification.attempts
+                )
+
+        Notification.objects.bulk_update(
+            [notification for (notification, _) in results],
+            fields=["status", "attempts", "next_attempt_at", "last_error", "sent_at"],
+        )
+
+        return sent
@@ -0,0 +1,498 @@
+"""
+    Concurrent fetcher for paginated ooni data
+"""
+# External imports
+from requests.adapters import HTTPAdapter
+from requests.exceptions import HTTPError, RequestException
+import requests as req
+
+# Local imports
+from blocking_early_warnings.settings import (
+    DATE_FORMAT,
+    OONI_FETCH_CONCURRENCY,
+    OONI_FETCH_WINDOW_HOURS,
+    OONI_FETCH_BUFFERED_PAGES,
+    OONI_MIN_PAGE_SIZE,
+    OONI_MAX_PAGE_SIZE,
+    OONI_TARGET_PAGE_SECONDS,
+    OONI_MAX_PAGE_BYTES,
+    OONI_REQUESTS_PER_SECOND,
+    OONI_REQUESTS_BURST,
+    OONI_MAX_RETRIES,
+    OONI_BACKOFF_SECONDS,
+    OONI_MAX_BACKOFF_SECONDS,
+)
+
+# Python imports
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from datetime import datetime, timedelta
+from urllib.parse import urlencode, urlsplit, urlunsplit, parse_qsl
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+import queue
+import random
+import threading
+import time
+
+# Status codes worth retrying, the rest of non 200 codes fail right away
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Marks the end of the pages of a window
+_WINDOW_DONE = object()
+
+
+class _WindowError:
+    """
+    Error raised while fetching a window, raised again by the consumer when reached
+    """
+
+    def __init__(self, error: Exception):
+        self.error = error
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket rate limiter. Tokens are refilled at 'rate' tokens per
+    second up to 'capacity', and every request consumes one of them
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        """
+        Parameters:
+            + rate : float = how many tokens are added each second
+            + capacity : int = max amount of tokens, namely how many requests can be performed in a burst
+        """
+        assert rate > 0, "rate should be greater than 0"
+        assert capacity > 0, "capacity should be greater than 0"
+
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = float(capacity)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, waiting until one is available
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self._capacity,
+                    self._tokens + (now - self._last_refill) * self._rate,
+                )
+                self._last_refill = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                wait = (1 - self._tokens) / self._rate
+
+            time.sleep(wait)
+
+
+class AdaptivePageSize:
+    """
+    Thread safe page size shared by every request of a fetcher. It grows while pages are
+    full and fast to retrieve, and shrinks when pages are slow or too big
+    """
+
+    def __init__(
+        self,
+        min_size: int = OONI_MIN_PAGE_SIZE,
+        max_size: int = OONI_MAX_PAGE_SIZE,
+        target_seconds: float = OONI_TARGET_PAGE_SECONDS,
+        max_bytes: int = OONI_MAX_PAGE_BYTES,
+    ):
+        """
+        Parameters:
+            + min_size : int = smallest page size to use
+            + max_size : int = biggest page size to use
+            + target_seconds : float = how long a page is expected to take at most
+            + max_bytes : int = how big a page is expected to be at most
+        """
+        assert (
+            0 < min_size <= max_size
+        ), "page size bounds should be positive and sorted"
+
+        self._min_size = min_size
+        self._max_size = max_size
+        self._target_seconds = target_seconds
+        self._max_bytes = max_bytes
+        self._value: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def get(self, requested: int) -> int:
+        """
+        Current page size. The first requested size is used as starting point
+        Parameters:
+            + requested : int = page size the caller would use
+        """
+        with self._lock:
+            if self._value is None:
+                self._value = min(max(requested, self._min_size), self._max_size)
+
+            return self._value
+
+    def update(self, page_size: int, n_results: int, seconds: float, n_bytes: int):
+        """
+        Adapt page size after a page was retrieved
+        Parameters:
+            + page_size : int = page size used for the request
+            + n_results : int = how many measurements were returned
+            + seconds : float = how long the request took
+            + n_bytes : int = response size
+        """
+        with self._lock:
+            if seconds > self._target_seconds or n_bytes > self._max_bytes:
+                self._value = max(self._min_size, page_size // 2)
+            elif seconds < self._target_seconds / 2 and n_results >= page_size:
+                # Only worth growing if the page was full, namely there's more data to fetch
+                self._value = min(self._max_size, page_size * 2)
+
+
+class OoniFetcher:
+    """
+    Fetch ooni pages for a time interval. The interval is split in sub windows that are
+    requested in parallel by a thread pool sharing a single keep-alive session, and pages
+    are returned in the same order as if they were requested one by one, as soon as
+    every page before them was returned.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = OONI_FETCH_CONCURRENCY,
+        window_hours: int = OONI_FETCH_WINDOW_HOURS,
+        buffered_pages: int = OONI_FETCH_BUFFERED_PAGES,
+        session: Optional[req.Session] = None,
+        rate_limiter: Optional[TokenBucket] = None,
+        page_size: Optional[AdaptivePageSize] = None,
+        max_retries: int = OONI_MAX_RETRIES,
+        backoff_seconds: float = OONI_BACKOFF_SECONDS,
+        max_backoff_seconds: float = OONI_MAX_BACKOFF_SECONDS,
+    ):
+        """
+        Parameters:
+            + concurrency : int = max number of windows to request at the same time
+            + window_hours : int = how many hours are requested by each window
+            + buffered_pages : int = max pages fetched ahead by every window that's not being consumed yet
+            + session : Session = session to perform requests with. A pooled session is created if not provided
+            + rate_limiter : TokenBucket = limiter shared by every request. Defaults to the configured ooni rate
+            + page_size : AdaptivePageSize = page size adaptation policy. Defaults to the configured bounds
+            + max_retries : int = how many times a failed request is retried
+            + backoff_seconds : float = base time to wait before retrying, doubled after every failure
+            + max_backoff_seconds : float = max time to wait before retrying
+        """
+        assert concurrency > 0, "concurrency should be greater than 0"
+        assert window_hours > 0, "window hours should be greater than 0"
+        assert buffered_pages > 0, "buffered pages should be greater than 0"
+
+        self._concurrency = concurrency
+        self._window_hours = window_hours
+        self._buffered_pages = buffered_pages
+        self._session = session or self._create_session(concurrency)
+        self._rate_limiter = rate_limiter or TokenBucket(
+            OONI_REQUESTS_PER_SECOND, OONI_REQUESTS_BURST
+        )
+        self._page_size = page_size or AdaptivePageSize()
+        self._max_retries = max_retries
+        self._backoff_seconds = backoff_seconds
+        self._max_backoff_seconds = max_backoff_seconds
+
+    @staticmethod
+    def _create_session(pool_size: int) -> req.Session:
+        """
+        Create a session whose connection pool can hold one keep-alive connection per worker
+        """
+        session = req.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+        return session
+
+    def split_interval(
+        self, since: datetime, until: datetime
+    ) -> List[Tuple[datetime, datetime]]:
+        """
+        Split [since, until) in consecutive windows of at most window_hours hours
+        Parameters:
+            + since : datetime = start of the interval
+            + until : datetime = end of the interval
+        Return:
+            List of (since, until) tuples, sorted by time
+        """
+        step = timedelta(hours=self._window_hours)
+        windows = []
+
+        start = since
+        while start < until:
+            end = min(start + step, until)
+            windows.append((start, end))
+            start = end
+
+        return windows
+
+    def iter_pages(
+        self,
+        ooni_endpoint: str,
+        args: Dict[str, Any],
+        since: datetime,
+        until: datetime,
+        date_format: str = DATE_FORMAT,
+    ) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Iterate over every page of measurements from "since" until "until".
+        Parameters:
+            + ooni_endpoint : str = ooni endpoint to request pages from
+            + args : dict = query arguments shared by every window, like country code or page size
+            + since : datetime = Start time for measurements
+            + until : datetime = End time for measurements
+            + date_format : str = format used for dates in the query
+        Return:
+            Iterator of measurement lists, one per page, sorted by window
+        """
+        return self.iter_sharded_pages(
+            ooni_endpoint=ooni_endpoint,
+            shards=[args],
+            since=since,
+            until=until,
+            date_format=date_format,
+        )
+
+    def iter_sharded_pages(
+        self,
+        ooni_endpoint: str,
+        shards: List[Dict[str, Any]],
+        since: datetime,
+        until: datetime,
+        date_format: str = DATE_FORMAT,
+    ) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Iterate over every page of measurements from "since" until "until" for each of
+        the given shards. Every shard is an independent query, and every (shard, window)
+        pair is requested by the same bounded pool.
+        At most 'concurrency' windows are in flight or waiting to be consumed at
+        any time, and every window holds at most 'buffered_pages' pages until it's
+        consumed, so memory usage stays bounded even for long intervals and windows.
+        Parameters:
+            + ooni_endpoint : str = ooni endpoint to request pages from
+            + shards : [dict] = query arguments for each shard, like country code, asn or page size
+            + since : datetime = Start time for measurements
+            + until : datetime = End time for measurements
+            + date_format : str = format used for dates in the query
+        Return:
+            Iterator of measurement lists, one per page, sorted by shard and window
+        """
+        windows = deque(
+            (args, start, end)
+            for args in shards
+            for (start, end) in self.split_interval(since, until)
+        )
+        pending: Deque[queue.Queue] = deque()
+        stop = threading.Event()
+
+        with ThreadPoolExecutor(max_workers=self._concurrency) as executor:
+
+            def submit_next():
+                args, start, end = windows.popleft()
+                window_args = {
+                    **args,
+                    "since": datetime.strftime(start, date_format),
+                    "until": datetime.strftime(end, date_format),
+                }
+                pages: queue.Queue = queue.Queue(maxsize=self._buffered_pages)
+                executor.submit(
+                    self._produce_window,
+                    f"{ooni_endpoint}?{urlencode(window_args)}",
+                    pages,
+                    stop,
+                )
+                pending.append(pages)
+
+            try:
+                while windows and len(pending) < self._concurrency:
+                    submit_next()
+
+                while pending:
+                    pages = pending[0]
+                    page = pages.get()
+                    if isinstance(page, _WindowError):
+                        raise page.error
+
+                    if page is not _WINDOW_DONE:
+                        yield page
+                        continue
+
+                    # Keep the pool busy with the next window once the current one is consumed
+                    pending.popleft()
+                    if windows:
+                        submit_next()
+            finally:
+                # Let workers waiting for free buffer space finish if the consumer stops early
+                stop.set()
+
+    def fetch_all(self, urls: List[str]) -> Iterator[Dict[str, Any]]:
+        """
+        Request a list of non paginated urls in parallel
+        Parameters:
+            + urls : [str] = urls to request
+        Return:
+            Iterator of json responses, in the same order as the given urls
+        """
+        with ThreadPoolExecutor(max_workers=self._concurrency) as executor:
+            yield from executor.map(self.fetch_json, urls)
+
+    def fetch_json(self, url: str) -> Dict[str, Any]:
+        """
+        Request a single url, returning its json content
+        Parameters:
+            + url : str = url to request
+        Return:
+            Decoded json response
+        """
+        print(f"requesting url: {url}")
+        return self._get(url).json()
+
+    def fetch_window(self, url: str) -> List[List[Dict[str, Any]]]:
+        """
+        Request every page for a single window, following the 'next_url' links
+        Parameters:
+            + url : str = url for the first page of this window
+        Return:
+            List of measurement lists, one per page
+        """
+        return list(self.iter_window(url))
+
+    def iter_window(self, url: str) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Iterate over every page for a single window as they're requested, following the 'next_url' links
+        Parameters:
+            + url : str = url for the first page of this window
+        Return:
+            Iterator of measurement lists, one per page
+        """
+        next_url = url
+
+        while next_url:
+            # Use the current adaptive page size, every page is requested by offset
+            next_url, page_size = self._resize_page(next_url)
+            print(f"next url is: {next_url}")
+
+            # Failed requests are retried from this same url, so previous pages are kept
+            start = time.monotonic()
+            response = self._get(next_url)
+
+            # Get data in json format
+            data = response.json()
+            results = data["results"]
+
+            if page_size is not None:
+                self._page_size.update(
+                    page_size=page_size,
+                    n_results=len(results),
+                    seconds=time.monotonic() - start,
+                    n_bytes=len(response.content),
+                )
+
+            yield results
+
+            # Where to get next page
+            next_url = data["metadata"]["next_url"]
+
+    def _produce_window(self, url: str, pages: queue.Queue, stop: threading.Event):
+        """
+        Put every page of a window in the given queue as they're requested, followed by _WINDOW_DONE,
+        or by a _WindowError if some request fails. Gives up as soon as 'stop' is set
+        Parameters:
+            + url : str = url for the first page of this window
+            + pages : Queue = bounded queue read by the consumer, in window order
+            + stop : Event = set when the consumer doesn't want more pages
+        """
+
+        def put(item: Any) -> bool:
+            # Wait for free space in the queue, unless the consumer already stopped
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+
+            return False
+
+        try:
+            for page in self.iter_window(url):
+                if not put(page):
+                    return
+
+            put(_WINDOW_DONE)
+        except Exception as e:
+            put(_WindowError(e))
+
+    def _resize_page(self, url: str) -> Tuple[str, Optional[int]]:
+        """
+        Replace the 'limit' argument of the given url with the current page size
+        Parameters:
+            + url : str = url to resize
+        Return:
+            The resized url and its page size, or the same url and None if it has no limit
+        """
+        parts = urlsplit(url)
+        query = dict(parse_qsl(parts.query))
+        if "limit" not in query:
+            return url, None
+
+        page_size = self._page_size.get(int(query["limit"]))
+        query["limit"] = str(page_size)
+
+        return urlunsplit(parts._replace(query=urlencode(query))), page_size
+
+    def _get(self, url: str) -> req.Response:
+        """
+        Perform a rate limited get request, retrying with exponential backoff and jitter
+        on connection errors or retryable status codes
+        Parameters:
+            + url : str = url to request
+        Return:
+            A successful response
+        """
+        attempt = 0
+        while True:
+            self._rate_limiter.acquire()
+
+            retry_after = None
+            try:
+                response = self._session.get(url)
+            except RequestException as e:
+                error = e
+            else:
+                if response.status_code == 200:
+                    return response
+
+                if response.status_code not in RETRY_STATUS_CODES:
+                    raise HTTPError(
+                        f"Could not retrieve ooni data, status code: {response.status_code}"
+                    )
+
+                error = HTTPError(
+                    f"Could not retrieve ooni data, status code: {response.status_code}"
+                )
+                retry_after = response.headers.get("Retry-After")
+
+            if attempt >= self._max_retries:
+                raise HTTPError("Could not retrieve ooni data") from error
+
+            # Full jitter, unless the server told us how long to wait
+            backoff = min(
+                self._max_backoff_seconds, self._backoff_seconds * 2**attempt
+            )
+            wait = random.uniform(0, backoff)
+            if retry_after is not None and retry_after.isdigit():
+                wait = max(wait, float(retry_after))
+
+            print(f"Request to {url} failed ({error}), retrying in {wait:.1f}s")
+            time.sleep(wait)
+            attempt += 1
@@ -2,25 +2,57 @@
     Functions to request data from ooni and save it to database if needed
 """
 # External imports
+from django.db import transaction
 from django.db.models import Max
 from pytz import utc
-from requests.exceptions import HTTPError
-import requests as req
 
 # Local imports
-from blocking_early_warnings.models import Metric, ASN, Url
+from blocking_early_warnings.models import Metric, ASN, Url, SyncCursor
 from blocking_early_warnings.settings import (
     OONI_ENDPOINT,
+    OONI_AGGREGATION_ENDPOINT,
+    INGESTION_STRATEGY,
     DATE_FORMAT,
     COUNTRY_CODE,
     NUMBER_OF_HOURS,
+    STREAMING_INGESTION,
+    SYNC_OVERLAP_HOURS,
+    METRIC_WRITE_CHUNK_SIZE,
+    MEASUREMENT_ARCHIVE_DIR,
+    OONI_SHARDED_QUERIES,
+    OONI_INPUT_FILTER_MAX_URLS,
+    OONI_PAGE_SIZE,
+    UPDATE_METRIC_ROLLUPS,
+    METRIC_SERIES_STORAGE,
+    UPDATE_RUNNING_STATISTICS,
 )
-from blocking_early_warnings.utils.misc import get_hour_from_str, get_hour
+from blocking_early_warnings.utils.misc import (
+    get_hour_from_time_str,
+    get_hour,
+    Accumulator,
+)
+from blocking_early_warnings.utils.ooni_fetcher import OoniFetcher
+from blocking_early_warnings.utils.measurement_archive import MeasurementArchive
+from blocking_early_warnings.utils.rollups import RollupManager
+from blocking_early_warnings.utils.metric_series import MetricSeriesStore
+from blocking_early_warnings.utils.running_statistics import RunningStatisticsManager
+from blocking_early_warnings.utils.anomaly_monitor import IssueDescription
 
 # Python imports
 from datetime import datetime, timedelta
+from enum import Enum
 from urllib.parse import urlencode
-from typing import Any, Dict, Optional, Tuple, List, Dict
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple, List, Dict
+
+
+class IngestionStrategy(Enum):
+    """Possible ways to get hourly counts from ooni
+    measurements: download every raw measurement and count them locally
+    aggregation: request counts already aggregated by the ooni aggregation api
+    """
+
+    MEASUREMENTS = "measurements"
+    AGGREGATION = "aggregation"
 
 
 class DBMetricsClient:
@@ -32,67 +64,291 @@ class DBMetricsClient:
         date_format: str = DATE_FORMAT,
         country_code: str = COUNTRY_CODE,
         ooni_endpoint: str = OONI_ENDPOINT,
+        streaming: bool = STREAMING_INGESTION,
+        fetcher: Optional[OoniFetcher] = None,
+        overlap_hours: int = SYNC_OVERLAP_HOURS,
+        write_chunk_size: int = METRIC_WRITE_CHUNK_SIZE,
+        ingestion_strategy: str = INGESTION_STRATEGY,
+        ooni_aggregation_endpoint: str = OONI_AGGREGATION_ENDPOINT,
+        archive_dir: Optional[str] = MEASUREMENT_ARCHIVE_DIR,
+        sharded: bool = OONI_SHARDED_QUERIES,
+        input_filter_max_urls: int = OONI_INPUT_FILTER_MAX_URLS,
+        page_size: int = OONI_PAGE_SIZE,
+        update_rollups: bool = UPDATE_METRIC_ROLLUPS,
+        store_series: bool = METRIC_SERIES_STORAGE,
+        update_statistics: bool = UPDATE_RUNNING_STATISTICS,
     ):
 
         self._number_of_hours = number_of_hours
         self._date_format = date_format
         self._country_code = country_code
         self._ooni_endpoint = ooni_endpoint
+        self._streaming = streaming
+        self._fetcher = fetcher or OoniFetcher()
+        self._overlap_hours = overlap_hours
+        self._write_chunk_size = write_chunk_size
+        self._ingestion_strategy = IngestionStrategy(ingestion_strategy)
+        self._ooni_aggregation_endpoint = ooni_aggregation_endpoint
+        self._sharded = sharded
+        self._page_size = page_size
+        self._input_filter_max_urls = input_filter_max_urls
+        self._archive = (
+            MeasurementArchive(archive_dir, country_code) if archive_dir else None
+        )
+        self._rollups = RollupManager() if update_rollups else None
+        self._series = MetricSeriesStore() if store_series else None
+        self._statistics = RunningStatisticsManager() if update_statistics else None
 
-    def sync_db_metrics(self, number_of_hours: Optional[int] = None):
+    def sync_db_metrics(
+        self, number_of_hours: Optional[int] = None, streaming: Optional[bool] = None
+    ) -> List[IssueDescription]:
         """
-        Sync metrics with current ooni data
+        Sync metrics with current ooni data. Only hours after the country's sync cursor
+        (minus a few overlap hours) are requested, and the cursor is moved forward in the
+        same transaction that stores the new metrics.
+        Parameters:
+            + number_of_hours : int = how many hours back to sync at most. Defaults to the client's number of hours
+            + streaming : bool = fold every page into hourly counters as soon as it arrives instead
+                of keeping every raw measurement in memory. Defaults to the client's configuration
+        Return:
+            Spikes found in newly synced hours by the running statistics, empty if they're disabled
         """
 
         number_of_hours = number_of_hours or self._number_of_hours
 
         # Compute required time interval from now until NUMBER_OF_HOURS before
         now = get_hour(datetime.now(tz=utc))
-        yesterday = now - timedelta(hours=number_of_hours)
+        since = now - timedelta(hours=number_of_hours)
+
+        # Start from the cursor if there's one, requesting a few hours again to catch late measurements
+        cursor = SyncCursor.objects.filter(country_code=self._country_code).first()
+        overwrite_since = None
+        if cursor is not None and cursor.last_hour is not None:
+            since = max(
+                since,
+                cursor.last_hour + timedelta(hours=1 - self._overlap_hours),
+            )
+            overwrite_since = since
+
+        if since >= now:
+            return []
+
+        metrics = self.get_interval_metrics(since=since, until=now, streaming=streaming)
+
+        # Metrics and cursor are committed together, so a failed sync is fully retried next time
+        with transaction.atomic():
+            self._store_metrics(metrics, overwrite_since=overwrite_since)
+            spikes = self._update_derived_metrics(since=since, until=now)
+            SyncCursor.objects.update_or_create(
+                country_code=self._country_code,
+                defaults={"last_hour": now - timedelta(hours=1)},
+            )
+
+        return spikes
+
+    def sync_interval(
+        self, since: datetime, until: datetime, streaming: Optional[bool] = None
+    ):
+        """
+        Sync metrics from "since" until "until", overwriting already stored metrics in
+        this interval. The sync cursor is not modified, so this can be used to fill
+        any interval in the past. Running statistics are not updated, since they can only
+        fold hours in order: rebuild them after filling past intervals
+        Parameters:
+            + since : datetime = Start time for measurements
+            + until : datetime = End time for measurements
+            + streaming : bool = Fold pages into counters as they arrive. Defaults to the client's configuration
+        """
+        since, until = get_hour(since), get_hour(until)
+        metrics = self.get_interval_metrics(
+            since=since, until=until, streaming=streaming
+        )
+
+        with transaction.atomic():
+            self._store_metrics(metrics, overwrite_since=since)
+            self._update_derived_metrics(
+                since=since, until=until, update_statistics=False
+            )
+
+    def get_interval_metrics(
+        self, since: datetime, until: datetime, streaming: Optional[bool] = None
+    ) -> Iterable[Tuple[Tuple[str, str], Dict[datetime, Dict[str, int]]]]:
+        """
+        Get hourly counters from "since" until "until" using the configured ingestion strategy
+        Parameters:
+            + since : datetime = Start time for measurements, should be an exact hour
+            + until : datetime = End time for measurements, should be an exact hour
+            + streaming : bool = Fold pages into counters as they arrive. Defaults to the client's configuration
+        Return:
+            [((url, asn), {hour : {count, anomaly_count}})] hourly counters for each pair of url and asn
+        """
+        streaming = self._streaming if streaming is None else streaming
+
+        if self._ingestion_strategy == IngestionStrategy.AGGREGATION:
+            # Counts are computed by ooni, so no measurement is downloaded
+            return self.get_metrics_from_ooni_aggregation(
+                since=since, until=until
+            ).items()
+
+        if streaming:
+            # Measurements are counted page by page, so only counters are kept in memory
+            return self.get_metrics_from_ooni(
+                since=since, until=until, page_size=self._page_size
+            ).items()
 
         # Get ooni data
-        data = self.get_raw_data_from_ooni(since=yesterday, until=now, page_size=5000)
+        data = self.get_raw_data_from_ooni(
+            since=since, until=until, page_size=self._page_size
+        )
         # Process data
-        metrics = map(
-            lambda k: (k[0], self.compute_metrics(k[1], since=get_hour(yesterday))),
+        hours = int((until - since) / timedelta(hours=1))
+        return map(
+            lambda k: (
+                k[0],
+                self.compute_metrics(k[1], since=since, number_of_hours=hours),
+            ),
             data.items(),
         )
 
-        url_map = {url.url: url for url in Url.objects.all()}
-        asn_map = {asn.code: asn for asn in ASN.objects.all()}
+    def replay_from_archive(self, since: datetime, until: datetime):
+        """
+        Rebuild metrics from "since" until "until" using archived measurements only,
+        without requesting anything to ooni. Stored metrics in this interval are
+        overwritten. Like in sync_interval, running statistics are not updated
+        Parameters:
+            + since : datetime = Start time for measurements
+            + until : datetime = End time for measurements
+        """
+        if self._archive is None:
+            raise ValueError(
+                "Can't replay metrics because there's no archive directory configured"
+            )
 
-        for m in metrics:
-            # deconstruct m in url, asn, and data
-            ((url, asn), data) = m
+        watched_urls, watched_asns = self._get_watched_urls_asns()
+        since = get_hour(since)
+
+        counters = {}
+        for page in self._archive.iter_pages(since=since, until=until):
+            self.fold_measurements(
+                page,
+                counters,
+                since=since,
+                until=until,
+                watched_urls=watched_urls,
+                watched_asns=watched_asns,
+            )
 
-            url_obj, asn_obj = url_map[url], asn_map[asn]
-            # Use max hour to filter metrics that should not be added as they already have a previous version
-            max_hour = (
-                Metric.objects.all()
-                .filter(asn=asn_obj, url=url_obj)
-                .aggregate(Max("hour"))["hour__max"]
+        with transaction.atomic():
+            self._store_metrics(counters.items(), overwrite_since=since)
+            self._update_derived_metrics(
+                since=since, until=until, update_statistics=False
             )
-            max_hour = max_hour or datetime(1970, 1, 1, tzinfo=utc)
 
-            for d in data.items():
+    def _update_derived_metrics(
+        self, since: datetime, until: datetime, update_statistics: bool = True
+    ) -> List[IssueDescription]:
+        """
+        Recompute daily and weekly rollups, and packed daily series, for periods touched by
+        metrics from "since" until "until", and fold new hours into the running statistics.
+        Each of them is only updated if enabled
+        Parameters:
+            + update_statistics : bool = fold new hours into the running statistics, if enabled.
+                Only syncs moving forward should fold them, since hours are folded in order
+        Return:
+            Spikes found by the running statistics in newly folded hours
+        """
+        if self._rollups is not None:
+            self._rollups.update(since=since, until=until)
 
-                (hour, data_metrics) = d
+        if self._series is not None:
+            self._series.convert_from_metrics(since=since, until=until)
 
-                # Dont create empty metrics as it will blow up the database quite fast
-                if data_metrics["count"] == 0:
-                    continue
+        if update_statistics and self._statistics is not None:
+            return self._statistics.update(since=since)
 
-                # Don't add metrics that are more recent than the most recent one
-                if hour <= (max_hour):
-                    continue
+        return []
+
+    def _store_metrics(
+        self,
+        metrics: Iterable[Tuple[Tuple[str, str], Dict[datetime, Dict[str, int]]]],
+        overwrite_since: Optional[datetime] = None,
+    ):
+        """
+        Store computed metrics in the database
+        Parameters:
+            + metrics : [((url, asn), {hour : {count, anomaly_count}})] = hourly counters for each
+                pair of url and asn, as returned by compute_metrics
+            + overwrite_since : datetime = metrics for this hour or later are updated even if
+                already stored. If not provided, already stored hours are never updated
+        """
+        url_ids = dict(Url.objects.values_list("url", "id"))
+        asn_ids = dict(ASN.objects.values_list("code", "id"))
+
+        # Use max hour to filter metrics that should not be added as they already have a previous version.
+        # Not needed when refreshing an interval, as every new metric is inside of it
+        max_hours = self._get_max_hours() if overwrite_since is None else {}
+        min_hour = datetime(1970, 1, 1, tzinfo=utc)
+
+        # Write metrics in chunks, updating counts for already existing hours
+        accumulator = Accumulator(
+            callback=lambda chunk: Metric.objects.bulk_create(
+                chunk,
+                update_conflicts=True,
+                unique_fields=["url", "asn", "hour"],
+                update_fields=["anomaly_count", "measurement_count"],
+            ),
+            queue=[],
+            treshold=self._write_chunk_size,
+        )
+
+        with transaction.atomic():
+            for m in metrics:
+                # deconstruct m in url, asn, and data
+                ((url, asn), data) = m
+
+                url_id, asn_id = url_ids[url], asn_ids[asn]
+                max_hour = max_hours.get((url_id, asn_id)) or min_hour
+
+                for d in data.items():
+
+                    (hour, data_metrics) = d
+
+                    # Dont create empty metrics as it will blow up the database quite fast
+                    if data_metrics["count"] == 0:
+                        continue
+
+                    # Don't add metrics that are more recent than the most recent one,
+                    # unless they're inside the interval being refreshed
+                    if hour <= max_hour and (
+                        overwrite_since is None or hour < overwrite_since
+                    ):
+                        continue
+
+                    accumulator.add(
+                        Metric(
+                            hour=hour,
+                            url_id=url_id,
+                            asn_id=asn_id,
+                            anomaly_count=data_metrics["anomaly_count"],
+                            measurement_count=data_metrics["count"],
+                        )
+                    )
+
+            accumulator.flush()
+
+    def _get_max_hours(self) -> Dict[Tuple[int, int], datetime]:
+        """
+        Helper function to get the most recent stored hour for every pair of
+        url id and asn id, using a single grouped query
+        """
+        rows = (
+            Metric.objects.filter(hour__isnull=False)
+            .values("url_id", "asn_id")
+            .annotate(max_hour=Max("hour"))
+            .order_by()
+        )
 
-                Metric.objects.update_or_create(
-                    hour=hour,
-                    anomaly_count=data_metrics["anomaly_count"],
-                    measurement_count=data_metrics["count"],
-                    url=url_obj,
-                    asn=asn_obj,
-                )
+        return {(row["url_id"], row["asn_id"]): row["max_hour"] for row in rows}
 
     def compute_metrics(
         self,
@@ -136,9 +392,11 @@ class DBMetricsClient:
         }
 
         for measurement in measurements:
-            hour = get_hour_from_str(start_time(measurement))
+            hour = get_hour_from_time_str(start_time(measurement))
 
-            metrics = classified[hour]
+            # Ignore measurements outside of the requested interval
+            if (metrics := classified.get(hour)) is None:
+                continue
 
             metrics["anomaly_count"] += measurement["anomaly"]
             metrics["count"] += 1
@@ -169,57 +427,269 @@ class DBMetricsClient:
             dict with the specified data format
         """
 
-        assert page_size > 0, "page size should be greater than 0"
+        # Classify retrieved data based on url,asn
+        classifier_dict = self._get_classifier_dict_url_asns()
+        watched_urls, watched_asns = self._get_watched_urls_asns()
+
+        for page in self.iter_pages_from_ooni(
+            since=since,
+            until=until,
+            country_code=country_code,
+            page_size=page_size,
+            ooni_endpoint=ooni_endpoint,
+            date_format=date_format,
+            shards=self.get_query_shards(watched_urls, watched_asns),
+        ):
+            for item in page:
+                asn = item["probe_asn"]
+                url = item["input"]
+
+                if (curr_list := classifier_dict.get((url, asn))) is not None:
+                    curr_list.append(item)
+
+        return classifier_dict
+
+    def get_metrics_from_ooni(
+        self,
+        since: datetime,
+        until: datetime,
+        country_code: Optional[str] = None,
+        page_size: int = 1000,
+        ooni_endpoint: Optional[str] = None,
+        date_format: Optional[str] = None,
+    ) -> Dict[Tuple[str, str], Dict[datetime, Dict[str, int]]]:
+        """
+        Streaming version of get_raw_data_from_ooni + compute_metrics. Every page is folded
+        into hourly counters as soon as it's decoded and then dropped, so memory usage depends
+        on the number of watched pairs instead of the number of measurements:
+            {
+                (url, asn) : {
+                    hour : { count : int, anomaly_count : int }
+                }
+            }
+        Only pairs and hours with at least one measurement are present in the result.
+        Parameters:
+            + since : datetime = Start time for measurements
+            + until : datetime = End time for measurements
+            + country_code  : str = Country code that all measurements should have
+            + page_size     : int = how many measurements request for each page
+        Return:
+            dict with the specified data format
+        """
+        watched_urls, watched_asns = self._get_watched_urls_asns()
+
+        counters = {}
+        for page in self.iter_pages_from_ooni(
+            since=since,
+            until=until,
+            country_code=country_code,
+            page_size=page_size,
+            ooni_endpoint=ooni_endpoint,
+            date_format=date_format,
+            shards=self.get_query_shards(watched_urls, watched_asns),
+        ):
+            self.fold_measurements(
+                page,
+                counters,
+                since=get_hour(since),
+                until=until,
+                watched_urls=watched_urls,
+                watched_asns=watched_asns,
+            )
+
+        return counters
 
+    def get_metrics_from_ooni_aggregation(
+        self,
+        since: datetime,
+        until: datetime,
+        country_code: Optional[str] = None,
+        ooni_aggregation_endpoint: Optional[str] = None,
+        date_format: Optional[str] = None,
+    ) -> Dict[Tuple[str, str], Dict[datetime, Dict[str, int]]]:
+        """
+        Get hourly counters from the ooni aggregation api, with the same format as
+        get_metrics_from_ooni. A request is performed for every watched asn, asking for
+        counts grouped by hour and input.
+
+        Note that ooni splits anomalies in confirmed and non confirmed ones, both of them
+        are counted as anomalies here.
+        Parameters:
+            + since : datetime = Start time for measurements
+            + until : datetime = End time for measurements
+            + country_code  : str = Country code that all measurements should have
+        Return:
+            dict with the specified data format
+        """
         # Setup default arguments
         country_code = country_code or self._country_code
-        ooni_endpoint = ooni_endpoint or self._ooni_endpoint
+        ooni_aggregation_endpoint = (
+            ooni_aggregation_endpoint or self._ooni_aggregation_endpoint
+        )
         date_format = date_format or self._date_format
 
-        # Set up arguments
-        since_str = datetime.strftime(since, date_format)
-        until_str = datetime.strftime(until, date_format)
+        watched_urls, watched_asns = self._get_watched_urls_asns()
+        asns = sorted(watched_asns)
 
         args = {
-            "since": since_str,
-            "until": until_str,
             "probe_cc": country_code,
-            "limit": page_size,
+            "since": datetime.strftime(since, date_format),
+            "until": datetime.strftime(until, date_format),
+            "axis_x": "measurement_start_day",
+            "axis_y": "input",
+            "time_grain": "hour",
         }
+        urls = [
+            f"{ooni_aggregation_endpoint}?{urlencode({**args, 'probe_asn': asn})}"
+            for asn in asns
+        ]
+
+        counters = {}
+        for (asn, response) in zip(asns, self._fetcher.fetch_all(urls)):
+            for row in response["result"]:
+                url = row["input"]
+                if url not in watched_urls or not row["measurement_count"]:
+                    continue
 
-        next_url = f"{ooni_endpoint}?{urlencode(args)}"
+                hour = get_hour_from_time_str(row["measurement_start_day"])
+                if not (since <= hour < until):
+                    continue
 
-        acc = []
+                if (pair_counters := counters.get((url, asn))) is None:
+                    pair_counters = counters[(url, asn)] = {}
 
-        while next_url:
-            print(f"next url is: {next_url}")
-            # Perform get request
-            request = req.get(next_url)
+                pair_counters[hour] = {
+                    "count": row["measurement_count"],
+                    "anomaly_count": row["anomaly_count"] + row["confirmed_count"],
+                }
 
-            # check if everything went ok
-            if request.status_code != 200:
-                raise HTTPError("Could not retrieve ooni data")
+        return counters
 
-            # Get data in json format
-            data = request.json()
+    def fold_measurements(
+        self,
+        measurements: Iterable[Dict[str, Any]],
+        counters: Dict[Tuple[str, str], Dict[datetime, Dict[str, int]]],
+        since: datetime,
+        until: datetime,
+        watched_urls: Iterable[str],
+        watched_asns: Iterable[str],
+    ):
+        """
+        Add the given measurements to the provided per (url, asn, hour) counters. Counters for
+        a pair or an hour are created the first time a measurement for them is found.
+        Measurements for non-watched pairs or outside the [since, until) interval are ignored.
+        Parameters:
+            + measurements : [dict] = List of measurement metadata as it comes from ooni
+            + counters : dict = counters to update, with the format returned by get_metrics_from_ooni
+            + since : datetime = earliest hour to count
+            + until : datetime = hour where counting stops
+            + watched_urls : {str} = urls to count measurements for
+            + watched_asns : {str} = asn codes to count measurements for
+        """
+        for measurement in measurements:
+            url = measurement["input"]
+            asn = measurement["probe_asn"]
 
-            metadata = data["metadata"]
-            acc.extend(data["results"])
+            if url not in watched_urls or asn not in watched_asns:
+                continue
 
-            # Where to get next page
-            next_url = metadata["next_url"]
+            hour = get_hour_from_time_str(measurement["measurement_start_time"])
+            if not (since <= hour < until):
+                continue
 
-        # Classify retrieved data based on url,asn
-        classifier_dict = self._get_classifier_dict_url_asns()
+            if (pair_counters := counters.get((url, asn))) is None:
+                pair_counters = counters[(url, asn)] = {}
 
-        for item in acc:
-            asn = item["probe_asn"]
-            url = item["input"]
+            if (metrics := pair_counters.get(hour)) is None:
+                metrics = pair_counters[hour] = {"count": 0, "anomaly_count": 0}
 
-            if (curr_list := classifier_dict.get((url, asn))) is not None:
-                curr_list.append(item)
+            metrics["anomaly_count"] += measurement["anomaly"]
+            metrics["count"] += 1
 
-        return classifier_dict
+    def iter_pages_from_ooni(
+        self,
+        since: datetime,
+        until: datetime,
+        country_code: Optional[str] = None,
+        page_size: int = 1000,
+        ooni_endpoint: Optional[str] = None,
+        date_format: Optional[str] = None,
+        shards: Optional[List[Dict[str, str]]] = None,
+    ) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Iterate over ooni measurement pages from "since" until "until". Every page is a list
+        of measurements as they come from ooni. Pages are requested by the client's fetcher,
+        which may request a few time windows in parallel, but they're always returned in order.
+        If an archive is configured, every page is archived before being returned.
+        Parameters:
+            + since : datetime = Start time for measurements
+            + until : datetime = End time for measurements
+            + country_code  : str = Country code that all measurements should have
+            + page_size     : int = how many measurements request for each page
+            + shards        : [dict] = extra filters for each independent query, as returned by get_query_shards.
+                If not provided, every measurement in the country is requested with a single query
+        Return:
+            Iterator of measurement lists, one per page
+        """
+
+        assert page_size > 0, "page size should be greater than 0"
+
+        # Setup default arguments
+        country_code = country_code or self._country_code
+        ooni_endpoint = ooni_endpoint or self._ooni_endpoint
+        date_format = date_format or self._date_format
+
+        # Set up arguments
+        args = {
+            "probe_cc": country_code,
+            "limit": page_size,
+        }
+
+        pages = self._fetcher.iter_sharded_pages(
+            ooni_endpoint=ooni_endpoint,
+            shards=[
+                {**args, **shard} for shard in (shards if shards is not None else [{}])
+            ],
+            since=since,
+            until=until,
+            date_format=date_format,
+        )
+
+        if self._archive is None:
+            yield from pages
+            return
+
+        try:
+            for page in pages:
+                self._archive.write_page(page)
+                yield page
+        finally:
+            self._archive.save_index()
+
+    def get_query_shards(
+        self, watched_urls: Iterable[str], watched_asns: Iterable[str]
+    ) -> List[Dict[str, str]]:
+        """
+        Split a query for the given urls and asns in independent shards, so filters are
+        performed by ooni and only measurements we store are downloaded. There's a shard
+        per asn, further split by input when there are only a few urls to watch.
+        Parameters:
+            + watched_urls : {str} = urls to request measurements for
+            + watched_asns : {str} = asn codes to request measurements for
+        Return:
+            List of extra query arguments, one per shard. A single shard without extra
+            arguments is returned if sharding is disabled
+        """
+        if not self._sharded:
+            return [{}]
+
+        asns = sorted(watched_asns)
+        urls = sorted(watched_urls)
+
+        if len(urls) <= self._input_filter_max_urls:
+            return [{"probe_asn": asn, "input": url} for asn in asns for url in urls]
+
+        return [{"probe_asn": asn} for asn in asns]
 
     def _get_classifier_dict_url_asns(self) -> Dict[Tuple[str, str], List[Any]]:
         """
@@ -238,3 +708,13 @@ class DBMetricsClient:
                 cl_dict[(url.url, asn.code)] = []
 
         return cl_dict
+
+    def _get_watched_urls_asns(self) -> Tuple[set, set]:
+        """
+        Helper function to get the set of urls and the set of asn codes whose
+        measurements should be counted
+        """
+        watched_urls = set(Url.objects.values_list("url", flat=True))
+        watched_asns = set(ASN.objects.values_list("code", flat=True))
+
+        return watched_urls, watched_asns
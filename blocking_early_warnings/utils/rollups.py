@@ -0,0 +1,189 @@
+"""
+    Daily and weekly metric rollups, so long range queries don't have to read hourly metrics
+"""
+# Django imports
+from django.db import connection, transaction
+from django.db.models import Max, Min, QuerySet, Sum
+from django.db.models.functions import TruncDay, TruncWeek
+
+# Local imports
+from blocking_early_warnings.models import Metric, MetricRollup
+
+# Python imports
+from datetime import datetime, timedelta
+from itertools import chain
+from typing import Iterable, Iterator, Tuple
+from pytz import utc
+import zlib
+
+Resolution = MetricRollup.Resolution
+
+
+class RollupManager:
+    """Keep daily and weekly rollups up to date with hourly metrics. Rollups are stored per (url, asn),
+    and per asn for every url.
+
+    Daily rollups are computed from hourly metrics, and weekly rollups from daily rollups, so a week
+    only reads up to seven rows per (url, asn) and stays correct after its first hours are pruned.
+
+    Updates lock the weeks they refresh until they commit, so updates for the same period at
+    once, like a sync and a backfill, run one after the other instead of duplicating rollups
+    """
+
+    def update(self, since: datetime, until: datetime):
+        """Recompute every rollup whose period intersects with the interval from "since" until "until"
+
+        Args:
+            since (datetime): Start of the interval with updated metrics
+            until (datetime): End of the interval with updated metrics
+        """
+        with transaction.atomic():
+            self._lock_weeks(since, until)
+            self._rebuild_days(*self.covering_periods(since, until, Resolution.DAY))
+            self._rebuild_weeks(*self.covering_periods(since, until, Resolution.WEEK))
+
+    def rebuild_all(self):
+        """Recompute every rollup for the days still stored as hourly metrics. Rollups for days already
+        pruned from hourly metrics are kept as they are, including a first day that was only partially pruned
+        """
+        hours = Metric.objects.aggregate(first=Min("hour"), last=Max("hour"))
+        if hours["first"] is None:
+            return
+
+        (since, until) = self.covering_periods(
+            hours["first"], hours["last"] + timedelta(hours=1), Resolution.DAY
+        )
+        partially_pruned = (
+            since < hours["first"]
+            and MetricRollup.objects.filter(
+                resolution=Resolution.DAY, period_start=since
+            ).exists()
+        )
+        if partially_pruned:
+            since = self.next_period(since, Resolution.DAY)
+
+        with transaction.atomic():
+            self._lock_weeks(since, until)
+            self._rebuild_days(since, until)
+            self._rebuild_weeks(*self.covering_periods(since, until, Resolution.WEEK))
+
+    @staticmethod
+    def _lock_weeks(since: datetime, until: datetime):
+        """Lock every week intersecting the interval from "since" until "until" until the current
+        transaction ends. Weeks are locked in order, so updates can't deadlock. Only needed in
+        PostgreSQL, other databases already serialize writing transactions
+        """
+        if connection.vendor != "postgresql":
+            return
+
+        (week, end) = RollupManager.covering_periods(since, until, Resolution.WEEK)
+        with connection.cursor() as cursor:
+            while week < end:
+                key = zlib.crc32(f"metric_rollup:{week.isoformat()}".encode())
+                cursor.execute("SELECT pg_advisory_xact_lock(%s)", [key])
+                week = RollupManager.next_period(week, Resolution.WEEK)
+
+    def _rebuild_days(self, since: datetime, until: datetime):
+        """Replace daily rollups for days from "since" until "until" with values computed from hourly metrics"""
+        metrics = Metric.objects.filter(hour__gte=since, hour__lt=until).annotate(
+            period=TruncDay("hour", tzinfo=utc)
+        )
+
+        # One aggregate per (url, asn), and another one per asn for all urls
+        rows = chain(
+            self._aggregate(metrics.values("period", "url_id", "asn_id")),
+            self._aggregate(metrics.values("period", "asn_id")),
+        )
+        self._replace(Resolution.DAY, since, until, rows)
+
+    def _rebuild_weeks(self, since: datetime, until: datetime):
+        """Replace weekly rollups for weeks from "since" until "until" with the sum of their daily rollups"""
+        days = MetricRollup.objects.filter(
+            resolution=Resolution.DAY, period_start__gte=since, period_start__lt=until
+        ).annotate(period=TruncWeek("period_start", tzinfo=utc))
+
+        # Daily rollups without url add up to weekly rollups without url
+        rows = self._aggregate(days.values("period", "url_id", "asn_id"))
+        self._replace(Resolution.WEEK, since, until, rows)
+
+    @staticmethod
+    def _aggregate(qs: QuerySet) -> Iterator[dict]:
+        """Sum counts for every group in a "values" queryset with a "period" annotation"""
+        return (
+            qs.annotate(
+                anomaly_count_sum=Sum("anomaly_count"),
+                measurement_count_sum=Sum("measurement_count"),
+            )
+            .order_by()
+            .iterator()
+        )
+
+    @staticmethod
+    def _replace(
+        resolution: str, since: datetime, until: datetime, rows: Iterable[dict]
+    ):
+        """Replace rollups with periods from "since" until "until" with the given aggregated rows"""
+        new_rollups = [
+            MetricRollup(
+                resolution=resolution,
+                period_start=row["period"],
+                url_id=row.get("url_id"),
+                asn_id=row["asn_id"],
+                anomaly_count=row["anomaly_count_sum"],
+                measurement_count=row["measurement_count_sum"],
+            )
+            for row in rows
+        ]
+
+        MetricRollup.objects.filter(
+            resolution=resolution, period_start__gte=since, period_start__lt=until
+        ).delete()
+        MetricRollup.objects.bulk_create(new_rollups, batch_size=1000)
+
+    @staticmethod
+    def covering_periods(
+        since: datetime, until: datetime, resolution: str
+    ) -> Tuple[datetime, datetime]:
+        """Start of the first and end of the last period intersecting with the interval from "since" until "until"
+
+        Args:
+            since (datetime): Start of the interval
+            until (datetime): End of the interval
+            resolution (str): "day" or "week"
+
+        Returns:
+            Tuple[datetime, datetime]: Start of the first period, and start of the period after the last one
+        """
+        period_start = RollupManager.period_start(since, resolution)
+        period_end = RollupManager.period_start(until, resolution)
+        if period_end < until:
+            period_end = RollupManager.next_period(period_end, resolution)
+
+        return (period_start, period_end)
+
+    @staticmethod
+    def period_start(time: datetime, resolution: str) -> datetime:
+        """Start of the period containing the given time
+
+        Args:
+            time (datetime): Time to truncate
+            resolution (str): "day" or "week". Weeks start on monday
+
+        Returns:
+            datetime: Start of the period, in utc
+        """
+        time = time.astimezone(utc)
+        start = datetime(time.year, time.month, time.day, tzinfo=utc)
+
+        if resolution == Resolution.WEEK:
+            start -= timedelta(days=start.weekday())
+
+        return start
+
+    @staticmethod
+    def next_period(start: datetime, resolution: str) -> datetime:
+        """Start of the period following the one starting at 'start'"""
+        if resolution == Resolution.WEEK:
+            return start + timedelta(weeks=1)
+
+        return start + timedelta(days=1)
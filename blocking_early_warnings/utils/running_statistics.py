@@ -0,0 +1,197 @@
+"""
+    Running anomaly ratio statistics per url and asn, updated incrementally with every synced hour
+"""
+# Django imports
+from django.db import transaction
+
+# Local imports
+from blocking_early_warnings.models import ASN, Metric, MetricStatistics, Url
+from blocking_early_warnings.settings import (
+    METRIC_WRITE_CHUNK_SIZE,
+    MONITOR_READ_CHUNK_SIZE,
+    RUNNING_STATISTICS_ALPHA,
+    RUNNING_STATISTICS_MIN_HOURS,
+    TOLERANCE,
+)
+from blocking_early_warnings.utils.anomaly_monitor import (
+    IssueDescription,
+    IssueType,
+    MetricRow,
+)
+
+# Python imports
+from datetime import datetime
+from itertools import groupby
+from operator import itemgetter
+from typing import Dict, List, Optional, Tuple
+
+
+class RunningStatisticsManager:
+    """Keep exponentially weighted statistics of the anomaly ratio for every pair of url and asn.
+
+    Every new hour is folded in O(1), and is tested for spikes against the statistics of the
+    hours before it, so new data can be checked without reading the whole window again.
+    Hours are folded only once, so counts updated after an hour was folded (for example,
+    by the sync overlap) are not reflected until the statistics are rebuilt.
+    Hours older than the last one folded are never folded, so intervals synced in the
+    past (like backfills) only reach the statistics when they're rebuilt
+    """
+
+    def __init__(
+        self,
+        alpha: float = RUNNING_STATISTICS_ALPHA,
+        min_hours: int = RUNNING_STATISTICS_MIN_HOURS,
+        tolerance: float = TOLERANCE,
+        batch_size: int = METRIC_WRITE_CHUNK_SIZE,
+        read_chunk_size: int = MONITOR_READ_CHUNK_SIZE,
+    ):
+        """
+        Args:
+            alpha (float): Weight of every new hour, between 0 and 1. Higher values forget history faster.
+            min_hours (int): How many hours should be folded before testing new hours for spikes.
+            tolerance (float): Spike tolerance, like in the anomaly monitor.
+            batch_size (int): How many statistics are written to database at once.
+            read_chunk_size (int): How many metrics are fetched from the database cursor at once.
+        """
+        assert 0 < alpha <= 1, f"Invalid alpha: {alpha}. It should be in (0, 1]"
+
+        self._alpha = alpha
+        self._min_hours = min_hours
+        self._tolerance = tolerance
+        self._batch_size = batch_size
+        self._read_chunk_size = read_chunk_size
+
+    def update(self, since: Optional[datetime] = None) -> List[IssueDescription]:
+        """Fold every metric from "since" on that is newer than the last hour folded for its pair
+
+        Args:
+            since (Optional[datetime]): Only look for new metrics from this hour on. Defaults to every metric.
+
+        Returns:
+            List[IssueDescription]: Spikes found in the newly folded hours, one issue per pair
+        """
+        (folded, spikes) = self._fold_new_hours(since)
+        self._save(folded)
+
+        return self._to_issues(spikes)
+
+    def _fold_new_hours(
+        self, since: Optional[datetime]
+    ) -> Tuple[List[MetricStatistics], Dict[Tuple[int, int], List[MetricRow]]]:
+        """Fold metrics from "since" on into the stored statistics, without saving them
+
+        Returns:
+            Tuple[List[MetricStatistics], Dict[Tuple[int, int], List[MetricRow]]]: Statistics
+                with new hours folded, and spikes found for each pair of url and asn
+        """
+        statistics: Dict[Tuple[int, int], MetricStatistics] = {
+            (s.url_id, s.asn_id): s for s in MetricStatistics.objects.all()
+        }
+
+        metrics = Metric.objects.filter(hour__isnull=False, measurement_count__gt=0)
+        if since is not None:
+            metrics = metrics.filter(hour__gte=since)
+
+        rows = (
+            metrics.order_by("url_id", "asn_id", "hour")
+            .values_list(
+                "url_id", "asn_id", "id", "hour", "anomaly_count", "measurement_count"
+            )
+            .iterator(chunk_size=self._read_chunk_size)
+        )
+
+        folded: List[MetricStatistics] = []
+        spikes: Dict[Tuple[int, int], List[MetricRow]] = {}
+
+        for ((url_id, asn_id), group) in groupby(rows, key=itemgetter(0, 1)):
+            stats = statistics.get((url_id, asn_id)) or MetricStatistics(
+                url_id=url_id, asn_id=asn_id
+            )
+
+            is_folded = False
+            for row in group:
+                metric = MetricRow(*row[2:])
+                if stats.last_hour is not None and metric.hour <= stats.last_hour:
+                    continue
+
+                ratio = (metric.anomaly_count or 0) / metric.measurement_count
+                if stats.count >= self._min_hours and stats.is_spike(
+                    ratio, self._tolerance
+                ):
+                    spikes.setdefault((url_id, asn_id), []).append(metric)
+
+                self._fold(stats, ratio)
+                stats.last_hour = metric.hour
+                is_folded = True
+
+            if is_folded:
+                folded.append(stats)
+
+        return (folded, spikes)
+
+    def _save(self, folded: List[MetricStatistics]):
+        """Insert or update the given statistics by url and asn, so statistics created
+        by a concurrent update are overwritten instead of duplicated
+        """
+        MetricStatistics.objects.bulk_create(
+            [
+                MetricStatistics(
+                    url_id=s.url_id,
+                    asn_id=s.asn_id,
+                    count=s.count,
+                    mean=s.mean,
+                    variance=s.variance,
+                    last_hour=s.last_hour,
+                )
+                for s in folded
+            ],
+            update_conflicts=True,
+            unique_fields=["url", "asn"],
+            update_fields=["count", "mean", "variance", "last_hour"],
+            batch_size=self._batch_size,
+        )
+
+    def rebuild(self) -> int:
+        """Recompute statistics for every pair from every stored metric
+
+        Returns:
+            int: How many pairs have statistics
+        """
+        with transaction.atomic():
+            MetricStatistics.objects.all().delete()
+            self.update(since=None)
+
+        return MetricStatistics.objects.count()
+
+    def _fold(self, stats: MetricStatistics, ratio: float):
+        """Update the exponentially weighted mean and variance with a new anomaly ratio"""
+        if stats.count == 0:
+            stats.mean, stats.variance = ratio, 0.0
+        else:
+            diff = ratio - stats.mean
+            increment = self._alpha * diff
+            stats.mean += increment
+            stats.variance = (1 - self._alpha) * (stats.variance + diff * increment)
+
+        stats.count += 1
+
+    @staticmethod
+    def _to_issues(
+        spikes: Dict[Tuple[int, int], List[MetricRow]]
+    ) -> List[IssueDescription]:
+        """Build a spike issue for every pair with spikes"""
+        if not spikes:
+            return []
+
+        asns = ASN.objects.in_bulk({asn_id for (_, asn_id) in spikes})
+        urls = Url.objects.in_bulk({url_id for (url_id, _) in spikes})
+
+        return [
+            IssueDescription(
+                asn=asns[asn_id],
+                metrics=metrics,
+                url=urls[url_id],
+                issue_type=IssueType.SPIKE,
+            )
+            for ((url_id, asn_id), metrics) in spikes.items()
+        ]
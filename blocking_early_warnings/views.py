@@ -1,4 +1,5 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+from pytz import utc
 from django.shortcuts import render
 from django.views.generic import TemplateView, View
 from django.http import HttpResponse, HttpRequest, HttpResponseBadRequest, JsonResponse
@@ -29,14 +30,16 @@ class HistogramBackendView(View):
                 - end_date : str = a date to finish counting measurements. If not provided, defaults to now.
                 - asn : str = asn code for an internet provider. If not provided, don't filter by asn
                 - url : str = url for a site. If not provided, don't filter by url
+                - resolution : str = block length, "hour", "day" or "week", or "auto" to choose it from the interval length. Defaults to "hour"
                 
         Returns:
             HttpResponse: A json response providing the following fields:
                 - date_format : str = date format used to express dates in strings
                 - url : Optional[str] = site url if provided as input
                 - asn : Optional[str] = ASN code if provided as input
+                - resolution : str = block length used for this histogram
                 - histogram : [object] = A list of objects for the histogram blocks, with the following format:
-                    - hour : datetime = hour value for this block
+                    - hour : datetime = hour value for this block, the start of its day or week for coarser resolutions
                     - total_count : int = how many measurements for this hour
                     - anomaly_count : int = how many anomalies for this block
         """
@@ -48,27 +51,40 @@ class HistogramBackendView(View):
         end_date = args.get("end_date")
         asn = args.get("asn")
         url = args.get("url")
+        resolution = args.get("resolution")
 
         # Try to parse date into datetimes
         if start_date is not None:
             try:
-                start_date = datetime.strptime(start_date, DATE_FORMAT)
+                start_date = datetime.strptime(start_date, DATE_FORMAT).replace(tzinfo=utc)
             except ValueError as e:
                 return HttpResponseBadRequest(f"Invalid start_date format. Expected format: {DATE_FORMAT}")
 
         if end_date is not None:
             try:
-                end_date = datetime.strptime(end_date, DATE_FORMAT)
+                end_date = datetime.strptime(end_date, DATE_FORMAT).replace(tzinfo=utc)
             except ValueError as e:
                 return HttpResponseBadRequest(f"Invalid end_date format. Expected format: {DATE_FORMAT}")
+
+        resolutions = [*HistogramGenerator.RESOLUTIONS, HistogramGenerator.AUTO_RESOLUTION]
+        if resolution is not None and resolution not in resolutions:
+            return HttpResponseBadRequest(f"Invalid resolution. Expected one of: {', '.join(resolutions)}")
+
+        # Use the same resolution the generator would choose, so it can be reported back
+        end_date = end_date or datetime.now(tz=utc)
+        start_date = start_date or end_date - timedelta(hours=24)
+        resolution = resolution or "hour"
+        if resolution == HistogramGenerator.AUTO_RESOLUTION:
+            resolution = HistogramGenerator.choose_resolution(start_date, end_date)
         
         # Compute histogram content
-        histo = HistogramGenerator.histogram(url, asn, start_date, end_date) 
+        histo = HistogramGenerator.histogram(url, asn, start_date, end_date, resolution) 
 
         return JsonResponse(data={
             "date_format" : DATE_FORMAT,
             "url" : url, 
             "asn" : asn,
+            "resolution" : resolution,
             "histogram" : [
                 {
                     "hour" : datetime.strftime(b.hour, DATE_FORMAT),